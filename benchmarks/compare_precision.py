@@ -0,0 +1,61 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Compare single precision (``dtype=np.float32``) model values with the
+default float64 calculation for the bundled models, using the same synthetic
+inputs as ``run_benchmarks.py``::
+
+  python benchmarks/compare_precision.py --spans 30 365
+
+For each model, time span and ODE solver this prints the maximum and RMS
+absolute difference of the predicted node values (degC) and the ``calc()``
+time of both precisions.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from run_benchmarks import CALC_METHODS, MODEL_SPECS, get_model
+
+
+def calc_model(name, days, evolve_method, rk4, dtype):
+    model = get_model(name, days, evolve_method, rk4, dtype=dtype)
+    model.make()
+    model.calc()
+    t0 = time.perf_counter()
+    model.calc()
+    dt = time.perf_counter() - t0
+    return model.mvals[:model.n_preds].astype(np.float64), dt
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Compare float32 and float64 Xija model values')
+    parser.add_argument('--models', nargs='+', default=sorted(MODEL_SPECS),
+                        choices=sorted(MODEL_SPECS),
+                        help='Models to compare (default=all)')
+    parser.add_argument('--spans', nargs='+', type=float, default=[30.0, 365.0],
+                        help='Model time spans in days (default=30 365)')
+    return parser
+
+
+def main(args=None):
+    opt = get_parser().parse_args(args)
+    print('{:10s} {:>6s} {:>6s} {:>3s} {:>10s} {:>10s} {:>9s} {:>9s}'
+          .format('model', 'days', 'evolve', 'rk4', 'max_diff', 'rms_diff',
+                  't_f64', 't_f32'))
+    for name in opt.models:
+        for days in opt.spans:
+            for evolve_method, rk4 in CALC_METHODS:
+                vals64, t64 = calc_model(name, days, evolve_method, rk4,
+                                         np.float64)
+                vals32, t32 = calc_model(name, days, evolve_method, rk4,
+                                         np.float32)
+                diff = np.abs(vals32 - vals64)
+                print('{:10s} {:6g} {:6d} {:3d} {:10.2e} {:10.2e} {:9.5f} {:9.5f}'
+                      .format(name, days, evolve_method, rk4, diff.max(),
+                              np.sqrt(np.mean(diff ** 2)), t64, t32))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Offline benchmarks of Xija model evaluation.
+
+Models are built from the bundled model specs with synthetic inputs set with
+``set_data()``, so no Ska engineering archive or kadi access is needed.  The
+timings of ``make()``, ``calc()`` (evolve_method 1 and 2 with RK2 / RK4),
+``calc_stat()`` with and without the gradient, and the EarthHeat ``dvals``
+computation are written to a JSON file along with the git commit, so results
+from different commits can be compared.  ``calc()`` and the ODE integration
+alone are timed for each of the ``mvals_layout`` options and head-to-head for
+each integration backend.  The synthetic ``chain`` model (a chain of coupled
+nodes, each with solar heating) provides a large model with 50 mvals rows::
+
+  python benchmarks/run_benchmarks.py --output bench.json
+  python benchmarks/run_benchmarks.py --spans 3 30 --repeat 3 --models dpa
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from Chandra.Time import DateTime
+
+import xija
+
+ROOT = Path(__file__).absolute().parent.parent
+
+MODEL_SPECS = {
+    'dpa': ROOT / 'xija' / 'tests' / 'dpa.json',
+    'pftank2t': ROOT / 'xija' / 'tests' / 'pftank2t.json',
+    'acisfp': ROOT / 'models' / 'acisfp' / 'acisfp_spec.json',
+    'chain': None,
+}
+
+# Number of nodes of the synthetic chain model
+N_CHAIN_NODES = 24
+
+# (evolve_method, rk4) combinations for calc() timing
+CALC_METHODS = ((1, 0), (2, 0), (2, 1))
+
+# (mvals_layout, backend) combinations for calc() and integration timing
+CALC_CONFIGS = (('comp', 'c'), ('time', 'c'), ('comp', 'soa'), ('comp', 'numba'),
+                ('comp', 'jit'))
+
+START = '2015:001:00:00:00'
+
+# Synthetic values for data components that are identified by name
+CONSTANT_INPUTS = {
+    'sim_z': 75000.0,
+    'fep_count': 6,
+    'ccd_count': 6,
+    'vid_board': 1,
+    'clocking': 1,
+    'roll': 0.0,
+    'dh_heater': False,
+    'aoattqt1': 0.0,
+    'aoattqt2': 0.0,
+    'aoattqt3': 0.0,
+    'aoattqt4': 1.0,
+}
+
+
+def set_synthetic_inputs(model):
+    """Set synthetic time-varying inputs for all data components of ``model``
+    so that nothing needs to be fetched.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+
+    Returns
+    -------
+
+    """
+    days = (model.times - model.times[0]) / 86400.0
+    for comp in model.comps:
+        name = comp.name
+        if isinstance(comp, xija.Node):
+            comp.set_data(20.0 + 5.0 * np.sin(2 * np.pi * days / 3.0))
+        elif isinstance(comp, xija.Pitch):
+            comp.set_data(110.0 + 60.0 * np.sin(2 * np.pi * days / 1.7))
+        elif isinstance(comp, xija.Eclipse):
+            comp.set_data(False)
+        elif name in CONSTANT_INPUTS:
+            comp.set_data(CONSTANT_INPUTS[name])
+        elif name.startswith('orbitephem0_'):
+            # Eccentric orbit with a 2.6 day period
+            phase = 2 * np.pi * days / 2.6
+            radius = 80000e3 - 60000e3 * np.cos(phase)
+            vals = {'x': radius * np.cos(phase),
+                    'y': radius * np.sin(phase) * 0.8,
+                    'z': radius * np.sin(phase) * 0.6}
+            comp.set_data(vals[name[-1]])
+        elif isinstance(comp, (xija.TelemData, xija.AcisDpaStatePower)):
+            # AcisDpaStatePower data are the telemetered power (diagnostic only)
+            comp.set_data(0.0)
+
+
+def add_chain_comps(model, n_nodes=N_CHAIN_NODES):
+    """Add a chain of ``n_nodes`` coupled nodes with solar heating and heat
+    sinks at both ends to ``model``.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+    n_nodes :
+        number of nodes (default=N_CHAIN_NODES)
+
+    Returns
+    -------
+
+    """
+    pitch = model.add(xija.Pitch)
+    eclipse = model.add(xija.Eclipse)
+    P_pitches = [45, 70, 90, 130, 180]
+    nodes = []
+    for i in range(n_nodes):
+        node = model.add(xija.Node, 'node{}'.format(i))
+        model.add(xija.SolarHeat, node, pitch, eclipse, P_pitches,
+                  Ps=[0.1 * (1 + i % 3)] * len(P_pitches))
+        if nodes:
+            model.add(xija.Coupling, node, nodes[-1], tau=20.0 + i)
+        nodes.append(node)
+    model.add(xija.HeatSink, nodes[0], T=-10.0, tau=30.0)
+    model.add(xija.HeatSink, nodes[-1], T=10.0, tau=30.0)
+
+
+def get_model(name, days, evolve_method=1, rk4=0, mvals_layout='comp',
+              dtype=np.float64, backend=None):
+    """Build the bundled model ``name`` covering ``days`` with synthetic inputs.
+
+    Parameters
+    ----------
+    name :
+        model name (key of ``MODEL_SPECS``)
+    days :
+        model duration (days)
+    evolve_method :
+        ODE solver (default=1)
+    rk4 :
+        use RK4 for evolve_method=2 (default=0)
+    mvals_layout :
+        memory layout of the model values (default='comp')
+    dtype :
+        floating point type of the model values (default=np.float64)
+    backend :
+        integration backend (default=None)
+
+    Returns
+    -------
+    XijaModel
+    """
+    stop = DateTime(START) + days
+    model = xija.XijaModel(name, start=START, stop=stop,
+                           model_spec=MODEL_SPECS[name],
+                           evolve_method=evolve_method, rk4=rk4,
+                           mvals_layout=mvals_layout, dtype=dtype,
+                           backend=backend)
+    if name == 'chain':
+        add_chain_comps(model)
+    set_synthetic_inputs(model)
+    return model
+
+
+def timeit(func, repeat):
+    """Call ``func`` ``repeat`` times and return timing statistics (sec).
+
+    Parameters
+    ----------
+    func :
+        function with no arguments
+    repeat :
+        number of calls
+
+    Returns
+    -------
+    dict
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return {'min': min(times), 'median': float(np.median(times)),
+            'repeat': repeat}
+
+
+def bench_model(name, days, repeat):
+    """Run the benchmarks for one model and time span.
+
+    Parameters
+    ----------
+    name :
+        model name (key of ``MODEL_SPECS``)
+    days :
+        model duration (days)
+    repeat :
+        number of timed calls of each function
+
+    Returns
+    -------
+    list
+        benchmark result dicts
+    """
+    results = []
+
+    def add(bench, timing, **kwargs):
+        result = dict(model=name, days=days, n_times=model.n_times,
+                      bench=bench, **kwargs)
+        result.update(timing)
+        results.append(result)
+        print('{model:10s} {days:6g} days {bench:14s} {extra:75s} '
+              '{min:10.5f} s'.format(extra=str(kwargs or ''), **result))
+
+    # make() includes computing the component dvals on first call, so time
+    # that once on a fresh model and then the repeated make() separately.
+    model = get_model(name, days)
+    add('make_first', timeit(model.make, 1))
+    add('make', timeit(model.make, repeat))
+
+    for comp in model.comps:
+        if isinstance(comp, xija.EarthHeat):
+            def earth_dvals():
+                comp.__dict__.pop('_dvals', None)
+                return comp.dvals
+            add('earthheat_dvals', timeit(earth_dvals, repeat))
+
+    for evolve_method, rk4 in CALC_METHODS:
+        for mvals_layout, backend in CALC_CONFIGS:
+            model = get_model(name, days, evolve_method, rk4, mvals_layout,
+                              backend=backend)
+            model.make()
+            model.calc()  # Load the core and compile any JIT code
+            config = dict(evolve_method=evolve_method, rk4=rk4,
+                          mvals_layout=mvals_layout, backend=backend)
+            add('calc', timeit(model.calc, repeat), **config)
+            # ODE integration only, without the component updates
+            add('integrate', timeit(model.kernel.run, repeat), **config)
+
+    model = get_model(name, days)
+    model.make()
+    model.calc_stat()
+    add('calc_stat', timeit(model.calc_stat, repeat))
+    model.calc_stat(grad=True)
+    add('calc_stat_grad', timeit(lambda: model.calc_stat(grad=True), repeat),
+        n_thawed=sum(not par.frozen for par in model.pars))
+
+    return results
+
+
+def get_git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii').strip()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Run offline Xija benchmarks')
+    parser.add_argument('--models', nargs='+', default=sorted(MODEL_SPECS),
+                        choices=sorted(MODEL_SPECS),
+                        help='Models to benchmark (default=all)')
+    parser.add_argument('--spans', nargs='+', type=float,
+                        default=[3.0, 30.0, 365.0],
+                        help='Model time spans in days (default=3 30 365)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls of each function (default=5)')
+    parser.add_argument('--output', default=None,
+                        help='Output JSON file (default=bench_<commit>.json)')
+    return parser
+
+
+def main(args=None):
+    opt = get_parser().parse_args(args)
+    commit = get_git_commit()
+
+    results = []
+    for name in opt.models:
+        for days in opt.spans:
+            try:
+                results.extend(bench_model(name, days, opt.repeat))
+            except ImportError as err:
+                # e.g. astropy_healpix for the acisfp EarthHeat component
+                print('Skipping {} {} days: {}'.format(name, days, err))
+                results.append(dict(model=name, days=days, skipped=str(err)))
+
+    output = {'commit': commit,
+              'xija_version': xija.__version__,
+              'numpy_version': np.__version__,
+              'python_version': platform.python_version(),
+              'platform': platform.platform(),
+              'date': datetime.datetime.utcnow().isoformat(),
+              'results': results}
+
+    filename = opt.output or 'bench_{}.json'.format((commit or 'unknown')[:10])
+    with open(filename, 'w') as fh:
+        json.dump(output, fh, indent=2)
+    print('Wrote {}'.format(filename))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,8 +23,10 @@ model = xija.XijaModel('acisfp', model_spec='acisfp_spec.json',
 model.comp['fptemp'].set_data(-120.0)
 
 # These two should be initialized to the given constant values.  No direct
-# analog is available in telemetry.  Ideally one should propagate the model for
-# at least 24 hours from these starting points to remove startup transients.
+# analog is available in telemetry.  The startup transients from these values
+# are removed below with model.solve_initial_state(), which replaces them with
+# the steady state for the inputs at the start time (instead of propagating the
+# model for at least 24 hours before the time of interest).
 model.comp['1cbat'].set_data(-55.0)
 model.comp['sim_px'].set_data(-110.0)
 
@@ -53,6 +55,7 @@ model.comp['clocking'].set_data(1)
 model.comp['dpa_power'].set_data(0.0)
 
 model.make()
+model.solve_initial_state()
 model.calc()
 
 # Note the telemetry MSID is fptemp_11 but the Node name is fptemp
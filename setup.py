@@ -1,6 +1,10 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+from distutils.errors import CompileError, LinkError
 import os
+import shutil
+import tempfile
 
 long_description = """
 Xija (pronounced "kiy - yuh", rhymes with Maya) is the thermal modeling
@@ -15,11 +19,67 @@ framework used Chandra thermal modeling:
 * Matlab interface
 """
 
+# The ensemble (batch) integrators parallelize over members with OpenMP where
+# the compiler supports it, which build_ext checks by compiling and linking a
+# small test program.  Without OpenMP the pragmas are ignored and the members
+# are integrated serially.
+OPENMP_FLAGS = {'msvc': (['/openmp'], []),
+                'unix': (['-fopenmp'], ['-fopenmp'])}
+
+OPENMP_TEST = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() < 1; }
+"""
+
+
+def has_openmp(compiler, compile_args, link_args):
+    """Return True if ``compiler`` builds a test program with OpenMP"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'test_openmp.c')
+        with open(src, 'w') as fh:
+            fh.write(OPENMP_TEST)
+        objs = compiler.compile([src], output_dir=tmpdir,
+                                extra_postargs=compile_args)
+        compiler.link_executable(objs, os.path.join(tmpdir, 'test_openmp'),
+                                 extra_postargs=link_args)
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return True
+
+
+class BuildExt(build_ext):
+    """Build the C cores with OpenMP if the compiler supports it"""
+    def build_extensions(self):
+        compile_args, link_args = OPENMP_FLAGS.get(self.compiler.compiler_type,
+                                                   OPENMP_FLAGS['unix'])
+        if has_openmp(self.compiler, compile_args, link_args):
+            for ext in self.extensions:
+                ext.extra_compile_args = ext.extra_compile_args + compile_args
+                ext.extra_link_args = ext.extra_link_args + link_args
+        else:
+            print('OpenMP not supported by the compiler, building the batch '
+                  'integrators without it')
+        build_ext.build_extensions(self)
+
+
 if os.name == "nt":
     core1_ext = Extension('xija.core_1', ['xija/core_1.c'],
-                      extra_link_args=['/EXPORT:calc_model_1'])
+                          extra_link_args=['/EXPORT:calc_model_1',
+                                           '/EXPORT:calc_model_1_f',
+                                           '/EXPORT:calc_model_1_batch',
+                                           '/EXPORT:calc_model_1_batch_f',
+                                           '/EXPORT:calc_model_1_soa',
+                                           '/EXPORT:calc_model_1_soa_f'])
     core2_ext = Extension('xija.core_2', ['xija/core_2.c'],
-                      extra_link_args=['/EXPORT:calc_model_2'])
+                          extra_link_args=['/EXPORT:calc_model_2',
+                                           '/EXPORT:calc_model_2_f',
+                                           '/EXPORT:calc_model_2_batch',
+                                           '/EXPORT:calc_model_2_batch_f',
+                                           '/EXPORT:calc_model_2_soa',
+                                           '/EXPORT:calc_model_2_soa_f'])
 else:
     core1_ext = Extension('xija.core_1', ['xija/core_1.c'])
     core2_ext = Extension('xija.core_2', ['xija/core_2.c'])
@@ -28,6 +88,7 @@ try:
     from testr.setup_helper import cmdclass
 except ImportError:
     cmdclass = {}
+cmdclass = dict(cmdclass, build_ext=BuildExt)
 
 entry_points = {'console_scripts': 'xija_gui_fit = xija.gui_fit.app:main'}
 
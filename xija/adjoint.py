@@ -0,0 +1,318 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Discrete adjoint (reverse mode) gradients of scalar functions of the model
+values.
+
+Given ``G = dJ/d(mvals)`` for a scalar ``J`` (e.g. the fit statistic) the
+backward pass runs over the stored ``mvals`` trajectory from the last time to
+the first, reverting each step of the evolve_method 1 or 2 scheme.  This
+accumulates ``dJ/d(tmal_floats)`` and ``dJ/d(mvals)`` for the input rows at
+roughly the cost of one extra model integration, independent of the number
+of parameters.  Each component then turns the gradient with respect to its
+TMAL floats and input row into the gradient with respect to its parameters
+(see ``ModelComponent.get_par_grads()``), e.g. directly for a coupling time
+constant or by a sparse product for the solar heat powers.  Only the
+parameters that a component does not cover (e.g. the SolarHeat ``tau``) are
+perturbed, using ``xija.sensitivity.iter_par_derivs()``.
+"""
+import numpy as np
+from numba import njit
+
+from .numba_core import dTdt
+from .sensitivity import iter_par_derivs
+
+__all__ = ['dTdt_vjp', 'calc_adjoint_1', 'calc_adjoint_2', 'calc_adjoint_grad']
+
+
+@njit(cache=True)
+def _add_at(grow, j, w, val):
+    if w == 0.0:
+        grow[j] += val
+    else:
+        grow[j] += (1.0 - w) * val
+        grow[j + 1] += w * val
+
+
+@njit(cache=True)
+def dTdt_vjp(j, w, n_preds, tmal_ints, tmal_floats, mvals, y, lam, gy,
+             gmvals, gfloats):
+    """Vector-Jacobian product of ``xija.numba_core.dTdt``.
+
+    For ``deriv = f(y, mvals, tmal_floats)`` evaluated at column ``j`` and
+    fractional step position ``w`` this adds ``lam . df/dy`` to ``gy``,
+    ``lam . df/dmvals`` to ``gmvals`` and ``lam . df/dtmal_floats`` to
+    ``gfloats``.
+
+    Parameters
+    ----------
+    j :
+        mvals column at the start of the step
+    w :
+        fractional position within the step (0 <= w <= 1)
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    mvals :
+        model mvals array
+    y :
+        predicted node values (length n_preds)
+    lam :
+        adjoint of the derivative (length n_preds)
+    gy :
+        gradient with respect to ``y`` (updated in place)
+    gmvals :
+        gradient with respect to ``mvals`` (updated in place)
+    gfloats :
+        gradient with respect to ``tmal_floats`` (updated in place)
+
+    Returns
+    -------
+
+    """
+    for i in range(tmal_ints.shape[0]):
+        opcode = tmal_ints[i, 0]
+        i1 = tmal_ints[i, 1]
+        i2 = tmal_ints[i, 2]
+        if i1 >= n_preds:
+            continue
+        f0 = tmal_floats[i, 0]
+        f1 = tmal_floats[i, 1]
+        lam1 = lam[i1]
+
+        if opcode == 0:  # Node to node coupling
+            if i2 < n_preds:
+                x2 = y[i2]
+                gy[i2] += lam1 / f0
+            else:
+                if w == 0.0:
+                    x2 = mvals[i2, j]
+                else:
+                    x2 = (1.0 - w) * mvals[i2, j] + w * mvals[i2, j + 1]
+                _add_at(gmvals[i2], j, w, lam1 / f0)
+            gy[i1] -= lam1 / f0
+            gfloats[i, 0] -= lam1 * (x2 - y[i1]) / f0 ** 2
+        elif opcode == 1:  # heat sink (coupling to fixed temperature)
+            gy[i1] -= lam1 / f1
+            gfloats[i, 0] += lam1 / f1
+            gfloats[i, 1] -= lam1 * (f0 - y[i1]) / f1 ** 2
+        elif opcode == 2:  # precomputed heat
+            _add_at(gmvals[i2], j, w, lam1)
+        elif opcode == 3 or opcode == 4:  # active heaters
+            if i2 < n_preds:
+                ctrl = y[i2]
+            elif w == 0.0:
+                ctrl = mvals[i2, j]
+            else:
+                ctrl = (1.0 - w) * mvals[i2, j] + w * mvals[i2, j + 1]
+            dt2 = f0 - ctrl
+            if dt2 > 0:
+                if opcode == 3:
+                    gfloats[i, 0] += lam1 * f1
+                    gfloats[i, 1] += lam1 * dt2
+                    if i2 < n_preds:
+                        gy[i2] -= lam1 * f1
+                    else:
+                        _add_at(gmvals[i2], j, w, -lam1 * f1)
+                else:
+                    gfloats[i, 1] += lam1
+
+
+@njit(cache=True)
+def calc_adjoint_1(n_times, n_preds, dt, tmal_ints, tmal_floats, mvals, gmvals,
+                   gfloats):
+    """Backward pass for the evolve_method=1 scheme of core_1.c.
+
+    On input the predicted rows of ``gmvals`` hold ``dJ/d(mvals)``.  On output
+    they hold the total adjoint of each model value and the other rows hold
+    ``dJ/d(mvals)`` for the inputs.  ``dJ/d(tmal_floats)`` is added to
+    ``gfloats``.  ``dt`` is the two-step time step as used by the C core.
+    """
+    y = np.zeros(n_preds)
+    ym = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    lam_ym = np.zeros(n_preds)
+    lam = np.zeros(n_preds)
+    gy = np.zeros(n_preds)
+
+    j0_last = ((n_times - 3) // 2) * 2
+    for j0 in range(j0_last, -1, -2):
+        for i in range(n_preds):
+            y[i] = mvals[i, j0]
+        dTdt(j0, 0.0, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            ym[i] = y[i] + dt * deriv[i] / 2.0
+
+        # mvals[j0 + 1] = ym + k2 / 2 and mvals[j0 + 2] = ym + k2
+        for i in range(n_preds):
+            lam_ym[i] = gmvals[i, j0 + 1] + gmvals[i, j0 + 2]
+            lam[i] = dt * (gmvals[i, j0 + 1] / 2.0 + gmvals[i, j0 + 2])
+            gy[i] = 0.0
+        dTdt_vjp(j0 + 1, 0.0, n_preds, tmal_ints, tmal_floats, mvals, ym, lam,
+                 gy, gmvals, gfloats)
+        for i in range(n_preds):
+            lam_ym[i] += gy[i]
+
+        # ym = y + dt * f(y) / 2
+        for i in range(n_preds):
+            lam[i] = dt / 2.0 * lam_ym[i]
+            gy[i] = 0.0
+        dTdt_vjp(j0, 0.0, n_preds, tmal_ints, tmal_floats, mvals, y, lam,
+                 gy, gmvals, gfloats)
+        for i in range(n_preds):
+            gmvals[i, j0] += lam_ym[i] + gy[i]
+
+
+@njit(cache=True)
+def calc_adjoint_2(rk4, n_times, n_preds, dt, tmal_ints, tmal_floats, mvals,
+                   gmvals, gfloats):
+    """Backward pass for the RK2 / RK4 scheme of core_2.c.  See
+    ``calc_adjoint_1()`` for the meaning of ``gmvals`` and ``gfloats``.
+    """
+    y = np.zeros(n_preds)
+    yh2 = np.zeros(n_preds)
+    yh3 = np.zeros(n_preds)
+    yh4 = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    lam_y = np.zeros(n_preds)
+    lam_k1 = np.zeros(n_preds)
+    lam_k2 = np.zeros(n_preds)
+    lam_k3 = np.zeros(n_preds)
+    lam = np.zeros(n_preds)
+    gy = np.zeros(n_preds)
+
+    for j in range(n_times - 2, -1, -1):
+        # Recompute the stage values of this step
+        for i in range(n_preds):
+            y[i] = mvals[i, j]
+        dTdt(j, 0.0, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            yh2[i] = y[i] + 0.5 * dt * deriv[i]
+        dTdt(j, 0.5, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, yh2)
+        if rk4:
+            for i in range(n_preds):
+                yh3[i] = y[i] + 0.5 * dt * deriv[i]
+            dTdt(j, 0.5, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, yh3)
+            for i in range(n_preds):
+                yh4[i] = y[i] + dt * deriv[i]
+
+        for i in range(n_preds):
+            lam_y[i] = gmvals[i, j + 1]
+
+        if rk4:
+            # y1 = y + (k1 + 2 k2 + 2 k3 + k4) / 6 with k4 = dt f(y + k3)
+            for i in range(n_preds):
+                lam_k1[i] = lam_y[i] / 6.0
+                lam_k2[i] = lam_y[i] / 3.0
+                lam_k3[i] = lam_y[i] / 3.0
+                lam[i] = dt * lam_y[i] / 6.0
+                gy[i] = 0.0
+            dTdt_vjp(j + 1, 0.0, n_preds, tmal_ints, tmal_floats, mvals, yh4,
+                     lam, gy, gmvals, gfloats)
+            for i in range(n_preds):
+                lam_y[i] += gy[i]
+                lam_k3[i] += gy[i]
+
+            # k3 = dt f(y + k2 / 2)
+            for i in range(n_preds):
+                lam[i] = dt * lam_k3[i]
+                gy[i] = 0.0
+            dTdt_vjp(j, 0.5, n_preds, tmal_ints, tmal_floats, mvals, yh3,
+                     lam, gy, gmvals, gfloats)
+            for i in range(n_preds):
+                lam_y[i] += gy[i]
+                lam_k2[i] += 0.5 * gy[i]
+        else:
+            # y1 = y + k2
+            for i in range(n_preds):
+                lam_k1[i] = 0.0
+                lam_k2[i] = lam_y[i]
+
+        # k2 = dt f(y + k1 / 2)
+        for i in range(n_preds):
+            lam[i] = dt * lam_k2[i]
+            gy[i] = 0.0
+        dTdt_vjp(j, 0.5, n_preds, tmal_ints, tmal_floats, mvals, yh2,
+                 lam, gy, gmvals, gfloats)
+        for i in range(n_preds):
+            lam_y[i] += gy[i]
+            lam_k1[i] += 0.5 * gy[i]
+
+        # k1 = dt f(y)
+        for i in range(n_preds):
+            lam[i] = dt * lam_k1[i]
+            gy[i] = 0.0
+        dTdt_vjp(j, 0.0, n_preds, tmal_ints, tmal_floats, mvals, y,
+                 lam, gy, gmvals, gfloats)
+        for i in range(n_preds):
+            gmvals[i, j] += lam_y[i] + gy[i]
+
+
+def calc_adjoint_grad(model, pars, mvals_grad):
+    """Gradient of a scalar function ``J`` of the model values with respect
+    to ``pars`` using the discrete adjoint of the model ODE solver.
+
+    The model must have been calculated with ``calc()`` for the current
+    parameter values, using ``evolve_method`` 1 or 2.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+    pars :
+        list of Param objects
+    mvals_grad :
+        (n_comps, n_times) array of dJ/d(mvals) for the model values
+
+    Returns
+    -------
+    ndarray
+        dJ/d(par) for each of ``pars``
+    """
+    n_preds = model.n_preds
+    gmvals = np.array(mvals_grad, dtype=np.float64)
+    gfloats = np.zeros(model.tmal_floats.shape)
+
+    # calc() copies the second to last column into the last one
+    gmvals[:n_preds, -2] += gmvals[:n_preds, -1]
+    gmvals[:n_preds, -1] = 0.0
+
+    if model.evolve_method == 1:
+        calc_adjoint_1(model.n_times, n_preds, model.dt_ksec * 2,
+                       model.tmal_ints, model.tmal_floats, model.mvals,
+                       gmvals, gfloats)
+    elif model.evolve_method == 2:
+        calc_adjoint_2(model.rk4, model.n_times, n_preds, model.dt_ksec,
+                       model.tmal_ints, model.tmal_floats, model.mvals,
+                       gmvals, gfloats)
+    else:
+        raise ValueError('adjoint gradient not supported for evolve_method={}'
+                         .format(model.evolve_method))
+
+    tmal_comps = [comp for comp in model.comps if hasattr(comp, 'tmal_ints')]
+    floats_rows = {id(comp): i for i, comp in enumerate(tmal_comps)}
+    par_comps = {id(par): comp for comp in model.comps for par in comp.pars}
+    comp_grads = {}
+    grad = np.zeros(len(pars))
+    fd_idxs = []
+    for i, par in enumerate(pars):
+        comp = par_comps[id(par)]
+        if id(comp) not in comp_grads:
+            row = floats_rows.get(id(comp))
+            floats_grad = None if row is None else gfloats[row]
+            has_input = comp.n_mvals and comp.mvals_i >= n_preds
+            mvals_grad = gmvals[comp.mvals_i] if has_input else None
+            comp_grads[id(comp)] = comp.get_par_grads(floats_grad, mvals_grad)
+        comp_grad = comp_grads[id(comp)]
+        if par.name in comp_grad:
+            grad[i] = comp_grad[par.name]
+        else:
+            fd_idxs.append(i)
+
+    fd_pars = [pars[i] for i in fd_idxs]
+    for i, (dfloats, dmvals) in zip(fd_idxs, iter_par_derivs(model, fd_pars)):
+        grad[i] = np.sum(dfloats * gfloats) + np.sum(dmvals * gmvals[n_preds:])
+
+    return grad
@@ -0,0 +1,117 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Registry of model integration backends.
+
+A backend is a kernel class that integrates the TMAL program of a model.  It
+is created with the model as the only argument after ``make()`` and must
+provide:
+
+- ``evolve_methods``: class attribute with the tuple of supported
+  ``evolve_method`` values
+- ``is_current``: property that is False once the model ``mvals``,
+  ``tmal_ints`` or ``tmal_floats`` buffers have been reallocated, in which
+  case the model creates a new kernel
+- ``run(j0=0)``: integrate the model from the initial state in mvals column
+  ``j0`` using the current buffer contents, leaving the results in the model
+  ``mvals``
+
+The built-in backends are:
+
+============ ============== ==================================================
+Name         evolve_method  Kernel
+============ ============== ==================================================
+``c``        1, 2           ``xija.kernel.CoreKernel`` (C cores via ctypes)
+``soa``      1, 2           ``xija.kernel.SoaKernel`` (TMAL grouped by opcode)
+``numba``    1, 2           ``xija.numba_core.NumbaKernel``
+``jit``      1, 2           ``xija.jit.JitKernel`` (TMAL program unrolled)
+``expm``     3              ``xija.linear.ExpmKernel``
+``implicit`` 4              ``xija.implicit.ImplicitKernel``
+============ ============== ==================================================
+
+Other engines can be added with ``register_backend()`` and then selected with
+``XijaModel(..., backend=name)``.
+"""
+from .implicit import ImplicitKernel
+from .jit import JitKernel
+from .kernel import CoreKernel, SoaKernel
+from .linear import ExpmKernel
+from .numba_core import NumbaKernel
+
+__all__ = ['BACKENDS', 'register_backend', 'get_backend', 'get_default_backend']
+
+BACKENDS = {}
+
+# Backend used for each evolve_method when none is specified
+DEFAULT_BACKENDS = {1: 'c', 2: 'c', 3: 'expm', 4: 'implicit'}
+
+
+def register_backend(name, kernel_class):
+    """Register ``kernel_class`` as the integration backend ``name``.
+
+    Parameters
+    ----------
+    name :
+        backend name
+    kernel_class :
+        kernel class (see module docstring for the required interface)
+
+    Returns
+    -------
+
+    """
+    if not getattr(kernel_class, 'evolve_methods', None):
+        raise ValueError('kernel class {} must define evolve_methods'
+                         .format(kernel_class.__name__))
+    BACKENDS[name] = kernel_class
+
+
+def get_backend(name):
+    """Return the kernel class of the backend ``name``.
+
+    Parameters
+    ----------
+    name :
+        backend name
+
+    Returns
+    -------
+    type
+        kernel class
+    """
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError('unknown backend {!r}, available backends are {}'
+                         .format(name, ', '.join(sorted(BACKENDS))))
+
+
+def get_default_backend(evolve_method, jit=False):
+    """Return the name of the default backend for ``evolve_method``.
+
+    Parameters
+    ----------
+    evolve_method :
+        ODE solver
+    jit :
+        use the JIT-specialized kernel for evolve_method 1 and 2
+        (default=False)
+
+    Returns
+    -------
+    str
+        backend name
+    """
+    if evolve_method not in DEFAULT_BACKENDS:
+        raise ValueError('evolve_method must be one of {}'
+                         .format(sorted(DEFAULT_BACKENDS)))
+    if jit and evolve_method in BACKENDS['jit'].evolve_methods:
+        return 'jit'
+    return DEFAULT_BACKENDS[evolve_method]
+
+
+register_backend('c', CoreKernel)
+register_backend('soa', SoaKernel)
+register_backend('numba', NumbaKernel)
+register_backend('jit', JitKernel)
+register_backend('expm', ExpmKernel)
+register_backend('implicit', ImplicitKernel)
@@ -0,0 +1,612 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Persistent on-disk caches shared between processes.
+
+``DiskCache`` is a directory of entries, each a set of named arrays with JSON
+metadata.  Every array is one ``.npy`` file which is written to a temporary
+file and renamed into place, and which is never modified afterwards, so the
+entries can be loaded as read-only memory maps.  The ``index.json`` file lists
+the files, metadata, size and last access time of each entry and is only read
+or replaced while holding an ``flock`` on ``index.lock``, so any number of
+processes (or threads) can use the same directory.  Reads only take a shared
+lock, with the access times kept in memory and written to the index with the
+next update, or at most every ``atime_flush_interval`` seconds.  When the
+total size exceeds ``max_bytes`` the least recently used entries are evicted.
+
+``TelemetryCache`` uses a ``DiskCache`` to keep the engineering archive
+telemetry fetched by ``XijaModel.fetch()``.  For each MSID and stat it holds
+segments that cover disjoint time ranges, with one column per MSID attribute
+(``times``, ``vals``, ``mins``, ...).  Only the parts of a requested time
+range that are not covered by a segment are read from the archive, after
+which the overlapping and adjacent segments are merged into one.
+
+Content-addressed caches such as the ``EarthHeat`` illumination cache use
+``hash_arrays()`` of the inputs as the ``DiskCache`` key, so that a result is
+reused whenever exactly the same inputs occur again.
+
+The caches are enabled by setting the ``XIJA_CACHE_DIR`` environment variable
+(or ``xija.cache.CACHE_DIR``) to the cache root directory, which may be shared
+by several users.  Each cache is a subdirectory of the root.
+"""
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the index is not locked
+    fcntl = None
+
+__all__ = ['DiskCache', 'TelemetryCache', 'CachedMSID', 'get_disk_cache',
+           'get_telemetry_cache', 'get_columns', 'get_time_slice', 'hash_arrays']
+
+# Root directory of the xija caches, caching is disabled if this is None
+CACHE_DIR = os.environ.get('XIJA_CACHE_DIR') or None
+
+# Size limit of each cache below CACHE_DIR (bytes)
+CACHE_MAX_BYTES = int(os.environ.get('XIJA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Gaps in the telemetry cache coverage shorter than this are not fetched (sec)
+MIN_GAP = 1.0
+
+# DiskCache objects, whose pending access times are written at exit
+_disk_caches = weakref.WeakSet()
+# DiskCache and TelemetryCache objects of get_disk_cache() and
+# get_telemetry_cache(), keyed by directory
+_caches = {}
+
+
+class DiskCache(object):
+    """Size-bounded directory of array sets that is safe for concurrent use.
+
+    Parameters
+    ----------
+    path :
+        cache directory, which is created if needed
+    max_bytes :
+        total size of the cached arrays above which the least recently used
+        entries are evicted (default=CACHE_MAX_BYTES)
+
+    Returns
+    -------
+
+    """
+    index_name = 'index.json'
+    lock_name = 'index.lock'
+    atime_flush_interval = 60.0
+
+    def __init__(self, path, max_bytes=None):
+        self.path = Path(path)
+        self.max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Access times of the entries read since the index was last written
+        self._atimes = {}
+        self._atimes_lock = threading.Lock()
+        self._flush_time = time.time()
+        _disk_caches.add(self)
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        with open(self.path / self.lock_name, 'a') as fh:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _write_atomic(self, filename, write, mode='wb'):
+        # Write to a temp file and rename so that readers never see a
+        # partially written file
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as fh:
+                write(fh)
+            os.replace(tmp_name, self.path / filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def _read_index(self):
+        try:
+            with open(self.path / self.index_name) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, index):
+        self._write_atomic(self.index_name, lambda fh: json.dump(index, fh),
+                           mode='w')
+
+    def _load(self, filename):
+        try:
+            return np.load(self.path / filename, mmap_mode='r', allow_pickle=False)
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            return np.load(self.path / filename, allow_pickle=False)
+
+    def _delete(self, entries):
+        for entry in entries:
+            for filename in entry['files'].values():
+                try:
+                    os.unlink(self.path / filename)
+                except FileNotFoundError:
+                    pass
+
+    def _apply_atimes(self, index):
+        """Set the pending access times in ``index``, which is about to be
+        written while holding the exclusive lock.
+        """
+        with self._atimes_lock:
+            atimes, self._atimes = self._atimes, {}
+            self._flush_time = time.time()
+        for key, atime in atimes.items():
+            if key in index:
+                index[key]['atime'] = max(index[key]['atime'], atime)
+        return bool(atimes)
+
+    def flush(self):
+        """Write the access times of the entries read since the last update
+        of the index.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        """
+        if not self._atimes:
+            return
+        with self._locked(exclusive=True):
+            index = self._read_index()
+            if self._apply_atimes(index):
+                self._write_index(index)
+
+    def _evict(self, index, keep):
+        """Remove least recently used entries other than ``keep`` from
+        ``index`` until the total size is within ``max_bytes``.
+        """
+        total = sum(entry['size'] for entry in index.values())
+        evicted = []
+        for key in sorted(index, key=lambda key: index[key]['atime']):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                total -= index[key]['size']
+                evicted.append(index.pop(key))
+        return evicted
+
+    def entries(self, prefix=''):
+        """Return the metadata of the entries with keys starting with ``prefix``.
+
+        Parameters
+        ----------
+        prefix :
+            key prefix (default='')
+
+        Returns
+        -------
+        dict
+            metadata dict for each key
+        """
+        with self._locked():
+            index = self._read_index()
+        return {key: entry['meta'] for key, entry in index.items()
+                if key.startswith(prefix)}
+
+    def get(self, key):
+        """Return the arrays of entry ``key`` as read-only memory maps, or None
+        if there is no such entry.
+
+        Parameters
+        ----------
+        key :
+            entry key
+
+        Returns
+        -------
+        dict
+            array for each name
+        """
+        with self._locked():
+            entry = self._read_index().get(key)
+            if entry is None:
+                return None
+            # Memory maps stay valid after the files are evicted and unlinked
+            arrays = {name: self._load(filename)
+                      for name, filename in entry['files'].items()}
+
+        now = time.time()
+        with self._atimes_lock:
+            self._atimes[key] = now
+        if now - self._flush_time > self.atime_flush_interval:
+            self.flush()
+        return arrays
+
+    def put(self, key, arrays, meta=None):
+        """Store ``arrays`` as entry ``key``, replacing any existing entry.
+
+        Parameters
+        ----------
+        key :
+            entry key
+        arrays :
+            dict of arrays (object arrays are not supported)
+        meta :
+            JSON-serializable metadata dict (default=None)
+
+        Returns
+        -------
+
+        """
+        files = {}
+        size = 0
+        for name, array in arrays.items():
+            filename = '{}.npy'.format(uuid.uuid4().hex)
+            self._write_atomic(filename, lambda fh: np.save(fh, np.asarray(array),
+                                                            allow_pickle=False))
+            files[name] = filename
+            size += os.path.getsize(self.path / filename)
+
+        with self._locked(exclusive=True):
+            index = self._read_index()
+            self._apply_atimes(index)
+            removed = [index.pop(key)] if key in index else []
+            index[key] = dict(files=files, meta=meta or {}, size=size,
+                              atime=time.time())
+            removed.extend(self._evict(index, keep=key))
+            self._write_index(index)
+            self._delete(removed)
+
+    def remove(self, keys):
+        """Remove the entries ``keys`` that exist.
+
+        Parameters
+        ----------
+        keys :
+            list of entry keys
+
+        Returns
+        -------
+
+        """
+        with self._locked(exclusive=True):
+            index = self._read_index()
+            removed = [index.pop(key) for key in keys if key in index]
+            if removed:
+                self._apply_atimes(index)
+                self._write_index(index)
+            self._delete(removed)
+
+    def clear(self):
+        """Remove all entries.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        """
+        with self._locked(exclusive=True):
+            self._apply_atimes({})
+            self._delete(self._read_index().values())
+            self._write_index({})
+
+    @property
+    def size(self):
+        """Total size of the cached arrays (bytes)"""
+        with self._locked():
+            return sum(entry['size'] for entry in self._read_index().values())
+
+
+class CachedMSID(object):
+    """Telemetry of one MSID read from a ``TelemetryCache``, with the MSID
+    attributes (``times``, ``vals``, ...) that were cached as attributes.
+
+    Parameters
+    ----------
+    msid :
+        MSID name
+    stat :
+        archive statistic
+    cols :
+        dict of column arrays
+
+    Returns
+    -------
+
+    """
+    def __init__(self, msid, stat, cols):
+        self.msid = msid
+        self.stat = stat
+        self.colnames = list(cols)
+        for name, vals in cols.items():
+            setattr(self, name, vals)
+
+
+def get_columns(tlm):
+    """Return the time-sampled columns of the fetched MSID ``tlm`` which can be
+    stored as ``.npy`` files.
+
+    Parameters
+    ----------
+    tlm :
+        object with ``times`` and the attributes in ``colnames``
+
+    Returns
+    -------
+    dict
+        array for each attribute, including ``times``
+    """
+    times = np.asarray(tlm.times)
+    cols = {'times': times}
+    for name in getattr(tlm, 'colnames', ['vals']):
+        vals = np.asarray(getattr(tlm, name))
+        if vals.shape[:1] == times.shape and vals.dtype != object:
+            cols[name] = vals
+    return cols
+
+
+def _merge_columns(cols_list):
+    """Combine the columns of several segments, sorted by time and with
+    duplicate times removed.
+    """
+    names = [name for name in cols_list[0]
+             if all(name in cols for cols in cols_list)]
+    times, idxs = np.unique(np.concatenate([cols['times'] for cols in cols_list]),
+                            return_index=True)
+    return {name: np.concatenate([cols[name] for cols in cols_list])[idxs]
+            for name in names}
+
+
+def get_time_slice(times, tstart, tstop):
+    """Return the index range of the sorted ``times`` from ``tstart`` to
+    ``tstop`` inclusive.
+
+    Parameters
+    ----------
+    times :
+        sorted times (CXC secs)
+    tstart :
+        start time (CXC secs)
+    tstop :
+        stop time (CXC secs)
+
+    Returns
+    -------
+    tuple
+        (i0, i1) such that ``times[i0:i1]`` is in the time range
+    """
+    return (int(np.searchsorted(times, tstart, side='left')),
+            int(np.searchsorted(times, tstop, side='right')))
+
+
+def _slice_columns(cols, tstart, tstop):
+    i0, i1 = get_time_slice(cols['times'], tstart, tstop)
+    return {name: vals[i0:i1] for name, vals in cols.items()}
+
+
+class TelemetryCache(object):
+    """Persistent cache of engineering archive telemetry keyed by MSID, stat
+    and attribute, which fetches only the time ranges it does not hold.
+
+    A segment fetched up to a time after the last available sample only
+    covers the time of that sample, so telemetry that is added to the archive
+    later is fetched next time.
+
+    Parameters
+    ----------
+    path :
+        cache directory
+    max_bytes :
+        size limit of the cache (default=CACHE_MAX_BYTES)
+
+    Returns
+    -------
+
+    """
+    def __init__(self, path, max_bytes=None):
+        self.cache = DiskCache(path, max_bytes)
+
+    @staticmethod
+    def _get_prefix(msid, stat):
+        return '{}/{}/'.format(msid.lower(), stat)
+
+    def get_gaps(self, msid, tstart, tstop, stat='5min'):
+        """Return the parts of the time range which are not in the cache.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tstart :
+            start time (CXC secs)
+        tstop :
+            stop time (CXC secs)
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+        list
+            (tstart, tstop) of each gap
+        """
+        segs = self.cache.entries(self._get_prefix(msid, stat)).values()
+        return self._get_gaps(tstart, tstop, [(seg['tstart'], seg['tstop'])
+                                              for seg in segs])
+
+    @staticmethod
+    def _get_gaps(tstart, tstop, ranges):
+        gaps = []
+        t0 = tstart
+        for seg_start, seg_stop in sorted(ranges):
+            if min(seg_start, tstop) - t0 >= MIN_GAP:
+                gaps.append((t0, min(seg_start, tstop)))
+            t0 = max(t0, seg_stop)
+        if tstop - t0 >= MIN_GAP:
+            gaps.append((t0, tstop))
+        return gaps
+
+    def fetch(self, msid, tstart, tstop, fetch_func, stat='5min'):
+        """Get the telemetry of ``msid`` from ``tstart`` to ``tstop``, calling
+        ``fetch_func(msid, tstart, tstop, stat)`` for the time ranges that are
+        not cached.
+
+        ``fetch_func`` must return an object with a ``times`` attribute and
+        the attributes in its ``colnames`` list (e.g. a Ska.engarchive MSID,
+        with bad times already filtered).
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tstart :
+            start time (CXC secs)
+        tstop :
+            stop time (CXC secs)
+        fetch_func :
+            function that fetches telemetry from the archive
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+        CachedMSID
+        """
+        prefix = self._get_prefix(msid, stat)
+
+        # Each piece is (tstart, tstop, key of cached segment or None, columns).
+        # All cached segments are loaded before any new segment is stored, as
+        # storing may evict them (the memory maps remain valid).  Segments
+        # evicted since entries() are left out so that their time range is
+        # fetched again as a gap.
+        pieces = []
+        for key, seg in self.cache.entries(prefix).items():
+            if seg['tstart'] <= tstop and seg['tstop'] >= tstart:
+                cols = self.cache.get(key)
+                if cols is not None:
+                    pieces.append((seg['tstart'], seg['tstop'], key, cols))
+
+        empty = None
+        for gap_start, gap_stop in self._get_gaps(
+                tstart, tstop, [piece[:2] for piece in pieces]):
+            cols = get_columns(fetch_func(msid, gap_start, gap_stop, stat))
+            times = cols['times']
+            if len(times) == 0:
+                empty = cols
+                continue
+            # Data ending more than two samples before the gap stop are taken
+            # to be the end of the archive so far
+            dt = np.median(np.diff(times)) if len(times) > 1 else 0.0
+            if times[-1] < gap_stop - 2 * dt:
+                gap_stop = float(times[-1])
+            pieces.append((gap_start, gap_stop, None, cols))
+
+        # Merge overlapping and adjacent pieces into contiguous segments
+        groups = []
+        for piece in sorted(pieces, key=lambda piece: piece[:2]):
+            if groups and piece[0] <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], piece[1])
+                groups[-1][2].append(piece)
+            else:
+                groups.append([piece[0], piece[1], [piece]])
+
+        out = []
+        for seg_start, seg_stop, group in groups:
+            keys = [key for _, _, key, _ in group if key is not None]
+            if len(group) == 1 and keys:
+                cols = group[0][3]
+            else:
+                cols = _merge_columns([cols for _, _, _, cols in group])
+                self.cache.put(prefix + uuid.uuid4().hex, cols,
+                               meta={'tstart': seg_start, 'tstop': seg_stop})
+                self.cache.remove(keys)
+            out.append(_slice_columns(cols, tstart, tstop))
+
+        if not out:
+            cols = (empty if empty is not None
+                    else get_columns(fetch_func(msid, tstart, tstop, stat)))
+        else:
+            cols = out[0] if len(out) == 1 else _merge_columns(out)
+        return CachedMSID(msid, stat, cols)
+
+def hash_arrays(*arrays):
+    """Return a hex digest of the dtype, shape and contents of ``arrays``.
+
+    Parameters
+    ----------
+    *arrays :
+        arrays to hash
+
+    Returns
+    -------
+    str
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update('{} {};'.format(array.dtype.str, array.shape).encode('ascii'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def get_disk_cache(name):
+    """Return the ``DiskCache`` in the directory ``name`` below ``CACHE_DIR``,
+    or None if caching is disabled.
+
+    Parameters
+    ----------
+    name :
+        cache name
+
+    Returns
+    -------
+    DiskCache or None
+    """
+    if CACHE_DIR is None:
+        return None
+    path = Path(CACHE_DIR) / name
+    if path not in _caches:
+        _caches[path] = DiskCache(path, CACHE_MAX_BYTES)
+    return _caches[path]
+
+
+def get_telemetry_cache():
+    """Return the telemetry cache in the ``telemetry`` directory below
+    ``CACHE_DIR``, or None if caching is disabled.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    TelemetryCache or None
+    """
+    if CACHE_DIR is None:
+        return None
+    path = Path(CACHE_DIR) / 'telemetry'
+    if path not in _caches:
+        _caches[path] = TelemetryCache(path, CACHE_MAX_BYTES)
+    return _caches[path]
+
+
+@atexit.register
+def _flush_disk_caches():
+    for disk_cache in list(_disk_caches):
+        try:
+            disk_cache.flush()
+        except OSError:
+            pass
@@ -1,5 +1,6 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 import numpy as np
+import scipy.sparse
 import six
 
 try:
@@ -8,12 +9,26 @@ except ImportError:
     pass
 
 from .. import tmal
+from ..profiling import profiled
 
 
 class Param(dict):
     """Model component parameter.  Inherits from dict but adds attribute access
     for convenience.
 
+    The parameter value is not stored in the dict but in element ``index`` of
+    a ``vals`` array that is shared by all parameters of a model (see
+    ``bind()``), so that ``XijaModel.parvals`` is a single array operation.
+    Item and attribute access to ``val`` read and write that element.
+
+    The ``version`` attribute (which is not one of the dict items) is
+    incremented each time ``val`` is set to a different value.  This lets the
+    model skip ``update()`` of components whose parameters did not change.
+
+    ``copy.copy()`` returns a standalone parameter with a snapshot of the
+    value, while pickling and ``copy.deepcopy()`` keep the parameters of a
+    model as views of one (copied) array.  The value cannot be None.
+
     Parameters
     ----------
 
@@ -24,6 +39,7 @@ class Param(dict):
     def __init__(self, comp_name, name, val, min=-1e38, max=1e38,
                  fmt="{:.4g}", frozen=False):
         dict.__init__(self)
+        self.bind(np.full(1, np.nan), np.zeros(1, dtype=np.int64), 0)
         self.comp_name = comp_name
         self.name = name
         self.val = val
@@ -33,15 +49,132 @@ class Param(dict):
         self.frozen = frozen
         self.full_name = comp_name + '__' + name
 
-    def __setattr__(self, attr, val):
+    def bind(self, vals, versions, index):
+        """Store the value and version of this parameter in element ``index``
+        of the ``vals`` and ``versions`` arrays, copying the current values.
+
+        Parameters
+        ----------
+        vals :
+            float array of parameter values
+        versions :
+            int array of parameter versions
+        index :
+            index of this parameter in ``vals`` and ``versions``
+
+        Returns
+        -------
+
+        """
+        if '_vals' in self.__dict__:
+            vals[index] = self._vals[self._index]
+            versions[index] = self._versions[self._index]
+        self.__dict__.update(_vals=vals, _versions=versions, _index=index)
+
+    @property
+    def val(self):
+        return float(self._vals[self._index])
+
+    @property
+    def version(self):
+        return int(self._versions[self._index])
+
+    def __getitem__(self, attr):
+        if attr == 'val':
+            return self.val
+        return dict.__getitem__(self, attr)
+
+    def __setitem__(self, attr, val):
+        if attr == 'val':
+            if val is None:
+                raise ValueError('value of parameter {} must be a number, not None'
+                                 .format(dict.get(self, 'name')))
+            if not self._vals[self._index] == val:
+                self._vals[self._index] = val
+                self._versions[self._index] += 1
+            # Placeholder so that 'val' is listed in the dict keys
+            val = None
         dict.__setitem__(self, attr, val)
 
+    # Iterate explicitly so that dict(par) uses __getitem__ for 'val'
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, attr, default=None):
+        return self[attr] if attr in self else default
+
+    def items(self):
+        return [(attr, self[attr]) for attr in self.keys()]
+
+    def values(self):
+        return [self[attr] for attr in self.keys()]
+
+    def update(self, *args, **kwargs):
+        for attr, val in dict(*args, **kwargs).items():
+            self[attr] = val
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __setattr__(self, attr, val):
+        self[attr] = val
+
     def __getattr__(self, attr):
-        return dict.__getitem__(self, attr)
+        try:
+            return dict.__getitem__(self, attr)
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __copy__(self):
+        # Standalone parameter with a snapshot of the value and version
+        par = self.__class__(self.comp_name, self.name, self.val)
+        par._versions[0] = self.version
+        for attr, val in self.items():
+            if attr != 'val':
+                dict.__setitem__(par, attr, val)
+        return par
+
+    def __reduce__(self):
+        # Pickle and deepcopy the shared arrays along with the index, so the
+        # parameters of a copied model remain views of one copied array.
+        state = {'attrs': {attr: val for attr, val in self.items() if attr != 'val'},
+                 '_vals': self._vals, '_versions': self._versions,
+                 '_index': self._index}
+        return (self.__class__, (self.comp_name, self.name, self.val), state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(_vals=state['_vals'], _versions=state['_versions'],
+                             _index=state['_index'])
+        for attr, val in state['attrs'].items():
+            dict.__setitem__(self, attr, val)
 
 
 class ModelComponent(object):
     """Model component base class"""
+    # Attributes that cache values computed on the model times.  These are
+    # deleted by reset_time_caches() when the model times change, or extended
+    # by extend_time_caches() when the model is extended.
+    time_cache_attrs = ('_dvals', '_model_plotdate')
+
+    # The model only calls update() when the component parameters or the
+    # model mvals array changed since the last call.  Set this to False in
+    # subclasses where update() depends on other state.
+    track_changes = True
+
+    # Names (``fnmatch`` patterns) of the parameters on which the predicted
+    # node values depend linearly, e.g. a power that scales a precomputed heat
+    # input.  These can be solved exactly with ``xija.varpro``.
+    linear_pars = ()
+
+    # Names of the parameters whose values are the TMAL floats of the
+    # component, in order, or None for a float computed from the parameters.
+    # See get_par_grads().
+    tmal_float_pars = ()
+
+    # MSIDs that computing dvals fetches from the engineering archive when no
+    # data are set.  See get_fetch_msids().
+    fetch_msids = ()
+
     def __init__(self, model):
         # This class overrides __setattr__ with a method that requires
         # the `pars` and `pars_dict` attrs to be visible.  So do this
@@ -58,6 +191,11 @@ class ModelComponent(object):
     n_parvals = property(lambda self: len(self.parvals))
     times = property(lambda self: self.model.times)
 
+    @property
+    def profiler(self):
+        """Profiler of the parent model (None unless profiling is enabled)"""
+        return self.model.profiler
+
     @property
     def model_plotdate(self):
         if not hasattr(self, '_model_plotdate'):
@@ -113,7 +251,13 @@ class ModelComponent(object):
 
     @property
     def parvals(self):
-        return np.array([par.val for par in self.pars])
+        pars = self.pars
+        # Parameters added to the model are contiguous in the model array
+        if pars and pars[-1]._vals is pars[0]._vals:
+            i0 = pars[0]._index
+            if pars[-1]._index == i0 + len(pars) - 1:
+                return pars[0]._vals[i0:i0 + len(pars)].copy()
+        return np.array([par.val for par in pars])
 
     @property
     def parnames(self):
@@ -122,14 +266,105 @@ class ModelComponent(object):
     def update(self):
         pass
 
+    @property
+    def update_key(self):
+        """Key that changes whenever ``update()`` could give a different
+        result, made from the model ``mvals_generation`` and the parameter
+        versions, or None if ``track_changes`` is False.  The generation is
+        bumped by ``make_mvals()``, ``set_data()`` and ``invalidate()``."""
+        if not self.track_changes:
+            return None
+        return (self.model.mvals_generation,) + tuple(par.version for par in self.pars)
+
+    def get_par_grads(self, floats_grad, mvals_grad):
+        """Gradient of a scalar function ``J`` of the model values with
+        respect to the component parameters, given the gradient with respect
+        to the component TMAL floats and mvals row (see ``xija.adjoint``).
+
+        This covers the parameters in ``tmal_float_pars``.  Subclasses add the
+        parameters whose derivative follows from the component update, e.g.
+        the ``linear_pars``.  The gradient of any parameter left out is
+        computed by finite differences.
+
+        Parameters
+        ----------
+        floats_grad :
+            dJ/d(tmal_floats) of the component TMAL statement (None if none)
+        mvals_grad :
+            dJ/d(mvals) of the component input mvals row (None if none)
+
+        Returns
+        -------
+        dict
+            dJ/d(par) by parameter name
+        """
+        grads = {}
+        if floats_grad is not None:
+            for name, grad in zip(self.tmal_float_pars, floats_grad):
+                if name is not None:
+                    grads[name] = grad
+        return grads
+
+    def reset_time_caches(self):
+        """Delete cached values that depend on the model times so they get
+        recomputed on next access (e.g. after ``XijaModel.extend()``)."""
+        for attr in self.time_cache_attrs:
+            self.__dict__.pop(attr, None)
+
+    def extend_time_caches(self, tail, j0):
+        """Extend the cached values that depend on the model times with those
+        of the same component ``tail`` in a model covering the model times
+        from index ``j0`` (see ``XijaModel.extend()``).  Cached values with
+        one entry per model time are kept up to ``j0`` and the ``tail`` values
+        are appended.  Any other cached values are deleted so they get
+        recomputed on next access.
+
+        Parameters
+        ----------
+        tail :
+            component of the model covering the times from ``j0``
+        j0 :
+            model time index of the first ``tail`` model time
+
+        Returns
+        -------
+
+        """
+        for attr in self.time_cache_attrs:
+            vals = self.__dict__.pop(attr, None)
+            tail_vals = tail.__dict__.get(attr)
+            if (getattr(vals, 'ndim', 0) > 0 and getattr(tail_vals, 'ndim', 0) > 0
+                    and vals.shape[0] == self.model.n_times
+                    and tail_vals.shape[0] == tail.model.n_times):
+                if scipy.sparse.issparse(vals):
+                    vals = scipy.sparse.vstack([vals[:j0], tail_vals], format='csr')
+                else:
+                    vals = np.concatenate([vals[:j0], tail_vals])
+                self.__dict__[attr] = vals
+
     def set_data(self, data, times=None):
         self.data = data
         if times is not None:
             self.data_times = times
+        self.model.invalidate()
 
     def get_dvals_tlm(self):
         return np.zeros_like(self.model.times)
 
+    def get_fetch_msids(self):
+        """Return the MSIDs that computing ``dvals`` will fetch from the
+        engineering archive, so the model can prefetch them all at once.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        tuple
+            MSID names
+        """
+        return self.fetch_msids if self.data is None else ()
+
     @property
     def dvals(self):
         if not hasattr(self, '_dvals'):
@@ -170,6 +405,9 @@ class TelemData(ModelComponent):
     def get_dvals_tlm(self):
         return self.model.fetch(self.msid, attr=self.fetch_attr)
 
+    def get_fetch_msids(self):
+        return (self.msid,) if self.data is None else ()
+
     def plot_data__time(self, fig, ax):
         lines = ax.get_lines()
         if not lines:
@@ -193,6 +431,9 @@ class CmdStatesData(TelemData):
     def get_dvals_tlm(self):
         return self.model.cmd_states[self.msid]
 
+    def get_fetch_msids(self):
+        return ()
+
 
 class Node(TelemData):
     """Time-series dataset for prediction.
@@ -226,6 +467,8 @@ class Node(TelemData):
     -------
 
     """
+    time_cache_attrs = TelemData.time_cache_attrs + ('_randx',)
+
     def __init__(self, model, msid, sigma=-10, quant=None,
                  predict=True, mask=None, name=None, data=None,
                  fetch_attr='vals', units='degC'):
@@ -272,6 +515,7 @@ class Node(TelemData):
             resid[i0:i1] = 0.0
         return resid
 
+    @profiled('calc_stat', comp=True)
     def calc_stat(self):
         if self.sigma == 0:
             return 0.0
@@ -280,6 +524,42 @@ class Node(TelemData):
             resids = resids[self.mask.mask]
         return np.sum(resids ** 2 / self.sigma ** 2)
 
+    def calc_stat_mvals_grad(self):
+        """Gradient of ``calc_stat()`` with respect to the node model values.
+        This is zero for masked times and ``mask_times`` (including the model
+        ``bad_times``), as for the residuals in ``calc_stat()``.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        ndarray
+            d(stat)/d(mvals) at each model time
+        """
+        if self.sigma == 0:
+            return np.zeros(self.model.n_times)
+        grad = -2.0 * self.resids / self.sigma ** 2
+        if self.mask is not None:
+            grad[~self.mask.mask] = 0.0
+        return grad
+
+    def calc_stat_grad(self, dmvals):
+        """Gradient of ``calc_stat()`` given the derivatives ``dmvals`` of the
+        node model values with respect to each parameter.
+
+        Parameters
+        ----------
+        dmvals :
+            (n_pars, n_times) array of d(mvals)/d(par) for this node
+
+        Returns
+        -------
+        ndarray
+            d(stat)/d(par) for each parameter
+        """
+        return dmvals.dot(self.calc_stat_mvals_grad())
+
     def plot_data__time(self, fig, ax):
         lines = ax.get_lines()
         if not lines:
@@ -344,6 +624,8 @@ class Coupling(ModelComponent):
     -------
 
     """
+    tmal_float_pars = ('tau',)
+
     def __init__(self, model, node1, node2, tau):
         ModelComponent.__init__(self, model)
         self.node1 = self.model.get_comp(node1)
@@ -363,6 +645,8 @@ class Coupling(ModelComponent):
 
 class HeatSink(ModelComponent):
     """Fixed temperature external heat bath"""
+    tmal_float_pars = ('T', 'tau')
+
     def __init__(self, model, node, T=0.0, tau=20.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -400,6 +684,8 @@ class HeatSinkRef(ModelComponent):
     -------
 
     """
+    linear_pars = ('P',)
+
     def __init__(self, model, node, T=0.0, tau=20.0, T_ref=20.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -413,6 +699,12 @@ class HeatSinkRef(ModelComponent):
         self.tmal_floats = (self.P * self.tau + self.T_ref,
                             self.tau)
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        grad_T, grad_tau = floats_grad[:2]
+        return {'P': grad_T * self.tau,
+                'tau': grad_T * self.P + grad_tau,
+                'T_ref': grad_T}
+
     def __str__(self):
         return 'heatsink__{0}'.format(self.node)
 
@@ -13,6 +13,8 @@ from . import tmal
 
 class AcisDpaPower6(PrecomputedHeatPower):
     """Heating from ACIS electronics (ACIS config dependent CCDs, FEPs etc)"""
+    fetch_msids = ('1dp28avo', '1dpicacu', '1dp28bvo', '1dpicbcu')
+
     def __init__(self, model, node, k=1.0, dp611=0.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -50,6 +52,8 @@ class AcisDpaPower6(PrecomputedHeatPower):
 
 class AcisDpaPowerClipped(PrecomputedHeatPower):
     """Heating from ACIS electronics (ACIS config dependent CCDs, FEPs etc)"""
+    fetch_msids = ('1dp28avo', '1dpicacu', '1dp28bvo', '1dpicbcu')
+
     def __init__(self, model, node, k=1.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -93,6 +97,9 @@ class AcisDpaPowerClipped(PrecomputedHeatPower):
 
 class SolarHeatSimZ(SolarHeat):
     """Solar heating (pitch and SimZ dependent)"""
+    time_cache_attrs = SolarHeat.time_cache_attrs + ('hrcs_mask', 'hrci_mask',
+                                                     'acisi_mask')
+
     def __init__(self, model, node, simz_comp, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.05, bias=0.0, epoch='2010:001:12:00:00',
@@ -3,28 +3,65 @@ from __future__ import print_function
 
 import re
 from itertools import count
-import glob
-import os
 from six.moves import zip
 from pathlib import Path
 
 from numba import jit
 import numpy as np
 import scipy.interpolate
+import scipy.sparse
 import astropy.units as u
 from astropy.io import fits
 
 try:
-    import Ska.Numpy
     from Ska.Matplotlib import plot_cxctime
     from Chandra.Time import DateTime
 except ImportError:
     pass
 
 from .base import ModelComponent, TelemData
+from .. import cache
 from .. import tmal
 
 
+def interpolation_weights(xp, x, cols=None, n_cols=None):
+    """Sparse matrix of the linear interpolation weights of the nodes ``xp``
+    at the points ``x``, such that ``weights.dot(fp)`` is the linear
+    interpolation of the values ``fp`` at ``xp``.  The ``x`` values must be
+    within the range of ``xp``.
+
+    Parameters
+    ----------
+    xp :
+        increasing node positions
+    x :
+        interpolation points
+    cols :
+        column offset of the nodes for each point (default=None for 0).  This
+        allows picking one of several sets of node values for each point.
+    n_cols :
+        number of matrix columns (default=len(xp))
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (len(x), n_cols) matrix with at most two non-zero values per row
+    """
+    xp = np.asarray(xp, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    idx = np.searchsorted(xp, x, side='right') - 1
+    idx = idx.clip(0, len(xp) - 2)
+    frac = (x - xp[idx]) / (xp[idx + 1] - xp[idx])
+    if cols is not None:
+        idx = idx + cols
+    n_x = len(x)
+    data = np.column_stack([1.0 - frac, frac]).ravel()
+    indices = np.column_stack([idx, idx + 1]).ravel()
+    indptr = np.arange(0, 2 * n_x + 1, 2)
+    return scipy.sparse.csr_matrix((data, indices, indptr),
+                                   shape=(n_x, n_cols or len(xp)))
+
+
 class PrecomputedHeatPower(ModelComponent):
     """Component that provides static (precomputed) direct heat power input"""
 
@@ -44,6 +81,15 @@ class PrecomputedHeatPower(ModelComponent):
     def exp(days, tau):
         return 1 - np.exp(-days / tau)
 
+    def get_var_vals(self):
+        """Return ``var_func(t_days, tau)``, which is only recomputed when
+        ``tau`` changes."""
+        var_vals = self.__dict__.get('_var_vals')
+        if var_vals is None or var_vals[0] != self.tau:
+            var_vals = self._var_vals = (self.tau,
+                                         self.var_func(self.t_days, self.tau))
+        return var_vals[1]
+
 
 class ActiveHeatPower(ModelComponent):
     """Component that provides active heat power input which depends on
@@ -78,6 +124,9 @@ class SolarHeatOffNomRoll(PrecomputedHeatPower):
     -------
 
     """
+    time_cache_attrs = (PrecomputedHeatPower.time_cache_attrs
+                        + ('sun_body_y', 'plus_y'))
+    linear_pars = ('P_plus_y', 'P_minus_y')
 
     def __init__(self, model, node, pitch_comp, roll_comp, eclipse_comp=None,
                  P_plus_y=0.0, P_minus_y=0.0):
@@ -109,6 +158,13 @@ class SolarHeatOffNomRoll(PrecomputedHeatPower):
 
         return self._dvals
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        grad = mvals_grad * self.sun_body_y
+        if self.eclipse_comp is not None:
+            grad = np.where(self.eclipse_comp.dvals, 0.0, grad)
+        return {'P_plus_y': grad[self.plus_y].sum(),
+                'P_minus_y': grad[~self.plus_y].sum()}
+
     def __str__(self):
         return 'solarheat_off_nom_roll__{0}'.format(self.node)
 
@@ -147,6 +203,11 @@ class SolarHeat(PrecomputedHeatPower):
     -------
 
     """
+    time_cache_attrs = (PrecomputedHeatPower.time_cache_attrs
+                        + ('pitches', 't_days', '_t_phase', 'P_vals', 'dP_vals',
+                           '_pitch_weights', '_cos_phase', '_var_vals'))
+    linear_pars = ('P_*', 'dP_*', 'ampl', 'bias')
+
     def __init__(self, model, node, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.05, bias=0.0, epoch='2010:001:12:00:00'):
@@ -197,6 +258,28 @@ class SolarHeat(PrecomputedHeatPower):
     @t_phase.deleter
     def t_phase(self):
         self._t_phase = None
+        self.__dict__.pop('_cos_phase', None)
+
+    @property
+    def cos_phase(self):
+        """Annual variation ``cos(t_phase)`` at each model time"""
+        if '_cos_phase' not in self.__dict__:
+            self._cos_phase = np.cos(self.t_phase)
+        return self._cos_phase
+
+    @property
+    def pitch_weights(self):
+        """Sparse (n_times, n_pitches) matrix of the interpolation weights of
+        the ``P_pitches`` nodes at the pitch of each model time.  This is
+        computed once per time grid, after which the interpolated powers are
+        a sparse matrix-vector product."""
+        if '_pitch_weights' not in self.__dict__:
+            if not hasattr(self, 'pitches'):
+                self.pitches = np.clip(self.pitch_comp.dvals, self.P_pitches[0],
+                                       self.P_pitches[-1])
+            self._pitch_weights = interpolation_weights(self.P_pitches,
+                                                        self.pitches)
+        return self._pitch_weights
 
     @property
     def epoch(self):
@@ -239,6 +322,7 @@ class SolarHeat(PrecomputedHeatPower):
             # Delete these cached attributes which depend on epoch
             del self.t_days
             del self.t_phase
+            self.__dict__.pop('_var_vals', None)
 
         self._epoch = value
 
@@ -246,27 +330,33 @@ class SolarHeat(PrecomputedHeatPower):
         """Override this method to adjust self._dvals after main computation."""
         pass
 
+    def dvals_post_hook_grads(self, mvals_grad):
+        """Override this method to return the gradient with respect to the
+        parameters used in ``dvals_post_hook()`` (see ``get_par_grads()``)."""
+        return {}
+
     def _compute_dvals(self):
-        vf = self.var_func(self.t_days, self.tau)
+        vf = self.get_var_vals()
         return (self.P_vals + self.dP_vals*vf +
-                self.ampl * np.cos(self.t_phase)).reshape(-1)
+                self.ampl * self.cos_phase).reshape(-1)
+
+    def _compute_dvals_grads(self, grad):
+        """Return the gradients with respect to ``P_vals``, ``dP_vals`` and
+        ``ampl`` (None if not linear) given the gradient ``grad`` with respect
+        to the ``_compute_dvals()`` values."""
+        return grad, grad * self.get_var_vals(), np.dot(grad, self.cos_phase)
 
     @property
     def dvals(self):
-        if not hasattr(self, 'pitches'):
-            self.pitches = np.clip(self.pitch_comp.dvals, self.P_pitches[0], self.P_pitches[-1])
         if not hasattr(self, 't_days'):
             self.t_days = (self.pitch_comp.times
                            - DateTime(self.epoch).secs) / 86400.0
 
-        Ps = self.parvals[0:self.n_pitches] + self.bias
-        dPs = self.parvals[self.n_pitches:2 * self.n_pitches]
-        Ps_interp = scipy.interpolate.interp1d(self.P_pitches, Ps,
-                                               kind='linear')
-        dPs_interp = scipy.interpolate.interp1d(self.P_pitches, dPs,
-                                                kind='linear')
-        self.P_vals = Ps_interp(self.pitches)
-        self.dP_vals = dPs_interp(self.pitches)
+        parvals = self.parvals
+        Ps = parvals[0:self.n_pitches] + self.bias
+        dPs = parvals[self.n_pitches:2 * self.n_pitches]
+        self.P_vals = self.pitch_weights.dot(Ps)
+        self.dP_vals = self.pitch_weights.dot(dPs)
 
         self._dvals = self._compute_dvals()
 
@@ -279,6 +369,24 @@ class SolarHeat(PrecomputedHeatPower):
 
         return self._dvals
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        grad = np.array(mvals_grad, dtype=np.float64)
+        if self.eclipse_comp is not None:
+            grad[self.eclipse_comp.dvals] = 0.0
+        grad_P_vals, grad_dP_vals, grad_ampl = self._compute_dvals_grads(grad)
+        grad_Ps = self.pitch_weights.T.dot(grad_P_vals)
+        grad_dPs = self.pitch_weights.T.dot(grad_dP_vals)
+
+        n_pitches = self.n_pitches
+        parnames = self.parnames
+        grads = dict(zip(parnames[0:n_pitches], grad_Ps))
+        grads.update(zip(parnames[n_pitches:2 * n_pitches], grad_dPs))
+        grads['bias'] = grad_Ps.sum()
+        if grad_ampl is not None:
+            grads['ampl'] = grad_ampl
+        grads.update(self.dvals_post_hook_grads(mvals_grad))
+        return grads
+
     def __str__(self):
         return 'solarheat__{0}'.format(self.node)
 
@@ -312,6 +420,8 @@ class SolarHeat(PrecomputedHeatPower):
 
 
 class SolarHeatMulplicative(SolarHeat):
+    linear_pars = ('P_*', 'dP_*', 'bias')
+
     def __init__(self, model, node, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.0334, bias=0.0, epoch='2010:001:12:00:00'):
@@ -321,10 +431,14 @@ class SolarHeatMulplicative(SolarHeat):
             tau=tau, ampl=ampl, bias=bias, epoch=epoch)
 
     def _compute_dvals(self):
-        vf = self.var_func(self.t_days, self.tau)
-        yv = (1.0 + self.ampl*np.cos(self.t_phase))
+        vf = self.get_var_vals()
+        yv = (1.0 + self.ampl*self.cos_phase)
         return ((self.P_vals+self.dP_vals*vf)*yv).reshape(-1)
 
+    def _compute_dvals_grads(self, grad):
+        grad = grad * (1.0 + self.ampl * self.cos_phase)
+        return grad, grad * self.get_var_vals(), None
+
 
 class SolarHeatAcisCameraBody(SolarHeat):
     """Solar heating (pitch and SIM-Z dependent)
@@ -366,6 +480,8 @@ class SolarHeatAcisCameraBody(SolarHeat):
     -------
 
     """
+    linear_pars = SolarHeat.linear_pars + ('dh_heater_bias',)
+
     def __init__(self, model, node, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.05, bias=0.0, epoch='2010:001:12:00:00',
@@ -383,6 +499,9 @@ class SolarHeatAcisCameraBody(SolarHeat):
         """Apply a bias power offset when detector housing heater is on"""
         self._dvals[self.dh_heater_comp.dvals] += self.dh_heater_bias
 
+    def dvals_post_hook_grads(self, mvals_grad):
+        return {'dh_heater_bias': mvals_grad[self.dh_heater_comp.dvals].sum()}
+
 
 class SolarHeatHrc(SolarHeat):
     """Solar heating (pitch and SIM-Z dependent)
@@ -422,6 +541,9 @@ class SolarHeatHrc(SolarHeat):
     -------
 
     """
+    time_cache_attrs = SolarHeat.time_cache_attrs + ('hrc_mask',)
+    linear_pars = SolarHeat.linear_pars + ('hrc_bias',)
+
     def __init__(self, model, node, simz_comp, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.05, bias=0.0, epoch='2010:001:12:00:00',
@@ -438,6 +560,9 @@ class SolarHeatHrc(SolarHeat):
             self.hrc_mask = self.simz_comp.dvals < 0
         self._dvals[self.hrc_mask] += self.hrc_bias
 
+    def dvals_post_hook_grads(self, mvals_grad):
+        return {'hrc_bias': mvals_grad[self.hrc_mask].sum()}
+
 
 class SolarHeatHrcOpts(SolarHeat):
     """Solar heating (pitch and SIM-Z dependent, two parameters for
@@ -480,6 +605,9 @@ class SolarHeatHrcOpts(SolarHeat):
     -------
 
     """
+    time_cache_attrs = SolarHeat.time_cache_attrs + ('hrci_mask', 'hrcs_mask')
+    linear_pars = SolarHeat.linear_pars + ('hrci_bias', 'hrcs_bias')
+
     def __init__(self, model, node, simz_comp, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.05, bias=0.0, epoch='2010:001:12:00:00',
@@ -501,8 +629,14 @@ class SolarHeatHrcOpts(SolarHeat):
             self.hrcs_mask = self.simz_comp.dvals <= -86147
         self._dvals[self.hrcs_mask] += self.hrcs_bias
 
+    def dvals_post_hook_grads(self, mvals_grad):
+        return {'hrci_bias': mvals_grad[self.hrci_mask].sum(),
+                'hrcs_bias': mvals_grad[self.hrcs_mask].sum()}
+
 
 class SolarHeatHrcMult(SolarHeatHrcOpts, SolarHeatMulplicative):
+    linear_pars = SolarHeatMulplicative.linear_pars + ('hrci_bias', 'hrcs_bias')
+
     def __init__(self, model, node, simz_comp, pitch_comp, eclipse_comp=None,
                  P_pitches=None, Ps=None, dPs=None, var_func='exp',
                  tau=1732.0, ampl=0.0334, bias=0.0, epoch='2010:001:12:00:00',
@@ -587,81 +721,126 @@ class EarthHeat(PrecomputedHeatPower):
             _, illums, _ = acis_taco.calc_earth_vis(ephem, q_att)
             self._dvals[i] = illums.sum()
 
+    def get_ephems_q_atts(self):
+        """Get the ephemeris and normalized attitude quaternions at the model
+        times.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        tuple
+            (n_times, 3) ephemeris and (n_times, 4) quaternion arrays
+        """
+        # Collect individual MSIDs for use in calc_earth_vis()
+        ephem_xyzs = [getattr(self, 'orbitephem0_{}'.format(x))
+                      for x in ('x', 'y', 'z')]
+        aoattqt_1234s = [getattr(self, 'aoattqt{}'.format(x))
+                         for x in range(1, 5)]
+        # Note: the copy() here is so that the array becomes contiguous in
+        # memory and allows numba to run faster (and avoids NumbaPerformanceWarning:
+        # np.dot() is faster on contiguous arrays).
+        ephems = np.array([x.dvals for x in ephem_xyzs]).transpose().copy()
+        q_atts = np.array([x.dvals for x in aoattqt_1234s]).transpose()
+
+        # Q_atts can have occasional bad values, maybe because the
+        # Ska eng 5-min "midvals" are not lined up, but I'm not quite sure.
+        # TODO: this (legacy) solution isn't great.  Investigate what's
+        # really happening.
+        q_norm = np.sqrt(np.sum(q_atts ** 2, axis=1))
+        bad = np.abs(q_norm - 1.0) > 0.1
+        if np.any(bad):
+            print(f"Replacing bad midval quaternions with [1,0,0,0] at times "
+                  f"{self.model.times[bad]}")
+            q_atts[bad, :] = [0.0, 0.0, 0.0, 1.0]
+        q_atts[~bad, :] = q_atts[~bad, :] / q_norm[~bad, np.newaxis]
+        return ephems, q_atts
+
     @property
     def dvals(self):
-        if not hasattr(self, '_dvals') and not self.get_cached():
-
-            # Collect individual MSIDs for use in calc_earth_vis()
-            ephem_xyzs = [getattr(self, 'orbitephem0_{}'.format(x))
-                          for x in ('x', 'y', 'z')]
-            aoattqt_1234s = [getattr(self, 'aoattqt{}'.format(x))
-                             for x in range(1, 5)]
-            # Note: the copy() here is so that the array becomes contiguous in
-            # memory and allows numba to run faster (and avoids NumbaPerformanceWarning:
-            # np.dot() is faster on contiguous arrays).
-            ephems = np.array([x.dvals for x in ephem_xyzs]).transpose().copy()
-            q_atts = np.array([x.dvals for x in aoattqt_1234s]).transpose()
-
-            # Q_atts can have occasional bad values, maybe because the
-            # Ska eng 5-min "midvals" are not lined up, but I'm not quite sure.
-            # TODO: this (legacy) solution isn't great.  Investigate what's
-            # really happening.
-            q_norm = np.sqrt(np.sum(q_atts ** 2, axis=1))
-            bad = np.abs(q_norm - 1.0) > 0.1
-            if np.any(bad):
-                print(f"Replacing bad midval quaternions with [1,0,0,0] at times "
-                      f"{self.model.times[bad]}")
-                q_atts[bad, :] = [0.0, 0.0, 0.0, 1.0]
-            q_atts[~bad, :] = q_atts[~bad, :] / q_norm[~bad, np.newaxis]
-
-            # Finally initialize dvals and update in-place appropriately
-            self._dvals = np.empty(self.model.n_times, dtype=float)
-            if self.use_earth_vis_grid:
-                self.calc_earth_vis_from_grid(ephems, q_atts)
-            else:
-                self.calc_earth_vis_from_taco(ephems, q_atts)
-
-            self.put_cache()
+        if not hasattr(self, '_dvals'):
+            ephems, q_atts = self.get_ephems_q_atts()
+            key = self.get_cache_key(ephems, q_atts)
+            if not self.get_cached(key):
+                # Finally initialize dvals and update in-place appropriately
+                self._dvals = np.empty(self.model.n_times, dtype=float)
+                if self.use_earth_vis_grid:
+                    self.calc_earth_vis_from_grid(ephems, q_atts)
+                else:
+                    self.calc_earth_vis_from_taco(ephems, q_atts)
+
+                self.put_cache(key)
 
         return self._dvals
 
-    def put_cache(self):
-        if os.path.exists('esa_cache'):
-            cachefile = 'esa_cache/{}-{}.npz'.format(
-                self.model.datestart, self.model.datestop)
-            np.savez(cachefile, times=self.model.times,
-                     dvals=self.dvals)
+    def get_cache_key(self, ephems, q_atts):
+        """Key of the illumination values in the ``earth_vis`` disk cache
+        (see ``xija.cache``), which is a hash of the model times, ephemeris
+        and attitudes along with the calculation method, the xija version and,
+        for the grid method, the path, modification time and size of the
+        grid file.
 
-    def get_cached(self):
-        """Find a cached version of the Earth solid angle values from
-        file if possible.
+        Parameters
+        ----------
+        ephems :
+            (n_times, 3) ephemeris array
+        q_atts :
+            (n_times, 4) quaternion array
+
+        Returns
+        -------
+        str
+        """
+        from .. import __version__
+
+        method = 'grid' if self.use_earth_vis_grid else 'taco'
+        source = [__version__, method]
+        if self.use_earth_vis_grid:
+            stat = Path(self.earth_vis_grid_path).stat()
+            source += [str(self.earth_vis_grid_path), str(stat.st_mtime_ns),
+                       str(stat.st_size)]
+        return '{}/{}'.format(method, cache.hash_arrays(np.array(source),
+                                                        self.model.times,
+                                                        ephems, q_atts))
+
+    def put_cache(self, key):
+        """Store the illumination values in the ``earth_vis`` disk cache if
+        caching is enabled.
 
         Parameters
         ----------
+        key :
+            cache key from ``get_cache_key()``
 
         Returns
         -------
 
         """
-        dts = {}  # delta times for each matching file
-        filenames = glob.glob('esa_cache/*.npz')
-        for name in filenames:
-            re_date = r'\d\d\d\d:\d\d\d:\d\d:\d\d:\d\d\.\d\d\d'
-            re_cache_file = r'({})-({})'.format(re_date, re_date)
-            m = re.search(re_cache_file, name)
-            if m:
-                f_datestart, f_datestop = m.groups()
-                if (f_datestart <= self.model.datestart and
-                    f_datestop >= self.model.datestop):
-                    dts[name] = DateTime(f_datestop) - DateTime(f_datestart)
-        if dts:
-            cachefile = sorted(dts.items(), key=lambda x: x[1])[0][0]
-            arrays = np.load(cachefile)
-            self._dvals = self.model.interpolate_data(
-                arrays['dvals'], arrays['times'], comp=self)
-            return True
-        else:
+        earth_vis_cache = cache.get_disk_cache('earth_vis')
+        if earth_vis_cache is not None:
+            earth_vis_cache.put(key, {'dvals': self._dvals})
+
+    def get_cached(self, key):
+        """Set the illumination values from the ``earth_vis`` disk cache as a
+        read-only memory map if possible.
+
+        Parameters
+        ----------
+        key :
+            cache key from ``get_cache_key()``
+
+        Returns
+        -------
+        bool
+            True if the values were found in the cache
+        """
+        earth_vis_cache = cache.get_disk_cache('earth_vis')
+        arrays = None if earth_vis_cache is None else earth_vis_cache.get(key)
+        if arrays is None:
             return False
+        self._dvals = np.asarray(arrays['dvals'])
+        return True
 
     def update(self):
         self.mvals = self.k * self.dvals
@@ -706,6 +885,12 @@ class DetectorHousingHeater(TelemData):
 
 class AcisPsmcSolarHeat(PrecomputedHeatPower):
     """Solar heating of PSMC box.  This is dependent on SIM-Z"""
+    time_cache_attrs = (PrecomputedHeatPower.time_cache_attrs
+                        + ('pitches', 'simzs', 'instrs', 't_days', 't_phase',
+                           '_pitch_weights', '_instr_weights', '_cos_phase',
+                           '_var_vals'))
+    linear_pars = ('P_*', 'dP_*', 'ampl', 'dh_heater')
+
     def __init__(self, model, node, pitch_comp, simz_comp, dh_heater_comp, P_pitches=None,
                  P_vals=None, dPs=None, var_func='linear',
                  tau=1732.0, ampl=0.05, epoch='2013:001:12:00:00', dh_heater=0.05):
@@ -761,33 +946,43 @@ class AcisPsmcSolarHeat(PrecomputedHeatPower):
             secs_per_year = (time2010 - time2000) / 10.0
             t_year = (self.pitch_comp.times - time2000) / secs_per_year
             self.t_phase = t_year * 2 * np.pi
+            self._cos_phase = np.cos(self.t_phase)
 
-        # Interpolate power(pitch) for each instrument separately and make 2d
-        # stack
+        # Sparse interpolation weights of the pitch nodes, for the dP values
+        # and for the P values of the instrument in use at each time.  These
+        # are computed once per time grid.
         n_p = len(self.P_pitches)
         n_instr = len(self.instr_names)
-        heats = []
-        dPs = self.parvals[n_instr * n_p:(n_instr + 1) * n_p]
-        dP_vals = Ska.Numpy.interpolate(dPs, self.P_pitches, self.pitches)
-        d_heat = (dP_vals * self.var_func(self.t_days, self.tau)
-                  + self.ampl * np.cos(self.t_phase)).ravel()
-
-        for i in range(n_instr):
-            P_vals = self.parvals[i * n_p:(i + 1) * n_p]
-            heat = Ska.Numpy.interpolate(P_vals, self.P_pitches, self.pitches)
-            heats.append(heat + d_heat)
-
-        self.heats = np.vstack(heats)
-
-        # Now pick out the power(pitch) for the appropriate instrument at each
-        # time
-        self._dvals = self.heats[self.instrs, np.arange(self.heats.shape[1])]
+        if not hasattr(self, '_pitch_weights'):
+            self._pitch_weights = interpolation_weights(self.P_pitches,
+                                                        self.pitches)
+            self._instr_weights = interpolation_weights(
+                self.P_pitches, self.pitches, cols=self.instrs.astype(np.intp) * n_p,
+                n_cols=n_instr * n_p)
+
+        parvals = self.parvals
+        dPs = parvals[n_instr * n_p:(n_instr + 1) * n_p]
+        self._dvals = (self._instr_weights.dot(parvals[:n_instr * n_p])
+                       + self._pitch_weights.dot(dPs) * self.get_var_vals()
+                       + self.ampl * self._cos_phase)
 
         # Increase heat power for times when detector housing heater is enabled
         self._dvals[self.dh_heater_comp.dvals] += self.dh_heater
 
         return self._dvals
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        n_p = len(self.P_pitches)
+        n_instr = len(self.instr_names)
+        parnames = self.parnames
+        grads = dict(zip(parnames[:n_instr * n_p],
+                         self._instr_weights.T.dot(mvals_grad)))
+        grads.update(zip(parnames[n_instr * n_p:(n_instr + 1) * n_p],
+                         self._pitch_weights.T.dot(mvals_grad * self.get_var_vals())))
+        grads['ampl'] = np.dot(mvals_grad, self._cos_phase)
+        grads['dh_heater'] = mvals_grad[self.dh_heater_comp.dvals].sum()
+        return grads
+
     def plot_solar_heat__pitch(self, fig, ax):
         P_vals = {}
         self.instr_names = ['hrcs', 'hrci', 'aciss', 'acisi']
@@ -817,6 +1012,9 @@ class AcisPsmcSolarHeat(PrecomputedHeatPower):
 
 class AcisPsmcPower(PrecomputedHeatPower):
     """Heating from ACIS electronics (ACIS config dependent CCDs, FEPs etc)"""
+    fetch_msids = ('1de28avo', '1deicacu', '1dp28avo', '1dpicacu', '1dp28bvo',
+                   '1dpicbcu')
+
     def __init__(self, model, node, k=1.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -850,6 +1048,8 @@ class AcisPsmcPower(PrecomputedHeatPower):
 
 class AcisDpaPower(PrecomputedHeatPower):
     """Heating from ACIS electronics (ACIS config dependent CCDs, FEPs etc)"""
+    fetch_msids = ('dp_dpa_power',)
+
     def __init__(self, model, node, k=1.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -898,6 +1098,8 @@ class AcisDpaPower(PrecomputedHeatPower):
 
 class AcisDeaPower(PrecomputedHeatPower):
     """Heating from ACIS DEA"""
+    fetch_msids = ('1de28avo', '1deicacu')
+
     def __init__(self, model, node, k=1.0):
         ModelComponent.__init__(self, model)
         self.node = self.model.get_comp(node)
@@ -946,6 +1148,10 @@ class AcisDpaStatePower(PrecomputedHeatPower):
     -------
 
     """
+    time_cache_attrs = PrecomputedHeatPower.time_cache_attrs + ('_par_idxs',)
+    linear_pars = ('pow_*',)
+    fetch_msids = ('dp_dpa_power',)
+
     def __init__(self, model, node, mult=1.0,
                  fep_count=None, ccd_count=None,
                  vid_board=None, clocking=None,
@@ -1037,7 +1243,8 @@ class AcisDpaStatePower(PrecomputedHeatPower):
         -------
 
         """
-        power_parvals = np.array([par.val for par in self.power_pars])
+        # The power parameters are the first ones added in __init__
+        power_parvals = self.parvals[:len(self.power_pars)]
         powers = power_parvals[self.par_idxs]
         self.mvals = self.mult / 100. * (powers - self.bias)
         self.tmal_ints = (tmal.OPCODES['precomputed_heat'],
@@ -1046,6 +1253,12 @@ class AcisDpaStatePower(PrecomputedHeatPower):
                           )
         self.tmal_floats = ()
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        grad_powers = np.bincount(self.par_idxs, weights=mvals_grad,
+                                  minlength=len(self.power_pars))
+        return {par.name: self.mult / 100. * grad
+                for par, grad in zip(self.power_pars, grad_powers)}
+
     def plot_data__time(self, fig, ax):
         powers = self.mvals * 100. / self.mult + self.bias
         lines = ax.get_lines()
@@ -1064,6 +1277,8 @@ class AcisDpaStatePower(PrecomputedHeatPower):
 
 class PropHeater(PrecomputedHeatPower):
     """Proportional heater (P = k * (T_set - T) for T < T_set)."""
+    tmal_float_pars = ('T_set', 'k')
+
     def __init__(self, model, node, node_control=None, k=0.1, T_set=20.0):
         super(PropHeater, self).__init__(model)
         self.node = self.model.get_comp(node)
@@ -1101,6 +1316,8 @@ class PropHeater(PrecomputedHeatPower):
 
 class ThermostatHeater(ActiveHeatPower):
     """Thermostat heater (no deadband): heat = P for T < T_set)."""
+    tmal_float_pars = ('T_set', 'P')
+
     def __init__(self, model, node, node_control=None, P=0.1, T_set=20.0):
         super(ThermostatHeater, self).__init__(model)
         self.node = self.model.get_comp(node)
@@ -1158,6 +1375,8 @@ class StepFunctionPower(PrecomputedHeatPower):
     -------
 
     """
+    linear_pars = ('P',)
+
     def __init__(self, model, node, time, P=0.0, id=''):
         super(StepFunctionPower, self).__init__(model)
         self.time = DateTime(time).secs
@@ -1184,6 +1403,10 @@ class StepFunctionPower(PrecomputedHeatPower):
                           )
         self.tmal_floats = ()
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        idx0 = np.searchsorted(self.model.times, self.time)
+        return {'P': mvals_grad[idx0:].sum()}
+
     def plot_data__time(self, fig, ax):
         lines = ax.get_lines()
         if lines:
@@ -1218,6 +1441,8 @@ class MsidStatePower(PrecomputedHeatPower):
         model.comp['cossrbx_on'].set_data(True)
 
     """
+    linear_pars = ('P',)
+
     def __init__(self, model, node, state_msid, state_val, P=0.0):
         super(MsidStatePower, self).__init__(model)
         self.node = self.model.get_comp(node)
@@ -1230,6 +1455,9 @@ class MsidStatePower(PrecomputedHeatPower):
     def __str__(self):
         return f'{self.state_msid}_{self.state_val_str}'
 
+    def get_fetch_msids(self):
+        return (self.state_msid,) if self.data is None else ()
+
     def get_dvals_tlm(self):
         """
         Return an array of power values where the power is ``P`` when the
@@ -1247,6 +1475,9 @@ class MsidStatePower(PrecomputedHeatPower):
                           )
         self.tmal_floats = ()
 
+    def get_par_grads(self, floats_grad, mvals_grad):
+        return {'P': mvals_grad[self.dvals].sum()}
+
     def plot_data__time(self, fig, ax):
         lines = ax.get_lines()
         if not lines:
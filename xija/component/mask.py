@@ -43,6 +43,14 @@ class Mask(ModelComponent):
     def compute_cache_key(self):
         return self.val
 
+    def reset_time_caches(self):
+        super(Mask, self).reset_time_caches()
+        self.cache_key = None
+
+    def extend_time_caches(self, tail, j0):
+        super(Mask, self).extend_time_caches(tail, j0)
+        self.cache_key = None
+
     def compute_mask(self):
         mask = getattr(operator, self.op)(self.node.dvals, self.val)
         return mask
@@ -1,6 +1,7 @@
 /* Core model integration using TMAL code */
 
 #include "Python.h"
+#include <stdlib.h>
 
 #if PY_MAJOR_VERSION < 3
 void initcore(void)
@@ -11,81 +12,306 @@ void PyInit_core_1(void)
     /* stub initialization function needed by distutils on Windows */
 }
 
-int calc_model_1(int n_times, int n_preds, int n_tmals, double dt, 
-                 double **mvals, int **tmal_ints, double **tmal_floats)
+/* The integrator is written once in DEFINE_CALC_MODEL_1 for ``mvals`` and
+ * ``tmal_floats`` buffers of element type MVAL_T, and defined below as
+ * calc_model_1 (double) and calc_model_1_f (float, which halves the memory
+ * footprint and bandwidth of the buffers).  The node values and derivatives
+ * within a step are always double.
+ *
+ * ``mvals`` is a flat buffer with element (i, j) at
+ * ``mvals[i*comp_stride + j*time_stride]``.  This covers the default layout
+ * with one row per component (comp_stride = row length, time_stride = 1), the
+ * time-major layout (comp_stride = 1, time_stride = n_comps) and integrating
+ * from a later initial time (``mvals`` pointing at that column).
+ */
+#define MVALS(i, j) mvals[(long)(i)*comp_stride + (long)(j)*time_stride]
+
+#define DEFINE_CALC_MODEL_1(NAME, MVAL_T)                                     \
+int NAME(int n_times, int n_preds, int n_tmals, double dt,                    \
+         MVAL_T *mvals, long comp_stride, long time_stride,                   \
+         int **tmal_ints, MVAL_T **tmal_floats)                               \
+{                                                                             \
+    double *deriv, *y;                                                        \
+    double k2, dt2;                                                           \
+    int i, j, j0, i1, i2, i3, rki, opcode;                                    \
+                                                                              \
+    deriv = (double *)malloc(n_preds*sizeof(double));                         \
+    y = (double *)malloc(n_preds*sizeof(double));                             \
+    if (deriv == NULL || y == NULL) {                                         \
+        free(deriv);                                                          \
+        free(y);                                                              \
+        return -1;                                                            \
+    }                                                                         \
+                                                                              \
+    for (j0 = 0; j0 < n_times-2; j0 += 2) {                                   \
+        for (rki = 0; rki < 2; rki++) {                                       \
+            j = (rki == 0) ? j0 : j0 + 1;                                     \
+                                                                              \
+            for (i = 0; i < n_preds; i++) {                                   \
+                y[i] = (rki == 0) ? MVALS(i, j) : y[i] + dt * deriv[i] / 2.0; \
+                deriv[i] = 0.0;                                               \
+            }                                                                 \
+                                                                              \
+            for (i = 0; i < n_tmals; i++) {                                   \
+                opcode = tmal_ints[i][0];                                     \
+                i1 = tmal_ints[i][1];                                         \
+                i2 = tmal_ints[i][2];                                         \
+                                                                              \
+                switch (opcode) {                                             \
+                    case 0:  /* Node to node coupling */                      \
+                        if (i2 < n_preds && i1 < n_preds) {                   \
+                            deriv[i1] = deriv[i1] + (y[i2] - y[i1]) / tmal_floats[i][0]; \
+                        }                                                     \
+                        else {                                                \
+                            deriv[i1] = deriv[i1] + (MVALS(i2, j) - y[i1]) / tmal_floats[i][0]; \
+                        }                                                     \
+                        break;                                                \
+                    case 1:  /* heat sink (coupling to fixed temperature) */  \
+                        if (i1 < n_preds) {                                   \
+                            deriv[i1] = deriv[i1] + (tmal_floats[i][0] - y[i1]) / tmal_floats[i][1]; \
+                        }                                                     \
+                        break;                                                \
+                    case 2:  /* precomputed heat */                           \
+                        if (i1 < n_preds) {                                   \
+                            deriv[i1] = deriv[i1] + MVALS(i2, j);             \
+                        }                                                     \
+                        break;                                                \
+                    case 3: /* active proportional heater */                  \
+                        dt2 =  tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : MVALS(i2, j)); \
+                        i3 = tmal_ints[i][3];                                 \
+                        if (dt2 > 0) {                                        \
+                            MVALS(i3, j) = tmal_floats[i][1] * dt2;           \
+                            if (i1 < n_preds) {                               \
+                                deriv[i1] = deriv[i1] + MVALS(i3, j);         \
+                            }                                                 \
+                        } else {                                              \
+                            MVALS(i3, j) = 0.0;                               \
+                        }                                                     \
+                        break;                                                \
+                    case 4: /* active thermostatic heater */                  \
+                        dt2 =  tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : MVALS(i2, j)); \
+                        i3 = tmal_ints[i][3];                                 \
+                        if (dt2 > 0) {                                        \
+                            MVALS(i3, j) = tmal_floats[i][1];                 \
+                            if (i1 < n_preds) {                               \
+                                deriv[i1] = deriv[i1] + MVALS(i3, j);         \
+                            }                                                 \
+                        } else {                                              \
+                            MVALS(i3, j) = 0.0;                               \
+                        }                                                     \
+                        break;                                                \
+                    }                                                         \
+            }                                                                 \
+        }                                                                     \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k2 = dt * deriv[i];                                               \
+            MVALS(i, j0 + 1) = y[i] + k2 / 2.0;                               \
+            MVALS(i, j0 + 2) = y[i] + k2;                                     \
+        }                                                                     \
+    }                                                                         \
+                                                                              \
+    free(deriv);                                                              \
+    free(y);                                                                  \
+                                                                              \
+    return 0;                                                                 \
+}
+
+DEFINE_CALC_MODEL_1(calc_model_1, double)
+DEFINE_CALC_MODEL_1(calc_model_1_f, float)
+
+/* Integrate an ensemble of ``n_members`` models that share the same TMAL
+ * program with calc_model_1 (``size == sizeof(double)``) or calc_model_1_f
+ * (``size == sizeof(float)``).  See calc_model_2_batch in core_2.c for the
+ * array layout.
+ */
+static int calc_model_1_batch_any(int n_members, int n_times, int n_comps,
+                                  int n_preds, int n_tmals, int n_ints,
+                                  int n_floats, double dt, void *mvals,
+                                  int *tmal_ints, void *tmal_floats,
+                                  size_t size)
 {
-    double deriv[100];  /* n_preds -- learn to malloc! */
-    double y[100];
-    double k2, dt2;
-    int i, j, j0, i1, i2, i3, rki, opcode;    
-
-    for (j0 = 0; j0 < n_times-2; j0 += 2) {
-        for (rki = 0; rki < 2; rki++) {
-            j = (rki == 0) ? j0 : j0 + 1;
-
-            for (i = 0; i < n_preds; i++) {
-                y[i] = (rki == 0) ? mvals[i][j] : y[i] + dt * deriv[i] / 2.0;
-                deriv[i] = 0.0;
-            }
+    int **ints;
+    int i, k, status = 0;
+
+    ints = (int **)malloc(n_tmals*sizeof(int *));
+    if (ints == NULL) return -1;
+    for (i = 0; i < n_tmals; i++) {
+        ints[i] = tmal_ints + (long)i*n_ints;
+    }
+
+#pragma omp parallel for private(i) schedule(dynamic)
+    for (k = 0; k < n_members; k++) {
+        void **floats_k;
+        char *mvals_base = (char *)mvals + (long)k*n_comps*n_times*size;
+        char *floats_base = (char *)tmal_floats + (long)k*n_tmals*n_floats*size;
 
+        floats_k = (void **)malloc(n_tmals*sizeof(void *));
+        if (floats_k == NULL) {
+            status = -1;
+        } else {
             for (i = 0; i < n_tmals; i++) {
-                opcode = tmal_ints[i][0];
-                i1 = tmal_ints[i][1];
-                i2 = tmal_ints[i][2];
-
-                switch (opcode) {
-                    case 0:  /* Node to node coupling */
-                        if (i2 < n_preds && i1 < n_preds) {
-                            deriv[i1] = deriv[i1] + (y[i2] - y[i1]) / tmal_floats[i][0];
-                        }
-                        else {
-                            deriv[i1] = deriv[i1] + (mvals[i2][j] - y[i1]) / tmal_floats[i][0];
-                        }
-                        break;
-                    case 1:  /* heat sink (coupling to fixed temperature) */
-                        if (i1 < n_preds) {
-                            deriv[i1] = deriv[i1] + (tmal_floats[i][0] - y[i1]) / tmal_floats[i][1];
-                        }
-                        break;
-                    case 2:  /* precomputed heat */
-                        if (i1 < n_preds) {
-                            deriv[i1] = deriv[i1] + mvals[i2][j];
-                        }
-                        break;
-                    case 3: /* active proportional heater */
-                        dt2 =  tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals[i2][j]);
-                        i3 = tmal_ints[i][3];
-                        if (dt2 > 0) {
-                            mvals[i3][j] = tmal_floats[i][1] * dt2;
-                            if (i1 < n_preds) {
-                                deriv[i1] = deriv[i1] + mvals[i3][j];
-                            }
-                        } else {
-                            mvals[i3][j] = 0.0;
-                        }
-                        break;
-                    case 4: /* active thermostatic heater */
-                        dt2 =  tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals[i2][j]);
-                        i3 = tmal_ints[i][3];
-                        if (dt2 > 0) {
-                            mvals[i3][j] = tmal_floats[i][1];
-                            if (i1 < n_preds) {
-                                deriv[i1] = deriv[i1] + mvals[i3][j];
-                            }
-                        } else {
-                            mvals[i3][j] = 0.0;
-                        }
-                        break;
-                    }
+                floats_k[i] = floats_base + (long)i*n_floats*size;
+            }
+            if ((size == sizeof(float)
+                 ? calc_model_1_f(n_times, n_preds, n_tmals, dt,
+                                  (float *)mvals_base, n_times, 1, ints,
+                                  (float **)floats_k)
+                 : calc_model_1(n_times, n_preds, n_tmals, dt,
+                                (double *)mvals_base, n_times, 1, ints,
+                                (double **)floats_k)) != 0) {
+                status = -1;
             }
         }
-
-        for (i = 0; i < n_preds; i++) {
-            k2 = dt * deriv[i];
-            mvals[i][j0 + 1] = y[i] + k2 / 2.0;
-            mvals[i][j0 + 2] = y[i] + k2;
-        }
+        free(floats_k);
     }
 
-    return 0;
+    free(ints);
+
+    return status;
 }
+
+int calc_model_1_batch(int n_members, int n_times, int n_comps,
+                       int n_preds, int n_tmals, int n_ints, int n_floats,
+                       double dt, double *mvals, int *tmal_ints,
+                       double *tmal_floats)
+{
+    return calc_model_1_batch_any(n_members, n_times, n_comps, n_preds,
+                                  n_tmals, n_ints, n_floats, dt, mvals,
+                                  tmal_ints, tmal_floats, sizeof(double));
+}
+
+int calc_model_1_batch_f(int n_members, int n_times, int n_comps,
+                         int n_preds, int n_tmals, int n_ints, int n_floats,
+                         double dt, float *mvals, int *tmal_ints,
+                         float *tmal_floats)
+{
+    return calc_model_1_batch_any(n_members, n_times, n_comps, n_preds,
+                                  n_tmals, n_ints, n_floats, dt, mvals,
+                                  tmal_ints, tmal_floats, sizeof(float));
+}
+
+/* Same as calc_model_1 but with the TMAL program compiled into
+ * struct-of-arrays form (see xija.tmal.group_by_opcode).  The statements are
+ * grouped by operation and each group is evaluated in one tight loop without
+ * branching on the opcode.  For group ``g``, ``n_ops[g]`` is the number of
+ * statements and ``op_ints[g]`` / ``op_floats[g]`` hold the integer and float
+ * columns of the group one after the other, each ``n_ops[g]`` long.  Coupling
+ * and heat sink time constants are given as reciprocals.  The group floats
+ * are always double, while ``mvals`` is strided as above with element type
+ * MVAL_T (calc_model_1_soa for double and calc_model_1_soa_f for float).
+ */
+#define SOA_COUPLING 0      /* ints: i1, i2       floats: 1/tau */
+#define SOA_COUPLING_EXT 1  /* ints: i1, i2       floats: 1/tau */
+#define SOA_HEATSINK 2      /* ints: i1           floats: T, 1/tau */
+#define SOA_HEAT 3          /* ints: i1, i2 */
+#define SOA_HEATER 4        /* ints: opcode, i1, i2, i3  floats: T_set, k or P */
+
+#define DEFINE_DTDT_SOA(NAME, MVAL_T)                                         \
+static void NAME(int j, int n_preds, int *n_ops, int **op_ints,               \
+                 double **op_floats, MVAL_T *mvals, long comp_stride,         \
+                 long time_stride, double *deriv, double *y)                  \
+{                                                                             \
+    int k, n, i1, i2, i3;                                                     \
+    int *ints;                                                                \
+    double *floats;                                                           \
+    double dt2;                                                               \
+                                                                              \
+    for (k = 0; k < n_preds; k++) {                                           \
+        deriv[k] = 0.0;                                                       \
+    }                                                                         \
+                                                                              \
+    /* Node to node couplings */                                              \
+    n = n_ops[SOA_COUPLING];                                                  \
+    ints = op_ints[SOA_COUPLING];                                             \
+    floats = op_floats[SOA_COUPLING];                                         \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += (y[ints[n + k]] - y[ints[k]]) * floats[k];          \
+    }                                                                         \
+                                                                              \
+    /* Couplings to nodes that are not predicted (e.g. telemetry) */          \
+    n = n_ops[SOA_COUPLING_EXT];                                              \
+    ints = op_ints[SOA_COUPLING_EXT];                                         \
+    floats = op_floats[SOA_COUPLING_EXT];                                     \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += (MVALS(ints[n + k], j) - y[ints[k]]) * floats[k];   \
+    }                                                                         \
+                                                                              \
+    /* Heat sinks */                                                          \
+    n = n_ops[SOA_HEATSINK];                                                  \
+    ints = op_ints[SOA_HEATSINK];                                             \
+    floats = op_floats[SOA_HEATSINK];                                         \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += (floats[k] - y[ints[k]]) * floats[n + k];           \
+    }                                                                         \
+                                                                              \
+    /* Precomputed heat */                                                    \
+    n = n_ops[SOA_HEAT];                                                      \
+    ints = op_ints[SOA_HEAT];                                                 \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += MVALS(ints[n + k], j);                              \
+    }                                                                         \
+                                                                              \
+    /* Active proportional (opcode 3) and thermostatic (opcode 4) heaters */  \
+    n = n_ops[SOA_HEATER];                                                    \
+    ints = op_ints[SOA_HEATER];                                               \
+    floats = op_floats[SOA_HEATER];                                           \
+    for (k = 0; k < n; k++) {                                                 \
+        i1 = ints[n + k];                                                     \
+        i2 = ints[2*n + k];                                                   \
+        i3 = ints[3*n + k];                                                   \
+        dt2 = floats[k] - ((i2 < n_preds) ? y[i2] : MVALS(i2, j));            \
+        if (dt2 > 0) {                                                        \
+            MVALS(i3, j) = (ints[k] == 3) ? floats[n + k] * dt2 : floats[n + k]; \
+            if (i1 < n_preds) {                                               \
+                deriv[i1] += MVALS(i3, j);                                    \
+            }                                                                 \
+        } else {                                                              \
+            MVALS(i3, j) = 0.0;                                               \
+        }                                                                     \
+    }                                                                         \
+}
+
+#define DEFINE_CALC_MODEL_1_SOA(NAME, DTDT, MVAL_T)                           \
+int NAME(int n_times, int n_preds, double dt, MVAL_T *mvals,                  \
+         long comp_stride, long time_stride, int *n_ops, int **op_ints,       \
+         double **op_floats)                                                  \
+{                                                                             \
+    double *work, *deriv, *y;                                                 \
+    double k2;                                                                \
+    int i, j0;                                                                \
+                                                                              \
+    work = (double *)malloc(2*n_preds*sizeof(double));                        \
+    if (work == NULL) return -1;                                              \
+    deriv = work;                                                             \
+    y = work + n_preds;                                                       \
+                                                                              \
+    for (j0 = 0; j0 < n_times-2; j0 += 2) {                                   \
+        for (i = 0; i < n_preds; i++) {                                       \
+            y[i] = MVALS(i, j0);                                              \
+        }                                                                     \
+        DTDT(j0, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,      \
+             time_stride, deriv, y);                                          \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            y[i] = y[i] + dt * deriv[i] / 2.0;                                \
+        }                                                                     \
+        DTDT(j0 + 1, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,  \
+             time_stride, deriv, y);                                          \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k2 = dt * deriv[i];                                               \
+            MVALS(i, j0 + 1) = y[i] + k2 / 2.0;                               \
+            MVALS(i, j0 + 2) = y[i] + k2;                                     \
+        }                                                                     \
+    }                                                                         \
+                                                                              \
+    free(work);                                                               \
+                                                                              \
+    return 0;                                                                 \
+}
+
+DEFINE_DTDT_SOA(dTdt_soa, double)
+DEFINE_DTDT_SOA(dTdt_soa_f, float)
+DEFINE_CALC_MODEL_1_SOA(calc_model_1_soa, dTdt_soa, double)
+DEFINE_CALC_MODEL_1_SOA(calc_model_1_soa_f, dTdt_soa_f, float)
@@ -1,6 +1,7 @@
 /* Core model integration using TMAL code */
 
 #include "Python.h"
+#include <stdlib.h>
 
 #if PY_MAJOR_VERSION < 3
 void initcore(void)
@@ -11,172 +12,446 @@ void PyInit_core_2(void)
     /* stub initialization function needed by distutils on Windows */
 }
 
-void dTdt(int j, int half, int n_preds, int n_tmals, int **tmal_ints, 
-          double **tmal_floats, double **mvals, double *deriv, double *y)
-{
-    int i, i1, i2, i3, opcode;
-    double dt2, mvals_i2, mvals_i3;
-    
-    for (i = 0; i < n_preds; i++) {
-        deriv[i] = 0.0;
-    }
+/* The derivative and the integrator are written once in DEFINE_DTDT and
+ * DEFINE_CALC_MODEL_2 for ``mvals`` and ``tmal_floats`` buffers of element
+ * type MVAL_T, and defined below as dTdt / calc_model_2 (double) and
+ * dTdt_f / calc_model_2_f (float, which halves the memory footprint and
+ * bandwidth of the buffers).  The node values and derivatives within a step
+ * are always double.
+ *
+ * ``mvals`` is a flat buffer with element (i, j) at
+ * ``mvals[i*comp_stride + j*time_stride]``.  This covers the default layout
+ * with one row per component (comp_stride = row length, time_stride = 1), the
+ * time-major layout (comp_stride = 1, time_stride = n_comps) and integrating
+ * from a later initial time (``mvals`` pointing at that column).
+ */
+#define MVALS(i, j) mvals[(long)(i)*comp_stride + (long)(j)*time_stride]
 
-    for (i = 0; i < n_tmals; i++) {
-        opcode = tmal_ints[i][0];
-        i1 = tmal_ints[i][1];
-        i2 = tmal_ints[i][2];
-    
-        /* Check to see if we are at the half-step, if so, interpolate */
-        
-        if (half == 0) {
-            mvals_i2 = mvals[i2][j];
-        } else {
-            mvals_i2 = 0.5*(mvals[i2][j]+mvals[i2][j+1]);
-        }
- 
-        switch (opcode) {
-            case 0:  /* Node to node coupling */
-                if (i2 < n_preds && i1 < n_preds) {
-                    deriv[i1] += (y[i2] - y[i1]) / tmal_floats[i][0];
-                }
-                else {
-                    deriv[i1] += (mvals_i2 - y[i1]) / tmal_floats[i][0];
-                }
-                break;
-            case 1:  /* heat sink (coupling to fixed temperature) */
-                if (i1 < n_preds) {
-                    deriv[i1] += (tmal_floats[i][0] - y[i1]) / tmal_floats[i][1];
-                }
-                break;
-            case 2:  /* precomputed heat */
-                if (i1 < n_preds) {
-                    deriv[i1] += mvals_i2;
-                }
-                break;
-            case 3: /* active proportional heater */
-                dt2 = tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals_i2);
-                i3 = tmal_ints[i][3];
-                if (dt2 > 0) {
-                    mvals_i3 = tmal_floats[i][1] * dt2;
-                    if (i1 < n_preds) {
-                        deriv[i1] += mvals_i3;
-                    }
-                } else {
-                    mvals_i3 = 0.0;
-                }
-                if (half == 0) mvals[i3][j] = mvals_i3;
-                break;
-            case 4: /* active thermostatic heater */
-                dt2 = tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals_i2);
-                i3 = tmal_ints[i][3];
-                if (dt2 > 0) {
-                    mvals_i3 = tmal_floats[i][1];
-                    if (i1 < n_preds) {
-                        deriv[i1] += mvals_i3;
-                    }
-                } else {
-                    mvals_i3 = 0.0;
-                }
-                if (half == 0) mvals[i3][j] = mvals_i3;
-                break;
-        }
-    }
+#define DEFINE_DTDT(NAME, MVAL_T)                                             \
+static void NAME(int j, int half, int n_preds, int n_tmals, int **tmal_ints,  \
+                 MVAL_T **tmal_floats, MVAL_T *mvals, long comp_stride,       \
+                 long time_stride, double *deriv, double *y)                  \
+{                                                                             \
+    int i, i1, i2, i3, opcode;                                                \
+    double dt2, mvals_i2, mvals_i3;                                           \
+                                                                              \
+    for (i = 0; i < n_preds; i++) {                                           \
+        deriv[i] = 0.0;                                                       \
+    }                                                                         \
+                                                                              \
+    for (i = 0; i < n_tmals; i++) {                                           \
+        opcode = tmal_ints[i][0];                                             \
+        i1 = tmal_ints[i][1];                                                 \
+        i2 = tmal_ints[i][2];                                                 \
+                                                                              \
+        /* Check to see if we are at the half-step, if so, interpolate */     \
+                                                                              \
+        if (half == 0) {                                                      \
+            mvals_i2 = MVALS(i2, j);                                          \
+        } else {                                                              \
+            mvals_i2 = 0.5*(MVALS(i2, j) + MVALS(i2, j+1));                   \
+        }                                                                     \
+                                                                              \
+        switch (opcode) {                                                     \
+            case 0:  /* Node to node coupling */                              \
+                if (i2 < n_preds && i1 < n_preds) {                           \
+                    deriv[i1] += (y[i2] - y[i1]) / tmal_floats[i][0];         \
+                }                                                             \
+                else {                                                        \
+                    deriv[i1] += (mvals_i2 - y[i1]) / tmal_floats[i][0];      \
+                }                                                             \
+                break;                                                        \
+            case 1:  /* heat sink (coupling to fixed temperature) */          \
+                if (i1 < n_preds) {                                           \
+                    deriv[i1] += (tmal_floats[i][0] - y[i1]) / tmal_floats[i][1]; \
+                }                                                             \
+                break;                                                        \
+            case 2:  /* precomputed heat */                                   \
+                if (i1 < n_preds) {                                           \
+                    deriv[i1] += mvals_i2;                                    \
+                }                                                             \
+                break;                                                        \
+            case 3: /* active proportional heater */                          \
+                dt2 = tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals_i2); \
+                i3 = tmal_ints[i][3];                                         \
+                if (dt2 > 0) {                                                \
+                    mvals_i3 = tmal_floats[i][1] * dt2;                       \
+                    if (i1 < n_preds) {                                       \
+                        deriv[i1] += mvals_i3;                                \
+                    }                                                         \
+                } else {                                                      \
+                    mvals_i3 = 0.0;                                           \
+                }                                                             \
+                if (half == 0) MVALS(i3, j) = mvals_i3;                       \
+                break;                                                        \
+            case 4: /* active thermostatic heater */                          \
+                dt2 = tmal_floats[i][0] - ((i2 < n_preds) ? y[i2] : mvals_i2); \
+                i3 = tmal_ints[i][3];                                         \
+                if (dt2 > 0) {                                                \
+                    mvals_i3 = tmal_floats[i][1];                             \
+                    if (i1 < n_preds) {                                       \
+                        deriv[i1] += mvals_i3;                                \
+                    }                                                         \
+                } else {                                                      \
+                    mvals_i3 = 0.0;                                           \
+                }                                                             \
+                if (half == 0) MVALS(i3, j) = mvals_i3;                       \
+                break;                                                        \
+        }                                                                     \
+    }                                                                         \
+}
 
+#define DEFINE_CALC_MODEL_2(NAME, DTDT, MVAL_T)                               \
+int NAME(int rk4, int n_times, int n_preds, int n_tmals, double dt,           \
+         MVAL_T *mvals, long comp_stride, long time_stride,                   \
+         int **tmal_ints, MVAL_T **tmal_floats)                               \
+{                                                                             \
+    double *work, *y, *yh, *deriv, *k1, *k2, *k3, *k4;                        \
+    int i, j;                                                                 \
+    double one_sixth = 1.0/6.0;                                               \
+                                                                              \
+    /* Allocate arrays we need */                                             \
+                                                                              \
+    work = (double *)malloc(7*(size_t)n_preds*sizeof(double));                \
+    if (work == NULL) return -1;                                              \
+    deriv = work;                                                             \
+    y = deriv + n_preds;                                                      \
+    yh = y + n_preds;                                                         \
+    k1 = yh + n_preds;                                                        \
+    k2 = k1 + n_preds;                                                        \
+    k3 = k2 + n_preds;                                                        \
+    k4 = k3 + n_preds;                                                        \
+                                                                              \
+    for (j = 0; j < n_times-1; j++) {                                         \
+                                                                              \
+        /* Initialize the y-array at the current step */                      \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            y[i] = MVALS(i, j);                                               \
+        }                                                                     \
+                                                                              \
+        /* Compute the derivative at the current step */                      \
+                                                                              \
+        DTDT(j, 0, n_preds, n_tmals, tmal_ints, tmal_floats, mvals,           \
+             comp_stride, time_stride, deriv, y);                             \
+                                                                              \
+        /* Advance a half-step */                                             \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k1[i] = dt * deriv[i];                                            \
+            yh[i] = y[i] + 0.5*k1[i];                                         \
+        }                                                                     \
+                                                                              \
+        /* Compute the derivative in the middle of the step interval */       \
+                                                                              \
+        DTDT(j, 1, n_preds, n_tmals, tmal_ints, tmal_floats, mvals,           \
+             comp_stride, time_stride, deriv, yh);                            \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k2[i] = dt * deriv[i];                                            \
+        }                                                                     \
+                                                                              \
+        /* If we're doing RK2, evaluate the temperature at the full step and  \
+         * move on to the next step. Otherwise, continue on to RK4 */         \
+                                                                              \
+        if (rk4 == 0) {                                                       \
+            for (i = 0; i < n_preds; i++) {                                   \
+                MVALS(i, j+1) = y[i] + k2[i];                                 \
+            }                                                                 \
+            continue;                                                         \
+        }                                                                     \
+                                                                              \
+        /* Second advancement to the half-step */                             \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            yh[i] = y[i] + 0.5*k2[i];                                         \
+        }                                                                     \
+                                                                              \
+        /* Evaluate the derivative at the half-step again */                  \
+                                                                              \
+        DTDT(j, 1, n_preds, n_tmals, tmal_ints, tmal_floats, mvals,           \
+             comp_stride, time_stride, deriv, yh);                            \
+                                                                              \
+        /* Advance the full step */                                           \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k3[i] = dt * deriv[i];                                            \
+            yh[i] = y[i] + k3[i];                                             \
+        }                                                                     \
+                                                                              \
+        /* Compute the derivative at the full step */                         \
+                                                                              \
+        DTDT(j+1, 0, n_preds, n_tmals, tmal_ints, tmal_floats, mvals,         \
+             comp_stride, time_stride, deriv, yh);                            \
+                                                                              \
+        /* Compute the full solution at the full step using RK4 */            \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k4[i] = dt * deriv[i];                                            \
+            MVALS(i, j+1) = y[i] + one_sixth*(k1[i]+2.0*(k2[i]+k3[i])+k4[i]); \
+        }                                                                     \
+                                                                              \
+    }                                                                         \
+                                                                              \
+    free(work);                                                               \
+                                                                              \
+    return 0;                                                                 \
 }
 
-int calc_model_2(int rk4, int n_times, int n_preds, int n_tmals, double dt, 
-                 double **mvals, int **tmal_ints, double **tmal_floats)
-{
-    double *y, *yh, *deriv, *k1, *k2, *k3, *k4;
-    int i, j;    
-    double one_sixth = 1.0/6.0;
-    
-    /* Allocate arrays we need */
-    
-    deriv = (double *)malloc(n_preds*sizeof(double));
-    y = (double *)malloc(n_preds*sizeof(double));
-    yh = (double *)malloc(n_preds*sizeof(double));
-    k1 = (double *)malloc(n_preds*sizeof(double));
-    k2 = (double *)malloc(n_preds*sizeof(double));
-    k3 = (double *)malloc(n_preds*sizeof(double));
-    k4 = (double *)malloc(n_preds*sizeof(double));
-
-    for (j = 0; j < n_times-1; j++) {
-        
-        /* Initialize the y-array at the current step */
-        
-        for (i = 0; i < n_preds; i++) {
-            y[i] = mvals[i][j];
-        }
+DEFINE_DTDT(dTdt, double)
+DEFINE_DTDT(dTdt_f, float)
+DEFINE_CALC_MODEL_2(calc_model_2, dTdt, double)
+DEFINE_CALC_MODEL_2(calc_model_2_f, dTdt_f, float)
 
-        /* Compute the derivative at the current step */
-        
-        dTdt(j, 0, n_preds, n_tmals, tmal_ints, tmal_floats, mvals, deriv, y);
-        
-        /* Advance a half-step */
-        
-        for (i = 0; i < n_preds; i++) {
-            k1[i] = dt * deriv[i];
-            yh[i] = y[i] + 0.5*k1[i];
-        }
+/* Integrate an ensemble of ``n_members`` models that share the same TMAL
+ * program (tmal_ints) but have their own mvals and tmal_floats with
+ * calc_model_2 (``size == sizeof(double)``) or calc_model_2_f
+ * (``size == sizeof(float)``).  The arrays are passed as flat C-contiguous
+ * buffers:
+ *
+ *   mvals:       n_members x n_comps x n_times
+ *   tmal_ints:   n_tmals x n_ints
+ *   tmal_floats: n_members x n_tmals x n_floats
+ *
+ * Members are independent so the loop over members is done in parallel when
+ * compiled with OpenMP support.
+ */
+static int calc_model_2_batch_any(int rk4, int n_members, int n_times,
+                                  int n_comps, int n_preds, int n_tmals,
+                                  int n_ints, int n_floats, double dt,
+                                  void *mvals, int *tmal_ints,
+                                  void *tmal_floats, size_t size)
+{
+    int **ints;
+    int i, k, status = 0;
 
-        /* Compute the derivative in the middle of the step interval */
-        
-        dTdt(j, 1, n_preds, n_tmals, tmal_ints, tmal_floats, mvals, deriv, yh);
+    ints = (int **)malloc(n_tmals*sizeof(int *));
+    if (ints == NULL) return -1;
+    for (i = 0; i < n_tmals; i++) {
+        ints[i] = tmal_ints + (long)i*n_ints;
+    }
 
-        for (i = 0; i < n_preds; i++) {
-            k2[i] = dt * deriv[i];
-        }
+#pragma omp parallel for private(i) schedule(dynamic)
+    for (k = 0; k < n_members; k++) {
+        void **floats_k;
+        char *mvals_base = (char *)mvals + (long)k*n_comps*n_times*size;
+        char *floats_base = (char *)tmal_floats + (long)k*n_tmals*n_floats*size;
 
-        /* If we're doing RK2, evaluate the temperature at the full step and
-         * move on to the next step. Otherwise, continue on to RK4 */
-        
-        if (rk4 == 0) {
-            for (i = 0; i < n_preds; i++) {
-                mvals[i][j+1] = y[i] + k2[i];
+        floats_k = (void **)malloc(n_tmals*sizeof(void *));
+        if (floats_k == NULL) {
+            status = -1;
+        } else {
+            for (i = 0; i < n_tmals; i++) {
+                floats_k[i] = floats_base + (long)i*n_floats*size;
+            }
+            if ((size == sizeof(float)
+                 ? calc_model_2_f(rk4, n_times, n_preds, n_tmals, dt,
+                                  (float *)mvals_base, n_times, 1, ints,
+                                  (float **)floats_k)
+                 : calc_model_2(rk4, n_times, n_preds, n_tmals, dt,
+                                (double *)mvals_base, n_times, 1, ints,
+                                (double **)floats_k)) != 0) {
+                status = -1;
             }
-            continue;
-        }
-        
-        /* Second advancement to the half-step */
-        
-        for (i = 0; i < n_preds; i++) {
-            yh[i] = y[i] + 0.5*k2[i];
         }
+        free(floats_k);
+    }
 
-        /* Evaluate the derivative at the half-step again */
-
-        dTdt(j, 1, n_preds, n_tmals, tmal_ints, tmal_floats, mvals, deriv, yh);
-
-        /* Advance the full step */
+    free(ints);
 
-        for (i = 0; i < n_preds; i++) {
-            k3[i] = dt * deriv[i];
-            yh[i] = y[i] + k3[i];
-        }
+    return status;
+}
 
-        /* Compute the derivative at the full step */
+int calc_model_2_batch(int rk4, int n_members, int n_times, int n_comps,
+                       int n_preds, int n_tmals, int n_ints, int n_floats,
+                       double dt, double *mvals, int *tmal_ints,
+                       double *tmal_floats)
+{
+    return calc_model_2_batch_any(rk4, n_members, n_times, n_comps, n_preds,
+                                  n_tmals, n_ints, n_floats, dt, mvals,
+                                  tmal_ints, tmal_floats, sizeof(double));
+}
 
-        dTdt(j+1, 0, n_preds, n_tmals, tmal_ints, tmal_floats, mvals, deriv, yh);
+int calc_model_2_batch_f(int rk4, int n_members, int n_times, int n_comps,
+                         int n_preds, int n_tmals, int n_ints, int n_floats,
+                         double dt, float *mvals, int *tmal_ints,
+                         float *tmal_floats)
+{
+    return calc_model_2_batch_any(rk4, n_members, n_times, n_comps, n_preds,
+                                  n_tmals, n_ints, n_floats, dt, mvals,
+                                  tmal_ints, tmal_floats, sizeof(float));
+}
 
-        /* Compute the full solution at the full step using RK4 */
-        
-        for (i = 0; i < n_preds; i++) {
-            k4[i] = dt * deriv[i];
-            mvals[i][j+1] = y[i] + one_sixth*(k1[i]+2.0*(k2[i]+k3[i])+k4[i]);
-        }
+/* Same as dTdt and calc_model_2 but with the TMAL program compiled into
+ * struct-of-arrays form (see xija.tmal.group_by_opcode).  The statements are
+ * grouped by operation and each group is evaluated in one tight loop without
+ * branching on the opcode.  For group ``g``, ``n_ops[g]`` is the number of
+ * statements and ``op_ints[g]`` / ``op_floats[g]`` hold the integer and float
+ * columns of the group one after the other, each ``n_ops[g]`` long.  Coupling
+ * and heat sink time constants are given as reciprocals.  The group floats
+ * are always double, while ``mvals`` is strided as above with element type
+ * MVAL_T (calc_model_2_soa for double and calc_model_2_soa_f for float).
+ */
+#define SOA_COUPLING 0      /* ints: i1, i2       floats: 1/tau */
+#define SOA_COUPLING_EXT 1  /* ints: i1, i2       floats: 1/tau */
+#define SOA_HEATSINK 2      /* ints: i1           floats: T, 1/tau */
+#define SOA_HEAT 3          /* ints: i1, i2 */
+#define SOA_HEATER 4        /* ints: opcode, i1, i2, i3  floats: T_set, k or P */
 
-    }
+#define DEFINE_DTDT_SOA(NAME, MVAL_T)                                         \
+static void NAME(int j, int half, int n_preds, int *n_ops, int **op_ints,     \
+                 double **op_floats, MVAL_T *mvals, long comp_stride,         \
+                 long time_stride, double *deriv, double *y)                  \
+{                                                                             \
+    int k, n, i1, i2, i3;                                                     \
+    int *ints;                                                                \
+    double *floats;                                                           \
+    double dt2, mvals_i2, mvals_i3;                                           \
+                                                                              \
+    for (k = 0; k < n_preds; k++) {                                           \
+        deriv[k] = 0.0;                                                       \
+    }                                                                         \
+                                                                              \
+    /* Node to node couplings */                                              \
+    n = n_ops[SOA_COUPLING];                                                  \
+    ints = op_ints[SOA_COUPLING];                                             \
+    floats = op_floats[SOA_COUPLING];                                         \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += (y[ints[n + k]] - y[ints[k]]) * floats[k];          \
+    }                                                                         \
+                                                                              \
+    /* Couplings to nodes that are not predicted (e.g. telemetry) */          \
+    n = n_ops[SOA_COUPLING_EXT];                                              \
+    ints = op_ints[SOA_COUPLING_EXT];                                         \
+    floats = op_floats[SOA_COUPLING_EXT];                                     \
+    if (half == 0) {                                                          \
+        for (k = 0; k < n; k++) {                                             \
+            deriv[ints[k]] += (MVALS(ints[n + k], j) - y[ints[k]]) * floats[k]; \
+        }                                                                     \
+    } else {                                                                  \
+        for (k = 0; k < n; k++) {                                             \
+            mvals_i2 = 0.5*(MVALS(ints[n + k], j) + MVALS(ints[n + k], j+1)); \
+            deriv[ints[k]] += (mvals_i2 - y[ints[k]]) * floats[k];            \
+        }                                                                     \
+    }                                                                         \
+                                                                              \
+    /* Heat sinks */                                                          \
+    n = n_ops[SOA_HEATSINK];                                                  \
+    ints = op_ints[SOA_HEATSINK];                                             \
+    floats = op_floats[SOA_HEATSINK];                                         \
+    for (k = 0; k < n; k++) {                                                 \
+        deriv[ints[k]] += (floats[k] - y[ints[k]]) * floats[n + k];           \
+    }                                                                         \
+                                                                              \
+    /* Precomputed heat */                                                    \
+    n = n_ops[SOA_HEAT];                                                      \
+    ints = op_ints[SOA_HEAT];                                                 \
+    if (half == 0) {                                                          \
+        for (k = 0; k < n; k++) {                                             \
+            deriv[ints[k]] += MVALS(ints[n + k], j);                          \
+        }                                                                     \
+    } else {                                                                  \
+        for (k = 0; k < n; k++) {                                             \
+            deriv[ints[k]] += 0.5*(MVALS(ints[n + k], j) + MVALS(ints[n + k], j+1)); \
+        }                                                                     \
+    }                                                                         \
+                                                                              \
+    /* Active proportional (opcode 3) and thermostatic (opcode 4) heaters */  \
+    n = n_ops[SOA_HEATER];                                                    \
+    ints = op_ints[SOA_HEATER];                                               \
+    floats = op_floats[SOA_HEATER];                                           \
+    for (k = 0; k < n; k++) {                                                 \
+        i1 = ints[n + k];                                                     \
+        i2 = ints[2*n + k];                                                   \
+        i3 = ints[3*n + k];                                                   \
+        if (i2 < n_preds) {                                                   \
+            mvals_i2 = y[i2];                                                 \
+        } else if (half == 0) {                                               \
+            mvals_i2 = MVALS(i2, j);                                          \
+        } else {                                                              \
+            mvals_i2 = 0.5*(MVALS(i2, j) + MVALS(i2, j+1));                   \
+        }                                                                     \
+        dt2 = floats[k] - mvals_i2;                                           \
+        if (dt2 > 0) {                                                        \
+            mvals_i3 = (ints[k] == 3) ? floats[n + k] * dt2 : floats[n + k];  \
+            if (i1 < n_preds) {                                               \
+                deriv[i1] += mvals_i3;                                        \
+            }                                                                 \
+        } else {                                                              \
+            mvals_i3 = 0.0;                                                   \
+        }                                                                     \
+        if (half == 0) MVALS(i3, j) = mvals_i3;                               \
+    }                                                                         \
+}
 
-    /* Free memory */
-    
-    free(y);
-    free(yh);
-    free(deriv);
-    free(k1);
-    free(k2);
-    free(k3);
-    free(k4);
-
-    return 0;
+#define DEFINE_CALC_MODEL_2_SOA(NAME, DTDT, MVAL_T)                           \
+int NAME(int rk4, int n_times, int n_preds, double dt, MVAL_T *mvals,         \
+         long comp_stride, long time_stride, int *n_ops, int **op_ints,       \
+         double **op_floats)                                                  \
+{                                                                             \
+    double *work, *y, *yh, *deriv, *k1, *k2, *k3, *k4;                        \
+    int i, j;                                                                 \
+    double one_sixth = 1.0/6.0;                                               \
+                                                                              \
+    work = (double *)malloc(7*n_preds*sizeof(double));                        \
+    if (work == NULL) return -1;                                              \
+    deriv = work;                                                             \
+    y = work + n_preds;                                                       \
+    yh = work + 2*n_preds;                                                    \
+    k1 = work + 3*n_preds;                                                    \
+    k2 = work + 4*n_preds;                                                    \
+    k3 = work + 5*n_preds;                                                    \
+    k4 = work + 6*n_preds;                                                    \
+                                                                              \
+    for (j = 0; j < n_times-1; j++) {                                         \
+        for (i = 0; i < n_preds; i++) {                                       \
+            y[i] = MVALS(i, j);                                               \
+        }                                                                     \
+                                                                              \
+        DTDT(j, 0, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,    \
+             time_stride, deriv, y);                                          \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k1[i] = dt * deriv[i];                                            \
+            yh[i] = y[i] + 0.5*k1[i];                                         \
+        }                                                                     \
+                                                                              \
+        DTDT(j, 1, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,    \
+             time_stride, deriv, yh);                                         \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k2[i] = dt * deriv[i];                                            \
+        }                                                                     \
+                                                                              \
+        if (rk4 == 0) {                                                       \
+            for (i = 0; i < n_preds; i++) {                                   \
+                MVALS(i, j+1) = y[i] + k2[i];                                 \
+            }                                                                 \
+            continue;                                                         \
+        }                                                                     \
+                                                                              \
+        for (i = 0; i < n_preds; i++) {                                       \
+            yh[i] = y[i] + 0.5*k2[i];                                         \
+        }                                                                     \
+        DTDT(j, 1, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,    \
+             time_stride, deriv, yh);                                         \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k3[i] = dt * deriv[i];                                            \
+            yh[i] = y[i] + k3[i];                                             \
+        }                                                                     \
+                                                                              \
+        DTDT(j+1, 0, n_preds, n_ops, op_ints, op_floats, mvals, comp_stride,  \
+             time_stride, deriv, yh);                                         \
+        for (i = 0; i < n_preds; i++) {                                       \
+            k4[i] = dt * deriv[i];                                            \
+            MVALS(i, j+1) = y[i] + one_sixth*(k1[i]+2.0*(k2[i]+k3[i])+k4[i]); \
+        }                                                                     \
+    }                                                                         \
+                                                                              \
+    free(work);                                                               \
+                                                                              \
+    return 0;                                                                 \
 }
+
+DEFINE_DTDT_SOA(dTdt_soa, double)
+DEFINE_DTDT_SOA(dTdt_soa_f, float)
+DEFINE_CALC_MODEL_2_SOA(calc_model_2_soa, dTdt_soa, double)
+DEFINE_CALC_MODEL_2_SOA(calc_model_2_soa_f, dTdt_soa_f, float)
@@ -0,0 +1,203 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+L-stable implicit integrator (TR-BDF2) for stiff models.
+
+The explicit RK solvers in the C cores are only stable when ``dt`` is small
+compared to the shortest time constant of the network.  TR-BDF2 takes each
+step as a trapezoidal stage to ``t + gamma * dt`` followed by a BDF2 stage to
+``t + dt`` with ``gamma = 2 - sqrt(2)``.  It is second order, L-stable and
+both stages share the same implicit matrix ``I - d * dt * A`` with
+``d = gamma / 2``, so a single inverse serves every simplified Newton
+iteration.  ``A`` is the Jacobian of the linear network (heaters off) from
+``xija.linear.LinearSystem``; the heater terms are handled by the Newton
+iteration itself.
+"""
+import logging
+
+import numpy as np
+from numba import njit
+
+from .linear import LinearSystem
+from .numba_core import dTdt
+
+__all__ = ['ImplicitKernel', 'GAMMA']
+
+logger = logging.getLogger('xija')
+
+GAMMA = 2.0 - np.sqrt(2.0)
+
+
+@njit(cache=True)
+def _newton(j, w, h, n_preds, tmal_ints, tmal_floats, mvals, M, rhs, y,
+            deriv, tol, max_iter):
+    """Solve ``y - h * f(y, w) = rhs`` in place with simplified Newton
+    iterations using ``M = inv(I - h * A)``.  Return True if converged."""
+    resid = np.zeros(n_preds)
+    for _ in range(max_iter):
+        dTdt(j, w, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            resid[i] = y[i] - h * deriv[i] - rhs[i]
+        max_delta = 0.0
+        for i in range(n_preds):
+            delta = 0.0
+            for k in range(n_preds):
+                delta += M[i, k] * resid[k]
+            y[i] -= delta
+            if abs(delta) > max_delta:
+                max_delta = abs(delta)
+        if max_delta < tol:
+            return True
+    return False
+
+
+@njit(cache=True)
+def calc_model_trbdf2(n_times, n_preds, dt, tmal_ints, tmal_floats, mvals, M,
+                      tol, max_iter):
+    """Integrate the model with TR-BDF2.
+
+    Parameters
+    ----------
+    n_times :
+        number of mvals columns
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+    dt :
+        time step (ksec)
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    mvals :
+        model mvals array, updated in place
+    M :
+        inverse of ``I - GAMMA / 2 * dt * A``
+    tol :
+        Newton convergence tolerance (degC)
+    max_iter :
+        maximum Newton iterations per stage
+
+    Returns
+    -------
+    int
+        number of stages where the Newton iteration did not converge
+    """
+    gamma = 2.0 - np.sqrt(2.0)
+    h = gamma / 2.0 * dt
+    c_g = 1.0 / (gamma * (2.0 - gamma))
+    c_n = (1.0 - gamma) ** 2 / (gamma * (2.0 - gamma))
+
+    y0 = np.zeros(n_preds)
+    yg = np.zeros(n_preds)
+    y1 = np.zeros(n_preds)
+    f0 = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    rhs = np.zeros(n_preds)
+    n_fail = 0
+
+    for j in range(n_times - 1):
+        for i in range(n_preds):
+            y0[i] = mvals[i, j]
+        dTdt(j, 0.0, True, n_preds, tmal_ints, tmal_floats, mvals, f0, y0)
+
+        # Trapezoidal stage to t + gamma * dt
+        for i in range(n_preds):
+            rhs[i] = y0[i] + h * f0[i]
+            yg[i] = y0[i] + gamma * dt * f0[i]
+        if not _newton(j, gamma, h, n_preds, tmal_ints, tmal_floats, mvals,
+                       M, rhs, yg, deriv, tol, max_iter):
+            n_fail += 1
+
+        # BDF2 stage to t + dt
+        for i in range(n_preds):
+            rhs[i] = c_g * yg[i] - c_n * y0[i]
+            y1[i] = y0[i] + (yg[i] - y0[i]) / gamma
+        if not _newton(j, 1.0, h, n_preds, tmal_ints, tmal_floats, mvals,
+                       M, rhs, y1, deriv, tol, max_iter):
+            n_fail += 1
+
+        for i in range(n_preds):
+            mvals[i, j + 1] = y1[i]
+
+    return n_fail
+
+
+class ImplicitKernel(object):
+    """Prepared handle for integrating a model with the L-stable TR-BDF2
+    implicit solver (``evolve_method = 4``).
+
+    This remains stable for any ``dt`` so stiff models (short coupling or heat
+    sink time constants) can run at the default 328 sec grid.  When the
+    network time constants change the kernel logs which of the explicit
+    methods would have been unstable at the model ``dt``.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+    tol :
+        Newton convergence tolerance (degC, default=1e-8)
+    max_iter :
+        maximum Newton iterations per stage (default=10)
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (4,)
+
+    def __init__(self, model, tol=1e-8, max_iter=10):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints
+        self.tmal_floats = model.tmal_floats
+        self.tol = tol
+        self.max_iter = max_iter
+        self._matrix_key = None
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers are still the ones used by the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_ints is model.tmal_ints
+                and self.tmal_floats is model.tmal_floats)
+
+    def get_matrix(self, system):
+        key = system.A.tobytes()
+        if key != self._matrix_key:
+            dt = self.model.dt_ksec
+            n_preds = self.model.n_preds
+            self._matrix = np.linalg.inv(np.eye(n_preds)
+                                         - GAMMA / 2 * dt * system.A)
+            self._matrix_key = key
+            unstable = system.unstable_explicit_methods(dt)
+            if unstable:
+                logger.info('Model {}: explicit {} would be unstable at dt={} '
+                            'sec'.format(self.model.name, ', '.join(unstable),
+                                         self.model.dt))
+        return self._matrix
+
+    def run(self, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        model = self.model
+        system = LinearSystem(self.tmal_ints, self.tmal_floats, model.n_preds)
+        M = self.get_matrix(system)
+        mvals = self.mvals[:, j0:] if j0 else self.mvals
+        n_fail = calc_model_trbdf2(model.n_times - j0, model.n_preds,
+                                   model.dt_ksec, self.tmal_ints,
+                                   self.tmal_floats, mvals, M, self.tol,
+                                   self.max_iter)
+        if n_fail:
+            logger.warning('Model {}: implicit solver did not converge in {} '
+                           'stages'.format(model.name, n_fail))
@@ -0,0 +1,284 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+JIT-specialized model kernels.
+
+The C cores interpret the TMAL program at every RK stage of every time step.
+For a given model the TMAL opcodes and indices never change during a run, so
+this module generates Python source for a derivative function that has the
+TMAL program unrolled into straight-line code (with the ``i < n_preds`` tests
+resolved at generation time) and compiles it with numba.  The generated source
+is written to a cache directory keyed by a hash of the TMAL structure so that
+numba can also cache the compiled machine code on disk between sessions.
+
+The cache directory is ``$XIJA_JIT_CACHE_DIR`` if set, otherwise
+``~/.xija/jit_cache``.
+"""
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from . import tmal
+
+__all__ = ['JitKernel', 'get_jit_module', 'get_jit_source']
+
+# Bump this when the generated source changes so old cache entries are not used
+JIT_VERSION = 1
+
+_jit_modules = {}
+
+MODULE_HEADER = '''\
+# Generated by xija.jit -- do not edit
+import numpy as np
+from numba import njit
+
+N_PREDS = {n_preds}
+'''
+
+MODULE_CORES = '''
+
+@njit(cache=True)
+def calc_model_1(n_times, dt, mvals, tmal_floats):
+    deriv = np.zeros(N_PREDS)
+    y = np.zeros(N_PREDS)
+    for j0 in range(0, n_times - 2, 2):
+        for i in range(N_PREDS):
+            y[i] = mvals[i, j0]
+        dTdt_full(j0, mvals, tmal_floats, deriv, y)
+        for i in range(N_PREDS):
+            y[i] = y[i] + dt * deriv[i] / 2.0
+        dTdt_full(j0 + 1, mvals, tmal_floats, deriv, y)
+        for i in range(N_PREDS):
+            k2 = dt * deriv[i]
+            mvals[i, j0 + 1] = y[i] + k2 / 2.0
+            mvals[i, j0 + 2] = y[i] + k2
+
+
+@njit(cache=True)
+def calc_model_2(rk4, n_times, dt, mvals, tmal_floats):
+    one_sixth = 1.0 / 6.0
+    deriv = np.zeros(N_PREDS)
+    y = np.zeros(N_PREDS)
+    yh = np.zeros(N_PREDS)
+    k1 = np.zeros(N_PREDS)
+    k2 = np.zeros(N_PREDS)
+    k3 = np.zeros(N_PREDS)
+    for j in range(n_times - 1):
+        for i in range(N_PREDS):
+            y[i] = mvals[i, j]
+        dTdt_full(j, mvals, tmal_floats, deriv, y)
+        for i in range(N_PREDS):
+            k1[i] = dt * deriv[i]
+            yh[i] = y[i] + 0.5 * k1[i]
+        dTdt_half(j, mvals, tmal_floats, deriv, yh)
+        for i in range(N_PREDS):
+            k2[i] = dt * deriv[i]
+        if rk4 == 0:
+            for i in range(N_PREDS):
+                mvals[i, j + 1] = y[i] + k2[i]
+            continue
+        for i in range(N_PREDS):
+            yh[i] = y[i] + 0.5 * k2[i]
+        dTdt_half(j, mvals, tmal_floats, deriv, yh)
+        for i in range(N_PREDS):
+            k3[i] = dt * deriv[i]
+            yh[i] = y[i] + k3[i]
+        dTdt_full(j + 1, mvals, tmal_floats, deriv, yh)
+        for i in range(N_PREDS):
+            k4 = dt * deriv[i]
+            mvals[i, j + 1] = y[i] + one_sixth * (k1[i] + 2.0 * (k2[i] + k3[i]) + k4)
+'''
+
+
+def _dTdt_source(name, tmal_ints, n_preds, half):
+    """Generate source for a derivative function with the TMAL program
+    unrolled.  For ``half=True`` the input mvals are interpolated to the
+    middle of the step and the active heater powers are not stored, matching
+    the ``half`` argument of ``dTdt`` in core_2.c.
+    """
+    def mvals_at(i2):
+        if half:
+            return '0.5 * (mvals[{0}, j] + mvals[{0}, j + 1])'.format(i2)
+        return 'mvals[{0}, j]'.format(i2)
+
+    lines = ['', '', '@njit(cache=True)',
+             'def {}(j, mvals, tmal_floats, deriv, y):'.format(name)]
+    for i in range(n_preds):
+        lines.append('    deriv[{}] = 0.0'.format(i))
+
+    for i, ints in enumerate(tmal_ints):
+        opcode, i1, i2, i3 = (int(x) for x in ints[:4])
+        if opcode == tmal.OPCODES['coupling']:
+            if i1 >= n_preds:
+                continue
+            src = 'y[{}]'.format(i2) if i2 < n_preds else mvals_at(i2)
+            lines.append('    deriv[{0}] += ({1} - y[{0}]) / tmal_floats[{2}, 0]'
+                         .format(i1, src, i))
+        elif opcode == tmal.OPCODES['heatsink']:
+            if i1 < n_preds:
+                lines.append('    deriv[{0}] += (tmal_floats[{1}, 0] - y[{0}]) '
+                             '/ tmal_floats[{1}, 1]'.format(i1, i))
+        elif opcode == tmal.OPCODES['precomputed_heat']:
+            if i1 < n_preds:
+                lines.append('    deriv[{}] += {}'.format(i1, mvals_at(i2)))
+        elif opcode in (tmal.OPCODES['proportional_heater'],
+                        tmal.OPCODES['thermostat_heater']):
+            ctrl = 'y[{}]'.format(i2) if i2 < n_preds else mvals_at(i2)
+            if opcode == tmal.OPCODES['proportional_heater']:
+                heat = 'tmal_floats[{}, 1] * dt2'.format(i)
+            else:
+                heat = 'tmal_floats[{}, 1]'.format(i)
+            lines.append('    dt2 = tmal_floats[{}, 0] - {}'.format(i, ctrl))
+            lines.append('    heat = {} if dt2 > 0 else 0.0'.format(heat))
+            if i1 < n_preds:
+                lines.append('    deriv[{}] += heat'.format(i1))
+            if not half:
+                lines.append('    mvals[{}, j] = heat'.format(i3))
+        else:
+            raise ValueError('unknown TMAL opcode {}'.format(opcode))
+
+    lines.append('    return')
+    return '\n'.join(lines) + '\n'
+
+
+def get_jit_source(tmal_ints, n_preds):
+    """Return the Python source of the specialized kernel module for the TMAL
+    program ``tmal_ints`` with ``n_preds`` predicted nodes.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+
+    Returns
+    -------
+    str
+        module source code
+    """
+    return (MODULE_HEADER.format(n_preds=n_preds)
+            + _dTdt_source('dTdt_full', tmal_ints, n_preds, half=False)
+            + _dTdt_source('dTdt_half', tmal_ints, n_preds, half=True)
+            + MODULE_CORES)
+
+
+def _get_cache_dir():
+    cache_dir = os.environ.get('XIJA_JIT_CACHE_DIR')
+    cache_dir = Path(cache_dir) if cache_dir else Path.home() / '.xija' / 'jit_cache'
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        if not os.access(cache_dir, os.W_OK):
+            raise PermissionError
+    except OSError:
+        cache_dir = Path(tempfile.gettempdir()) / 'xija_jit_cache'
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_jit_module(tmal_ints, n_preds):
+    """Get the compiled kernel module for the TMAL program ``tmal_ints``.
+
+    The module is generated, written to the JIT cache directory and imported
+    the first time a given TMAL structure is seen.  Subsequent calls in the
+    same session return the already-imported module.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+
+    Returns
+    -------
+    module
+        module providing ``calc_model_1`` and ``calc_model_2``
+    """
+    tmal_ints = np.ascontiguousarray(tmal_ints, dtype=np.int32)
+    key_src = '{} {} {} {}'.format(JIT_VERSION, n_preds, tmal_ints.shape,
+                                   tmal_ints.tobytes().hex())
+    key = hashlib.sha1(key_src.encode('ascii')).hexdigest()[:16]
+    if key in _jit_modules:
+        return _jit_modules[key]
+
+    module_name = 'xija_jit_{}'.format(key)
+    path = _get_cache_dir() / (module_name + '.py')
+    if not path.exists():
+        # Write to a temp file and rename so concurrent processes never see a
+        # partially written module
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(get_jit_source(tmal_ints, n_preds))
+        os.replace(tmp_name, path)
+
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    _jit_modules[key] = module
+
+    return module
+
+
+class JitKernel(object):
+    """Prepared handle for integrating a model with a JIT-specialized kernel.
+
+    This provides the same interface as ``CoreKernel`` and gives the same
+    results as the C cores to within floating point rounding.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (1, 2)
+
+    def __init__(self, model):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints.copy()
+        self.tmal_floats = model.tmal_floats
+        self.module = get_jit_module(self.tmal_ints, model.n_preds)
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers and TMAL program match the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_floats is model.tmal_floats
+                and np.array_equal(self.tmal_ints, model.tmal_ints))
+
+    def run(self, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        model = self.model
+        mvals = self.mvals[:, j0:] if j0 else self.mvals
+        n_times = model.n_times - j0
+        if model.evolve_method == 1:
+            self.module.calc_model_1(n_times, model.dt_ksec * 2,
+                                     mvals, self.tmal_floats)
+        elif model.evolve_method == 2:
+            self.module.calc_model_2(model.rk4, n_times, model.dt_ksec,
+                                     mvals, self.tmal_floats)
+
+        # hackish fix to ensure last value is computed
+        self.mvals[:, -1] = self.mvals[:, -2]
@@ -0,0 +1,245 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Prepared integration kernels that hold the buffers and ctypes pointer tables
+needed by the C cores so that repeated model evaluations do not rebuild them.
+"""
+import ctypes
+
+import numpy as np
+
+from . import tmal
+
+__all__ = ['CoreKernel', 'SoaKernel', 'convert_type_star_star']
+
+
+def convert_type_star_star(array, ctype_type):
+    f4ptr = ctypes.POINTER(ctype_type)
+    return (f4ptr * len(array))(*[row.ctypes.data_as(f4ptr) for row in array])
+
+
+class CoreKernel(object):
+    """Prepared handle for integrating a model with the C core libraries.
+
+    The ctypes arrays of row pointers into ``tmal_ints`` and ``tmal_floats``
+    are built once when the kernel is created.  The model ``make_tmal()``
+    method updates the TMAL arrays in place, so as long as the model layout
+    does not change (which is set in ``make_mvals()``) the pointers remain
+    valid and ``run()`` only needs to call the C routine.
+
+    ``mvals`` is passed to the C routine as a pointer to its first element
+    along with its component and time strides, so the same routine handles the
+    default layout, ``mvals_layout='time'`` and a later initial column
+    without copying.  For a model with ``dtype=np.float32`` the single
+    precision ``calc_model_1_f`` or ``calc_model_2_f`` instance of the
+    routine is used.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (1, 2)
+
+    def __init__(self, model):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints
+        self.tmal_floats = model.tmal_floats
+        self.n_tmals = len(self.tmal_ints)
+
+        self.single = model.dtype == np.float32
+        self.ctype = ctypes.c_float if self.single else ctypes.c_double
+        self.tmal_ints_ptrs = convert_type_star_star(self.tmal_ints, ctypes.c_int)
+        self.tmal_floats_ptrs = convert_type_star_star(self.tmal_floats, self.ctype)
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers are still the ones used by the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_ints is model.tmal_ints
+                and self.tmal_floats is model.tmal_floats)
+
+    def run(self, evolve_method=None, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        evolve_method :
+            override the model ``evolve_method`` (1 or 2, default=None)
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        model = self.model
+        if evolve_method is None:
+            evolve_method = model.evolve_method
+
+        mvals = self.mvals[:, j0:]
+        n_times = mvals.shape[1]
+        comp_stride, time_stride = (stride // mvals.itemsize
+                                    for stride in mvals.strides)
+        mvals_ptr = mvals.ctypes.data_as(ctypes.POINTER(self.ctype))
+        if evolve_method == 1:
+            calc_model = (model.core_1.calc_model_1_f if self.single
+                          else model.core_1.calc_model_1)
+            status = calc_model(n_times, model.n_preds, self.n_tmals,
+                                model.dt_ksec * 2, mvals_ptr, comp_stride,
+                                time_stride, self.tmal_ints_ptrs,
+                                self.tmal_floats_ptrs)
+        elif evolve_method == 2:
+            calc_model = (model.core_2.calc_model_2_f if self.single
+                          else model.core_2.calc_model_2)
+            status = calc_model(model.rk4, n_times, model.n_preds,
+                                self.n_tmals, model.dt_ksec, mvals_ptr,
+                                comp_stride, time_stride, self.tmal_ints_ptrs,
+                                self.tmal_floats_ptrs)
+        else:
+            raise ValueError('evolve_method must be one of {}'
+                             .format(self.evolve_methods))
+        if status != 0:
+            raise MemoryError('failed to allocate memory in {}'
+                              .format(calc_model.__name__))
+
+        # hackish fix to ensure last value is computed
+        self.mvals[:, -1] = self.mvals[:, -2]
+
+
+class SoaKernel(object):
+    """Prepared handle for integrating a model with the struct-of-arrays C
+    routines ``calc_model_1_soa`` and ``calc_model_2_soa`` (``backend='soa'``).
+
+    The TMAL program is compiled once into per-group index and coefficient
+    arrays (see ``xija.tmal.group_by_opcode``), e.g. all couplings between
+    predicted nodes become the ``i1``, ``i2`` and ``1 / tau`` vectors, so that
+    the C core evaluates each group in a tight loop without branching on the
+    opcode or dividing by the time constants.  The coefficients are refreshed
+    from the model ``tmal_floats`` at each ``run()``.
+
+    As for ``CoreKernel``, ``mvals`` is passed as a pointer with component and
+    time strides so any ``mvals_layout`` and initial column are handled
+    without copying, and ``dtype=np.float32`` uses the ``_f`` instances of the
+    routines.  The group coefficients are always kept in double precision.
+    The results are the same as ``CoreKernel`` to within floating point
+    rounding.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (1, 2)
+
+    # Integer columns of tmal_ints and float columns of tmal_floats in each
+    # group.  Float columns given as negative (-1 - col) are reciprocals.
+    GROUP_COLS = {'coupling': ((1, 2), (-1,)),
+                  'coupling_ext': ((1, 2), (-1,)),
+                  'heatsink': ((1,), (0, -2)),
+                  'precomputed_heat': ((1, 2), ()),
+                  'heater': ((0, 1, 2, 3), (0, 1))}
+
+    def __init__(self, model):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints.copy()
+        self.tmal_floats = model.tmal_floats
+        self.single = model.dtype == np.float32
+        self.ctype = ctypes.c_float if self.single else ctypes.c_double
+
+        # All group floats live in one buffer that is refreshed from
+        # tmal_floats with a single gather (``float_src``) followed by
+        # inverting the time constants (``float_recip``).
+        groups = tmal.group_by_opcode(self.tmal_ints, model.n_preds)
+        n_ops = []
+        self.op_ints = []
+        float_src = []
+        float_recip = []
+        for name in tmal.SOA_GROUPS:
+            rows = groups[name]
+            int_cols, float_cols = self.GROUP_COLS[name]
+            ints = self.tmal_ints[np.ix_(rows, int_cols)].T
+            self.op_ints.append(np.ascontiguousarray(ints, dtype=np.int32).ravel())
+            float_src.append([])
+            for col in float_cols:
+                float_recip.extend([col < 0] * len(rows))
+                float_src[-1].extend(rows * tmal.N_FLOATS + (-1 - col if col < 0 else col))
+            n_ops.append(len(rows))
+        self.float_src = np.array(sum(float_src, []), dtype=np.intp)
+        self.float_recip = np.flatnonzero(float_recip)
+        self.floats = np.zeros(len(self.float_src))
+        bounds = np.cumsum([0] + [len(src) for src in float_src])
+        self.op_floats = [self.floats[i0:i1] for i0, i1 in zip(bounds[:-1], bounds[1:])]
+
+        self.n_ops = (ctypes.c_int * len(n_ops))(*n_ops)
+        self.op_ints_ptrs = convert_type_star_star(self.op_ints, ctypes.c_int)
+        self.op_floats_ptrs = convert_type_star_star(self.op_floats, ctypes.c_double)
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers and TMAL program match the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_floats is model.tmal_floats
+                and np.array_equal(self.tmal_ints, model.tmal_ints))
+
+    def update_floats(self):
+        """Copy the current TMAL coefficients into the group float arrays."""
+        floats = self.floats
+        floats[:] = self.tmal_floats.ravel()[self.float_src]
+        floats[self.float_recip] = 1.0 / floats[self.float_recip]
+
+    def run(self, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        model = self.model
+        self.update_floats()
+        mvals = self.mvals[:, j0:]
+        n_times = mvals.shape[1]
+        comp_stride, time_stride = (stride // mvals.itemsize
+                                    for stride in mvals.strides)
+        mvals_ptr = mvals.ctypes.data_as(ctypes.POINTER(self.ctype))
+        if model.evolve_method == 1:
+            calc_model = (model.core_1.calc_model_1_soa_f if self.single
+                          else model.core_1.calc_model_1_soa)
+            status = calc_model(n_times, model.n_preds, model.dt_ksec * 2,
+                                mvals_ptr, comp_stride, time_stride,
+                                self.n_ops, self.op_ints_ptrs,
+                                self.op_floats_ptrs)
+        elif model.evolve_method == 2:
+            calc_model = (model.core_2.calc_model_2_soa_f if self.single
+                          else model.core_2.calc_model_2_soa)
+            status = calc_model(model.rk4, n_times, model.n_preds,
+                                model.dt_ksec, mvals_ptr, comp_stride,
+                                time_stride, self.n_ops, self.op_ints_ptrs,
+                                self.op_floats_ptrs)
+        else:
+            raise ValueError('evolve_method must be one of {}'
+                             .format(self.evolve_methods))
+        if status != 0:
+            raise MemoryError('failed to allocate memory in {}'
+                              .format(calc_model.__name__))
+
+        # hackish fix to ensure last value is computed
+        self.mvals[:, -1] = self.mvals[:, -2]
@@ -0,0 +1,402 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Linear-system view of a TMAL program and the exact exponential integrator.
+
+Without the active heater opcodes a Xija network is a linear ODE system::
+
+  dy/dt = A y + B u(t) + c
+
+where ``y`` are the predicted node values (the first ``n_preds`` rows of
+mvals), ``u`` are the mvals rows used as inputs (fixed node temperatures and
+precomputed heat powers) and ``c`` holds the heat sink terms.
+"""
+import logging
+
+import numpy as np
+import scipy.linalg
+from numba import njit
+
+from . import tmal
+from .kernel import CoreKernel
+from .numba_core import dTdt
+
+__all__ = ['LinearSystem', 'has_active_heaters', 'ExpmKernel',
+           'EXPLICIT_METHODS', 'solve_steady_state']
+
+logger = logging.getLogger('xija')
+
+HEATER_OPCODES = (tmal.OPCODES['proportional_heater'],
+                  tmal.OPCODES['thermostat_heater'])
+
+
+# Stability functions R(z) of the explicit solvers for dy/dt = lambda y, where
+# z = lambda * dt and dt is the time step actually passed to the C core
+# (2 * model dt for evolve_method=1).  The evolve_method=1 scheme advances from
+# the half step, giving (1 + z/2) * (1 + z).
+EXPLICIT_METHODS = {
+    'evolve_method=1': (1, 0, lambda z: (1 + z / 2) * (1 + z)),
+    'evolve_method=2 (RK2)': (2, 0, lambda z: 1 + z + z ** 2 / 2),
+    'evolve_method=2 (RK4)': (2, 1, lambda z: (1 + z + z ** 2 / 2 + z ** 3 / 6
+                                               + z ** 4 / 24)),
+}
+
+
+def has_active_heaters(tmal_ints):
+    """Return True if the TMAL program has active heater statements, which
+    make the model nonlinear in the node values.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+
+    Returns
+    -------
+    bool
+    """
+    return bool(np.any(np.isin(np.asarray(tmal_ints)[:, 0], HEATER_OPCODES)))
+
+
+class LinearSystem(object):
+    """Matrices ``A``, ``B`` and ``c`` of the linear network defined by a TMAL
+    program, such that ``dy/dt = A y + B u + c`` with ``u = mvals[input_rows]``.
+
+    Active heater statements are ignored, so for models with heaters this
+    describes the network with all heaters off.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+
+    Returns
+    -------
+
+    """
+    def __init__(self, tmal_ints, tmal_floats, n_preds):
+        self.n_preds = n_preds
+
+        input_rows = set()
+        for opcode, i1, i2 in np.asarray(tmal_ints)[:, :3]:
+            if i1 < n_preds and i2 >= n_preds and opcode in (
+                    tmal.OPCODES['coupling'], tmal.OPCODES['precomputed_heat']):
+                input_rows.add(int(i2))
+        self.input_rows = np.array(sorted(input_rows), dtype=np.intp)
+        cols = {row: col for col, row in enumerate(self.input_rows)}
+
+        self.A = A = np.zeros((n_preds, n_preds))
+        self.B = B = np.zeros((n_preds, len(self.input_rows)))
+        self.c = c = np.zeros(n_preds)
+
+        for ints, floats in zip(tmal_ints, tmal_floats):
+            opcode, i1, i2 = (int(x) for x in ints[:3])
+            if i1 >= n_preds:
+                continue
+            if opcode == tmal.OPCODES['coupling']:
+                A[i1, i1] -= 1.0 / floats[0]
+                if i2 < n_preds:
+                    A[i1, i2] += 1.0 / floats[0]
+                else:
+                    B[i1, cols[i2]] += 1.0 / floats[0]
+            elif opcode == tmal.OPCODES['heatsink']:
+                A[i1, i1] -= 1.0 / floats[1]
+                c[i1] += floats[0] / floats[1]
+            elif opcode == tmal.OPCODES['precomputed_heat']:
+                B[i1, cols[i2]] += 1.0
+
+    def unstable_explicit_methods(self, dt):
+        """Return the explicit solvers that would be unstable for this network
+        with model time step ``dt``.
+
+        Parameters
+        ----------
+        dt :
+            model time step (ksec)
+
+        Returns
+        -------
+        list
+            names of unstable methods (keys of ``EXPLICIT_METHODS``)
+        """
+        eigvals = np.linalg.eigvals(self.A)
+        unstable = []
+        for name, (evolve_method, rk4, stab_func) in EXPLICIT_METHODS.items():
+            step = dt * 2 if evolve_method == 1 else dt
+            if np.any(np.abs(stab_func(eigvals * step)) > 1.0 + 1e-12):
+                unstable.append(name)
+        return unstable
+
+    def forcing(self, mvals, j0=0, j1=None):
+        """Forcing term ``B u + c`` for columns ``j0:j1`` of ``mvals``.
+
+        Parameters
+        ----------
+        mvals :
+            model mvals array
+        j0 :
+            first column (default=0)
+        j1 :
+            stop column (default=all)
+
+        Returns
+        -------
+        ndarray
+            (n_preds, n_cols) array
+        """
+        u = mvals[self.input_rows, j0:j1]
+        return self.B.dot(u) + self.c[:, np.newaxis]
+
+    def propagators(self, dt):
+        """Return the exact one-step propagators for step size ``dt``.
+
+        For a forcing ``f`` that varies linearly over the step from ``f0`` to
+        ``f1``::
+
+          y(t + dt) = Phi y(t) + Gamma f0 + Gamma1 (f1 - f0)
+
+        with ``Phi = exp(A dt)``, ``Gamma = integral_0^dt exp(A s) ds`` and
+        ``Gamma1 = integral_0^dt exp(A (dt - s)) s / dt ds``.  All three come
+        from a single matrix exponential of an augmented matrix, so this also
+        works when ``A`` is singular.
+
+        Parameters
+        ----------
+        dt :
+            step size (ksec)
+
+        Returns
+        -------
+        tuple
+            (Phi, Gamma, Gamma1)
+        """
+        n = self.n_preds
+        aug = np.zeros((3 * n, 3 * n))
+        aug[:n, :n] = self.A * dt
+        aug[:n, n:2 * n] = np.eye(n) * dt
+        aug[n:2 * n, 2 * n:] = np.eye(n)
+        expm = scipy.linalg.expm(aug)
+        return (expm[:n, :n].copy(), expm[:n, n:2 * n].copy(),
+                expm[:n, 2 * n:].copy())
+
+
+def solve_steady_state(tmal_ints, tmal_floats, mvals, n_preds, j=0, tol=1e-8,
+                       max_iter=50):
+    """Solve for the predicted node values that are in equilibrium with the
+    inputs in column ``j`` of ``mvals``, i.e. ``dy/dt = 0``.
+
+    For the linear network this is ``y = -inv(A) (B u + c)``.  Active heater
+    terms are included by Newton iterations using ``A`` as the Jacobian.  If
+    ``A`` is singular (some nodes are not connected to any input or heat sink)
+    the least-squares solution is used and a warning is logged.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    mvals :
+        model mvals array
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+    j :
+        mvals column defining the inputs (default=0)
+    tol :
+        convergence tolerance (degC, default=1e-8)
+    max_iter :
+        maximum number of iterations (default=50)
+
+    Returns
+    -------
+    ndarray
+        steady-state values of the predicted nodes
+    """
+    system = LinearSystem(tmal_ints, tmal_floats, n_preds)
+    A = system.A
+    singular = np.linalg.matrix_rank(A) < n_preds
+    if singular:
+        logger.warning('Network matrix is singular, using least-squares '
+                       'steady state')
+
+    y = mvals[:n_preds, j].astype(np.float64)
+    deriv = np.zeros(n_preds)
+    for _ in range(max_iter):
+        dTdt(j, 0.0, False, n_preds, np.asarray(tmal_ints),
+             np.asarray(tmal_floats), mvals, deriv, y)
+        if singular:
+            dy = np.linalg.lstsq(A, -deriv, rcond=None)[0]
+        else:
+            dy = np.linalg.solve(A, -deriv)
+        y += dy
+        if np.max(np.abs(dy)) < tol:
+            break
+    else:
+        logger.warning('Steady state solution did not converge in {} '
+                       'iterations'.format(max_iter))
+
+    return y
+
+
+@njit(cache=True)
+def _propagate(Phis, GBs, gcs, G1, input_rows, mvals):
+    # Propagate blocks of steps from the state at the block start, where a
+    # block is one step with changing inputs or up to len(Phis) - 1 steps
+    # with identical inputs.  After k steps from y with inputs u (changing
+    # linearly to u1 over a single step)::
+    #
+    #   y_k = Phis[k] y + GBs[k] u + gcs[k] (+ G1 (u1 - u))
+    n_preds = Phis.shape[1]
+    n_inputs = len(input_rows)
+    n_steps = mvals.shape[1] - 1
+    max_block = len(Phis) - 1
+    y = np.empty(n_preds)
+    u = np.empty(n_inputs)
+    du = np.empty(n_inputs)
+    j = 0
+    while j < n_steps:
+        n = 0
+        while n < max_block and j + n < n_steps:
+            same = True
+            for m in range(n_inputs):
+                if mvals[input_rows[m], j + n + 1] != mvals[input_rows[m], j + n]:
+                    same = False
+                    break
+            if not same:
+                break
+            n += 1
+        for m in range(n_inputs):
+            u[m] = mvals[input_rows[m], j]
+            du[m] = mvals[input_rows[m], j + 1] - u[m]
+        for i in range(n_preds):
+            y[i] = mvals[i, j]
+        if n == 0:
+            for i in range(n_preds):
+                val = gcs[1, i]
+                for m in range(n_preds):
+                    val += Phis[1, i, m] * y[m]
+                for m in range(n_inputs):
+                    val += GBs[1, i, m] * u[m] + G1[i, m] * du[m]
+                mvals[i, j + 1] = val
+            n = 1
+        else:
+            for k in range(1, n + 1):
+                for i in range(n_preds):
+                    val = gcs[k, i]
+                    for m in range(n_preds):
+                        val += Phis[k, i, m] * y[m]
+                    for m in range(n_inputs):
+                        val += GBs[k, i, m] * u[m]
+                    mvals[i, j + k] = val
+        j += n
+
+
+class ExpmKernel(object):
+    """Prepared handle for integrating a model with the exponential
+    integrator (``evolve_method = 3``).
+
+    The input mvals rows are interpolated linearly between the model times,
+    as for the other integrators, and each time step is propagated exactly
+    for that input.  Runs of time steps with identical input columns (e.g.
+    between commanded state changes) are split into blocks of at most
+    ``max_block`` steps.  Every state in a block is computed directly from the
+    block start state with the cached powers ``Phi**k`` and input integrals
+    ``Gamma_k``, so the forcing is evaluated and the state carried over once
+    per block rather than once per time step.  Each state is still a dense
+    ``n_preds`` x ``n_preds`` product, so large sparse networks are faster
+    with the explicit solvers.  The linear system and propagators are only
+    rebuilt when the TMAL values change.
+
+    Models with active heaters are nonlinear so these fall back to the RK2 /
+    RK4 C core (``evolve_method = 2``).
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (3,)
+
+    # Maximum number of time steps propagated from one block start state
+    max_block = 64
+
+    def __init__(self, model):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints
+        self.tmal_floats = model.tmal_floats
+        self.use_rk = has_active_heaters(self.tmal_ints)
+        if self.use_rk:
+            logger.warning('Model {} has active heaters, using RK '
+                           '(evolve_method=2) instead of the exponential '
+                           'integrator'.format(model.name))
+            self.core_kernel = CoreKernel(model)
+        self._system_key = None
+        self._propagators_key = None
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers are still the ones used by the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_ints is model.tmal_ints
+                and self.tmal_floats is model.tmal_floats)
+
+    def get_system(self):
+        """Linear system of the current TMAL values"""
+        key = self.tmal_ints.tobytes() + self.tmal_floats.tobytes()
+        if key != self._system_key:
+            self._system = LinearSystem(self.tmal_ints, self.tmal_floats,
+                                        self.model.n_preds)
+            self._system_key = key
+        return self._system
+
+    def get_propagators(self, system):
+        """Propagators for ``k = 0 .. max_block`` steps with constant inputs
+        ``u``, stacked as ``Phis[k] = Phi**k``, ``GBs[k] = Gamma_k B`` and
+        ``gcs[k] = Gamma_k c`` where ``Gamma_k = sum_{i<k} Phi**i Gamma``,
+        along with ``G1 = Gamma1 B`` for inputs that change over one step
+        (see ``LinearSystem.propagators()``)."""
+        key = system.A.tobytes() + system.B.tobytes() + system.c.tobytes()
+        if key != self._propagators_key:
+            Phi, Gamma, Gamma1 = system.propagators(self.model.dt_ksec)
+            n = system.n_preds
+            Phis = np.empty((self.max_block + 1, n, n))
+            Gammas = np.empty((self.max_block + 1, n, n))
+            Phis[0] = np.eye(n)
+            Gammas[0] = 0.0
+            for k in range(1, self.max_block + 1):
+                Phis[k] = Phi.dot(Phis[k - 1])
+                Gammas[k] = Gammas[k - 1] + Phis[k - 1].dot(Gamma)
+            self._propagators = (Phis, Gammas.dot(system.B), Gammas.dot(system.c),
+                                 Gamma1.dot(system.B))
+            self._propagators_key = key
+        return self._propagators
+
+    def run(self, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        if self.use_rk:
+            self.core_kernel.run(evolve_method=2, j0=j0)
+            return
+
+        system = self.get_system()
+        _propagate(*self.get_propagators(system), system.input_rows,
+                   self.mvals[:, j0:])
@@ -10,6 +10,7 @@ import os
 import json
 import ctypes
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from pathlib import Path
 
@@ -17,6 +18,12 @@ import numpy as np
 
 from . import component
 from . import tmal
+from . import providers
+from .linear import LinearSystem, EXPLICIT_METHODS, solve_steady_state
+from .backends import get_backend, get_default_backend
+from . import sensitivity
+from . import adjoint
+from .profiling import Profiler, profiled
 
 # Optional packages for model fitting or use on HEAD LAN
 from Chandra.Time import DateTime, date2secs
@@ -43,17 +50,22 @@ if 'debug' in globals():
 logger = clogging.config_logger('xija', level=clogging.INFO)
 
 DEFAULT_DT = 328.0
+
+# Reference time (CXC secs) of the model time grid, which is aligned with the
+# timestamps of the '5min' Ska eng archive data
+TIME0 = 410270764.0
+# Memory layouts of mvals, see XijaModel.make_mvals()
+MVALS_LAYOUTS = ('comp', 'time')
+# Number of threads used by XijaModel.prefetch() for engineering archive reads
+FETCH_WORKERS = 8
+
+
 dt_factors = np.array([1.0, 0.5, 0.25, 0.2, 0.125, 0.1, 0.05, 0.025])
 
 #int calc_model(int n_times, int n_preds, int n_tmals, double dt,
 #               double **mvals, int **tmal_ints, double **tmal_floats)
 
 
-def convert_type_star_star(array, ctype_type):
-    f4ptr = ctypes.POINTER(ctype_type)
-    return (f4ptr * len(array))(*[row.ctypes.data_as(f4ptr) for row in array])
-
-
 class FetchError(Exception):
     pass
 
@@ -70,6 +82,12 @@ class XijaModel(object):
       two steps as a full RK2 step.
     - ``evolve_method = 2`` uses the new ODE solver which treats every step
       as a full RK2 step, and optionally allows for RK4 if ``rk4 = 1``.
+    - ``evolve_method = 3`` uses the exact exponential integrator for the
+      linear network with inputs interpolated linearly over each step, which
+      propagates runs of identical inputs in blocks.  Models with active
+      heaters fall back to ``evolve_method = 2``.
+    - ``evolve_method = 4`` uses the L-stable implicit TR-BDF2 solver, which
+      stays stable for stiff models (short time constants) at any ``dt``.
     - Otherwise defaults are: ``name='xijamodel'``, ``start = stop - 45 days``,
       ``stop = NOW - 30 days``, ``dt = 328 secs``, ``evolve_method = 1``,
       ``rk4 = 0``
@@ -89,12 +107,33 @@ class XijaModel(object):
     cmd_states :
         commanded states input (None | structured array)
     evolve_method :
-        choose method to evolve ODE (None | 1 or 2, default 1)
+        choose method to evolve ODE (None | 1, 2, 3 or 4, default 1, or the
+        only method supported by ``backend``)
     rk4 :
         use 4th-order Runge-Kutta to evolve ODE, only works with
         evolve_method == 2 (None | 0 or 1, default 0)
     limits :
         dict of limit values (None | dict)
+    jit :
+        use a kernel JIT-compiled for this model's TMAL program instead of
+        the C core (default=False)
+    mvals_layout :
+        memory layout of ``mvals``: 'comp' for one contiguous row per
+        component or 'time' for a time-major buffer where the values of all
+        components at one time are contiguous (default='comp')
+    dtype :
+        floating point type of the ``mvals`` and ``tmal_floats`` buffers,
+        np.float64 or np.float32 for single precision storage which halves
+        the memory use (e.g. for large ``calc_batch()`` ensembles) at the
+        cost of ~1e-3 degC accuracy (default=np.float64)
+    backend :
+        name of the integration backend registered in ``xija.backends``, e.g.
+        'c', 'numba' or 'jit' (default=None to use the default backend for
+        ``evolve_method``)
+    provider :
+        source of the telemetry and commanded states inputs, see
+        ``xija.providers`` (default=None to use
+        ``xija.providers.get_default_provider()``)
 
     Returns
     -------
@@ -102,7 +141,8 @@ class XijaModel(object):
     """
     def __init__(self, name=None, start=None, stop=None, dt=None,
                  model_spec=None, cmd_states=None, evolve_method=None,
-                 rk4=None, limits=None):
+                 rk4=None, limits=None, jit=False, mvals_layout='comp',
+                 dtype=np.float64, backend=None, provider=None):
         # If model_spec is a str or Path then read that file
         if isinstance(model_spec, (str, Path)):
             model_spec = json.load(open(model_spec, 'r'))
@@ -126,7 +166,9 @@ class XijaModel(object):
         if dt is None:
             dt = DEFAULT_DT
         if evolve_method is None:
-            evolve_method = 1
+            evolve_methods = (get_backend(backend).evolve_methods
+                              if backend is not None else ())
+            evolve_method = evolve_methods[0] if len(evolve_methods) == 1 else 1
         if rk4 is None:
             rk4 = 0
         if limits is None:
@@ -136,36 +178,85 @@ class XijaModel(object):
         self.comp = OrderedDict()
         self.dt = self._get_allowed_timestep(dt)
         self.dt_ksec = self.dt / 1000.
-        self.times = self._eng_match_times(start, stop)
-        self.tstart = self.times[0]
-        self.tstop = self.times[-1]
-        self.ksecs = (self.times - self.tstart) / 1000.
-        self.datestart = DateTime(self.tstart).date
-        self.datestop = DateTime(self.tstop).date
-        self.n_times = len(self.times)
+        self._set_times(self._eng_match_times(start, stop))
         self.evolve_method = evolve_method
         self.rk4 = rk4
         self.limits = limits
+        self.jit = jit
+        self.mvals_generation = 0
+        if backend is not None:
+            get_backend(backend)
+        self.backend = backend
+        if mvals_layout not in MVALS_LAYOUTS:
+            raise ValueError('mvals_layout must be one of {}'
+                             .format(MVALS_LAYOUTS))
+        self.mvals_layout = mvals_layout
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float64, np.float32):
+            raise ValueError('dtype must be float64 or float32')
+        self.profiler = None
+        self.provider = (providers.get_default_provider() if provider is None
+                         else provider)
 
         if model_spec is None or 'bad_times' not in model_spec:
             self.bad_times = []
         else:
             self.bad_times = model_spec['bad_times']
-        self.bad_times_indices = []
-        for t0, t1 in self.bad_times:
-            t0, t1 = DateTime([t0, t1]).secs
-            i0, i1 = np.searchsorted(self.times, [t0, t1])
-            if i1 > i0:
-                self.bad_times_indices.append((i0, i1))
+        self.bad_times_indices = self._get_times_indices(self.bad_times)
         self.mask_times = self.bad_times.copy()
         self.mask_times_indices = self.bad_times_indices.copy()
         self.mask_time_secs = date2secs(self.mask_times)
 
         self.pars = []
+        self._parvals = np.empty(0)
+        self._par_versions = np.empty(0, dtype=np.int64)
         if model_spec:
             self._set_from_model_spec(model_spec)
         self.cmd_states = cmd_states
 
+    def _set_times(self, times):
+        """Set the model times and the attributes derived from them.
+
+        Parameters
+        ----------
+        times :
+            model times (CXC secs)
+
+        Returns
+        -------
+
+        """
+        self.times = times
+        self.tstart = self.times[0]
+        self.tstop = self.times[-1]
+        self.ksecs = (self.times - self.tstart) / 1000.
+        self.datestart = DateTime(self.tstart).date
+        self.datestop = DateTime(self.tstop).date
+        self.n_times = len(self.times)
+        # Telemetry fetched over the padded model time range, keyed by MSID
+        self._tlm_cache = {}
+
+    def _get_times_indices(self, time_ranges):
+        """Get the model time index ranges ``(i0, i1)`` corresponding to a list
+        of ``(start, stop)`` time ranges, skipping ranges with no model times.
+
+        Parameters
+        ----------
+        time_ranges :
+            list of (start, stop) pairs (any DateTime format)
+
+        Returns
+        -------
+        list
+        """
+        indices = []
+        for t0, t1 in time_ranges:
+            t0, t1 = DateTime([t0, t1]).secs
+            i0, i1 = np.searchsorted(self.times, [t0, t1])
+            if i1 > i0:
+                indices.append((i0, i1))
+        return indices
+
     def _get_allowed_timestep(self, dt):
         """This method ensures that only certain timesteps are chosen,
         which are integer multiples of 8.2 and where 328.0/dt is an
@@ -252,18 +343,14 @@ class XijaModel(object):
             timestamps in the '5min' (328 sec) Ska eng archive data.
 
         """
-        time0 = 410270764.0
-        i0 = int((DateTime(start).secs - time0) / self.dt) + 1
-        i1 = int((DateTime(stop).secs - time0) / self.dt)
-        return time0 + np.arange(i0, i1) * self.dt
+        i0 = int((DateTime(start).secs - TIME0) / self.dt) + 1
+        i1 = int((DateTime(stop).secs - TIME0) / self.dt)
+        return TIME0 + np.arange(i0, i1) * self.dt
 
     def _get_cmd_states(self):
         if not hasattr(self, '_cmd_states'):
-            import kadi.commands.states as kadi_states
-            logger.info('Getting kadi commanded states over %s to %s' %
-                        (self.datestart, self.datestop))
-            states = kadi_states.get_states(self.datestart, self.datestop)
-            self._cmd_states = kadi_states.interpolate_states(states, self.times).as_array()
+            self._cmd_states = self.provider.get_cmd_states(
+                self.datestart, self.datestop, self.times)
 
         return self._cmd_states
 
@@ -293,8 +380,82 @@ class XijaModel(object):
     cmd_states = property(_get_cmd_states, _set_cmd_states)
     """test cmdstats"""
 
+    def _fetch_tlm(self, msid):
+        """Fetch 5-minute telemetry for ``msid`` over the model time range
+        padded by 5 time steps from the model ``provider``.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+
+        Returns
+        -------
+        MSID
+            telemetry with ``times`` and MSID attributes, e.g. a Ska.engarchive
+            MSID object with bad times filtered
+        """
+        tpad = DEFAULT_DT*5.0
+        tstart = self.tstart - tpad
+        tstop = self.tstop + tpad
+        tlm = self.provider.fetch(msid, tstart, tstop, stat='5min')
+        if (len(tlm.times) == 0 or tlm.times[0] > self.tstart
+                or tlm.times[-1] < self.tstop):
+            raise ValueError('Fetched telemetry does not span model start and '
+                             'stop times for {}'.format(msid))
+        return tlm
+
+    @profiled('prefetch')
+    def prefetch(self, max_workers=None):
+        """Fetch the telemetry needed by all model components concurrently.
+
+        The MSIDs that the components will fetch when computing ``dvals`` (see
+        ``ModelComponent.get_fetch_msids()``) are collected and each is read
+        once from the model ``provider`` in a pool of threads, along with the
+        commanded states if any component needs those.  The results are
+        cached for ``fetch()``, so the wall time is set by the slowest read
+        instead of the sum of all reads.  Fetch errors are left to be raised
+        by ``fetch()`` when the component calls it.  This is called by
+        ``make()``.
+
+        Parameters
+        ----------
+        max_workers :
+            number of threads (default=FETCH_WORKERS)
+
+        Returns
+        -------
+
+        """
+        msids = []
+        need_states = False
+        for comp in self.comps:
+            if '_dvals' in comp.__dict__:
+                continue
+            for msid in comp.get_fetch_msids():
+                if msid not in msids and msid not in self._tlm_cache:
+                    msids.append(msid)
+            if (isinstance(comp, component.CmdStatesData) and comp.data is None
+                    and not hasattr(self, '_cmd_states')):
+                need_states = True
+        if not msids and not need_states:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers or FETCH_WORKERS) as executor:
+            futures = [(msid, executor.submit(self._fetch_tlm, msid)) for msid in msids]
+            if need_states:
+                executor.submit(self._get_cmd_states)
+        for msid, future in futures:
+            if future.exception() is None:
+                self._tlm_cache[msid] = future.result()
+
+    @profiled('fetch')
     def fetch(self, msid, attr='vals', method='linear'):
-        """Get data from the Chandra engineering archive.
+        """Get telemetry from the model ``provider`` (by default the Chandra
+        engineering archive) interpolated at the model times.
+
+        Telemetry that was already fetched for the model times (e.g. by
+        ``prefetch()``) is reused.
 
         Parameters
         ----------
@@ -309,20 +470,9 @@ class XijaModel(object):
         -------
 
         """
-        tpad = DEFAULT_DT*5.0
-        datestart = DateTime(self.tstart - tpad).date
-        datestop = DateTime(self.tstop + tpad).date
-        logger.info('Fetching msid: %s over %s to %s' %
-                    (msid, datestart, datestop))
-        try:
-            import Ska.engarchive.fetch_sci as fetch
-            tlm = fetch.MSID(msid, datestart, datestop, stat='5min')
-            tlm.filter_bad_times()
-        except ImportError:
-            raise ValueError('Ska.engarchive.fetch not available')
-        if tlm.times[0] > self.tstart or tlm.times[-1] < self.tstop:
-            raise ValueError('Fetched telemetry does not span model start and '
-                             'stop times for {}'.format(msid))
+        if msid not in self._tlm_cache:
+            self._tlm_cache[msid] = self._fetch_tlm(msid)
+        tlm = self._tlm_cache[msid]
         vals = Ska.Numpy.interpolate(getattr(tlm, attr), tlm.times,
                                      self.times, method=method)
         return vals
@@ -400,9 +550,24 @@ class XijaModel(object):
         self.comp[comp.name] = comp
         for par in comp.pars:
             self.pars.append(par)
+        self._bind_pars()
 
         return comp
 
+    def _bind_pars(self):
+        """Store the values and versions of all model parameters in the
+        ``_parvals`` and ``_par_versions`` arrays (in the order of
+        ``self.pars``) with each ``Param`` as a view of one element."""
+        n_pars = len(self.pars)
+        if len(self._parvals) == n_pars:
+            return
+        parvals = np.empty(n_pars)
+        par_versions = np.empty(n_pars, dtype=np.int64)
+        for i, par in enumerate(self.pars):
+            par.bind(parvals, par_versions, i)
+        self._parvals = parvals
+        self._par_versions = par_versions
+
     comps = property(lambda self: list(self.comp.values()))
     """List of model components"""
 
@@ -574,12 +739,13 @@ class XijaModel(object):
 
     def _get_parvals(self):
         """ """
-        return tuple(par.val for par in self.pars)
+        return tuple(self._parvals.tolist())
 
     def _set_parvals(self, vals):
         """Set the full list of parameter values.  No provision is made for
         setting individual elements or slicing (use self.pars directly in this
-        case).
+        case).  The values are copied into the model parameter array in one
+        operation and the version of each changed parameter is incremented.
 
         Parameters
         ----------
@@ -593,8 +759,10 @@ class XijaModel(object):
         if len(vals) != len(self.pars):
             raise ValueError('Length mismatch setting parvals {} vs {}'.format(
                     len(self.pars), len(vals)))
-        for par, val in zip(self.pars, vals):
-            par.val = val
+        vals = np.asarray(vals, dtype=np.float64)
+        changed = self._parvals != vals
+        self._par_versions[changed] += 1
+        self._parvals[:] = vals
 
     parvals = property(_get_parvals, _set_parvals)
 
@@ -604,8 +772,8 @@ class XijaModel(object):
         return tuple(par.full_name for par in self.pars)
 
     def make(self):
-        """Call self.make_mvals and self.make_tmal to prepare for model evaluation
-        once all model components have been added.
+        """Call self.prefetch, self.make_mvals and self.make_tmal to prepare for
+        model evaluation once all model components have been added.
 
         Parameters
         ----------
@@ -614,9 +782,67 @@ class XijaModel(object):
         -------
 
         """
+        self.prefetch()
         self.make_mvals()
         self.make_tmal()
+        self._kernel = self._make_kernel()
+        if self.evolve_method in (1, 2):
+            self.check_stability()
 
+    def check_stability(self):
+        """Check whether the explicit ODE solvers are stable for the current
+        network time constants and ``dt``.  A warning is logged if the
+        method selected by ``evolve_method`` and ``rk4`` is unstable, in which
+        case a smaller ``dt`` or ``evolve_method=4`` should be used.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        list
+            names of the explicit methods that would be unstable
+        """
+        system = LinearSystem(self.tmal_ints, self.tmal_floats, self.n_preds)
+        unstable = system.unstable_explicit_methods(self.dt_ksec)
+        for name in unstable:
+            evolve_method, rk4, _ = EXPLICIT_METHODS[name]
+            if (evolve_method == self.evolve_method
+                    and (evolve_method == 1 or rk4 == self.rk4)):
+                logger.warning('Model {}: {} is unstable at dt={} sec, use a '
+                               'smaller dt or evolve_method=4'
+                               .format(self.name, name, self.dt))
+        return unstable
+
+    def _get_kernel_class(self):
+        backend = self.backend or get_default_backend(self.evolve_method, self.jit)
+        kernel_class = get_backend(backend)
+        if self.evolve_method not in kernel_class.evolve_methods:
+            raise ValueError('backend {!r} does not support evolve_method={}, '
+                             'supported methods are {}'
+                             .format(backend, self.evolve_method,
+                                     kernel_class.evolve_methods))
+        return kernel_class
+
+    @profiled('kernel_setup')
+    def _make_kernel(self):
+        return self._get_kernel_class()(self)
+
+    @property
+    def kernel(self):
+        """Prepared kernel of the integration backend (see ``xija.backends``)
+        used by ``calc()`` to integrate the model.  This is created by
+        ``make()`` and only rebuilt when the mvals or TMAL buffers have been
+        reallocated (e.g. by ``make_mvals()``) or the ``backend``, ``jit`` or
+        ``evolve_method`` settings change.
+        """
+        kernel = getattr(self, '_kernel', None)
+        if (kernel is None or not kernel.is_current
+                or type(kernel) is not self._get_kernel_class()):
+            kernel = self._kernel = self._make_kernel()
+        return kernel
+
+    @profiled('make_mvals')
     def make_mvals(self):
         """Initialize the global mvals (model values) array.  This is an
         N (rows) x n_times (cols) array that contains all data needed
@@ -625,6 +851,12 @@ class XijaModel(object):
         external temperatures, etc).  In the model calculation some
         rows will be overwritten with predictions.
 
+        With ``mvals_layout='time'`` the values are stored in a C-contiguous
+        (n_times, n_comps) buffer and ``mvals`` is its transpose, so that
+        ``mvals`` and the component ``mvals`` views are indexed as usual while
+        the C core reads all the values of one time step from adjacent
+        memory.
+
         Parameters
         ----------
 
@@ -646,13 +878,29 @@ class XijaModel(object):
 
         # Stack the input dvals.  This *copies* the data values.
         self.n_preds = len(preds)
-        self.mvals = np.hstack([comp.dvals for comp in preds + unpreds])
-        self.mvals.shape = (len(comps), -1)  # why doesn't this use vstack?
+        dvals = [comp.dvals for comp in preds + unpreds]
+        if self.mvals_layout == 'time':
+            self.mvals = np.column_stack(dvals).astype(self.dtype, copy=False).T
+        else:
+            self.mvals = np.hstack(dvals).astype(self.dtype, copy=False)
+            self.mvals.shape = (len(comps), -1)  # why doesn't this use vstack?
         self.cvals = self.mvals[:, 0::2]
+        self.mvals_generation += 1
+        self._kernel = None
 
+    @profiled('make_tmal')
     def make_tmal(self):
         """Make the TMAL "code" using components that generate TMAL
-        statements
+        statements.  The ``tmal_ints`` and ``tmal_floats`` arrays are updated
+        in place when the number of TMAL statements is unchanged, so that the
+        prepared kernel pointers into them remain valid.
+
+        Component ``update()`` is only called when the component
+        ``update_key`` changed, i.e. when one of its parameters changed, its
+        data were set with ``set_data()``, the mvals array was rebuilt by
+        ``make_mvals()`` or ``invalidate()`` was called.  Otherwise the mvals
+        rows and TMAL values from the previous call are kept, including any
+        values written directly into the ``mvals`` input rows.
 
         Parameters
         ----------
@@ -661,46 +909,517 @@ class XijaModel(object):
         -------
 
         """
+        profiler = self.profiler
         for comp in self.comps:
-            comp.update()
+            key = comp.update_key
+            if key is not None and key == getattr(comp, '_update_key', None):
+                continue
+            if profiler is None:
+                comp.update()
+            else:
+                with profiler.phase('update', str(comp)):
+                    comp.update()
+            comp._update_key = key
         tmal_comps = [x for x in self.comps if hasattr(x, 'tmal_ints')]
-        self.tmal_ints = np.zeros((len(tmal_comps), tmal.N_INTS),
-                                  dtype=np.int32)
-        self.tmal_floats = np.zeros((len(tmal_comps), tmal.N_FLOATS),
-                                    dtype=np.float)
+        if (getattr(self, 'tmal_ints', None) is None
+                or len(self.tmal_ints) != len(tmal_comps)):
+            self.tmal_ints = np.zeros((len(tmal_comps), tmal.N_INTS),
+                                      dtype=np.int32)
+            self.tmal_floats = np.zeros((len(tmal_comps), tmal.N_FLOATS),
+                                        dtype=self.dtype)
+        else:
+            self.tmal_ints.fill(0)
+            self.tmal_floats.fill(0.0)
         for i, comp in enumerate(tmal_comps):
             self.tmal_ints[i, 0:len(comp.tmal_ints)] = comp.tmal_ints
             self.tmal_floats[i, 0:len(comp.tmal_floats)] = comp.tmal_floats
 
+    def invalidate(self):
+        """Force every component ``update()`` on the next ``calc()``.
+
+        Use this after changing model inputs in a way that the component
+        ``update_key`` does not track, e.g. writing directly into the
+        ``mvals`` input rows, so that they are recomputed from the components.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        """
+        self.mvals_generation += 1
+
+    @profiled('calc')
     def calc(self):
-        """Calculate the model.  The results appear in the self.mvals array."""
+        """Calculate the model.  The results appear in the self.mvals array.
+
+        Values written directly into the ``mvals`` input rows are used as is
+        and persist until the components are next updated (see
+        ``make_tmal()`` and ``invalidate()``)."""
+        self.make_tmal()
+        kernel = self.kernel
+        if self.profiler is None:
+            kernel.run()
+        else:
+            with self.profiler.phase('integrate'):
+                kernel.run()
+
+    def enable_profiling(self, trace=True):
+        """Start recording the wall time and number of calls of each phase of
+        the model evaluation (``make_mvals``, ``make_tmal``, component
+        ``update``, ``kernel_setup``, ``integrate``, ``calc_stat``,
+        ``fit_stat`` and ``fetch``).  Any previous statistics are discarded.
+        See ``xija.profiling``.
+
+        Parameters
+        ----------
+        trace :
+            also record each call as a Chrome trace event (default=True)
+
+        Returns
+        -------
+        Profiler
+        """
+        self.profiler = self._profiler = Profiler(trace=trace)
+        return self.profiler
+
+    def disable_profiling(self):
+        """Stop recording profile statistics.  The statistics recorded so far
+        remain available from ``profile_report()``."""
+        self.profiler = None
+
+    def _get_profiler(self):
+        profiler = getattr(self, '_profiler', None)
+        if profiler is None:
+            raise ValueError('profiling has not been enabled, use '
+                             'enable_profiling()')
+        return profiler
+
+    def profile_report(self):
+        """Cumulative wall time and number of calls per phase and per
+        component since ``enable_profiling()``.  Times of nested phases are
+        inclusive (e.g. ``calc`` includes ``make_tmal`` and ``integrate``).
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        Table
+            columns phase, comp, n_calls, total (sec) and mean (sec)
+        """
+        return self._get_profiler().report()
+
+    def write_profile_trace(self, filename):
+        """Write the profiled calls as a Chrome trace-event JSON file that
+        can be loaded in ``chrome://tracing`` or Perfetto.
+
+        Parameters
+        ----------
+        filename :
+            output file name
+
+        Returns
+        -------
+
+        """
+        self._get_profiler().write_trace(filename)
+
+    def solve_initial_state(self, t0=None):
+        """Set the initial values of the predicted nodes to the steady state
+        implied by the model inputs at time ``t0``.
+
+        This solves the linear node network (including any active heaters)
+        for ``dy/dt = 0`` with the inputs at ``t0`` and seeds the first
+        column of the predicted rows of ``mvals``.  This replaces the usual
+        practice of starting the model a day or more early so that transients
+        from the initial node values die out.  Call this after ``make()``.
+
+        Parameters
+        ----------
+        t0 :
+            time of inputs to use (any DateTime format, default=model start)
+
+        Returns
+        -------
+        ndarray
+            steady-state values of the predicted nodes
+        """
+        self.make_tmal()
+        if t0 is None:
+            j = 0
+        else:
+            j = np.searchsorted(self.times, DateTime(t0).secs)
+            j = int(np.clip(j, 0, self.n_times - 1))
+        y = solve_steady_state(self.tmal_ints, self.tmal_floats, self.mvals,
+                               self.n_preds, j)
+        self.mvals[:self.n_preds, 0] = y
+        return y
+
+    def extend(self, new_stop, new_inputs=None, cmd_states=None):
+        """Extend the model to ``new_stop`` and integrate only the new times.
+
+        The model times are extended on the same time grid.  The input data
+        and ``dvals`` are only fetched and computed for the new times (from a
+        checkpoint near the old stop time) and appended to those of the
+        existing time range, and the model is integrated from the predicted
+        state at the checkpoint to the new stop.  This gives the same result
+        as a full ``calc()`` over the extended time range, provided the inputs
+        over the old time range and the parameter values are unchanged since
+        the last ``calc()``.
+
+        Component data that were set with ``set_data()`` as arrays at the
+        model times must span the new time range, so new values can be
+        supplied in ``new_inputs``.  Components without data are fetched over
+        the new times.
+
+        Parameters
+        ----------
+        new_stop :
+            new model stop time (any DateTime format)
+        new_inputs :
+            dict of component name to new data value or ``(data, times)``
+            tuple, passed to the component ``set_data()`` (default=None)
+        cmd_states :
+            commanded states covering the extended time range (default=None)
+
+        Returns
+        -------
+
+        """
+        if getattr(self, 'mvals', None) is None:
+            raise ValueError('model must be calculated before calling extend()')
+
+        i0 = int(round((self.tstart - TIME0) / self.dt))
+        i1 = int((DateTime(new_stop).secs - TIME0) / self.dt)
+        times = TIME0 + np.arange(i0, i1) * self.dt
+        if len(times) <= self.n_times:
+            raise ValueError('new_stop {} is not after model stop {}'
+                             .format(DateTime(new_stop).date, self.datestop))
+
+        # Checkpoint column to restart the integration from.  The last column
+        # is not computed (see calc()) and evolve_method=1 takes two steps at
+        # a time starting from even columns.
+        j0 = self.n_times - 2
+        if self.evolve_method == 1:
+            j0 -= j0 % 2
+
+        # Components whose update() is current give the same mvals rows as
+        # a full update over the extended times.  New inputs only supply the
+        # data for the new times, so this is checked before setting them.
+        current = [comp.update_key is not None
+                   and comp.update_key == getattr(comp, '_update_key', None)
+                   for comp in self.comps]
+
+        for name, data in (new_inputs or {}).items():
+            if isinstance(data, tuple):
+                self.comp[name].set_data(*data)
+            else:
+                self.comp[name].set_data(data)
+
+        # Model covering the times from the checkpoint, which fetches the
+        # inputs and computes the dvals and mvals of just those times
+        tail = self._make_chunk_model(times[j0:], j0)
+        if cmd_states is not None:
+            tail.cmd_states = cmd_states
+        tail.prefetch()
+        tail.make_mvals()
+        tail.make_tmal()
+
+        for comp, tail_comp in zip(self.comps, tail.comps):
+            comp.extend_time_caches(tail_comp, j0)
+
+        if cmd_states is None and hasattr(self, '_cmd_states'):
+            if hasattr(tail, '_cmd_states'):
+                self._cmd_states = np.concatenate([self._cmd_states[:j0],
+                                                   tail._cmd_states])
+            else:
+                del self._cmd_states
+
+        self._set_times(times)
+        self.bad_times_indices = self._get_times_indices(self.bad_times)
+        self.mask_times_indices = self._get_times_indices(self.mask_times)
+        if cmd_states is not None:
+            self.cmd_states = cmd_states
+
+        # Keep the mvals up to and including the checkpoint column, which
+        # holds the initial state, and append the new mvals.  The rows of
+        # both models are in the same order (see make_mvals()).
+        if self.mvals_layout == 'time':
+            self.mvals = np.concatenate([self.mvals.T[:j0 + 1],
+                                         tail.mvals.T[1:]]).T
+        else:
+            self.mvals = np.concatenate([self.mvals[:, :j0 + 1],
+                                         tail.mvals[:, 1:]], axis=1)
+        self.cvals = self.mvals[:, 0::2]
+        self.mvals_generation += 1
+        self._kernel = None
+        for comp, is_current in zip(self.comps, current):
+            if is_current:
+                comp._update_key = comp.update_key
+
         self.make_tmal()
-        # int calc_model(int n_times, int n_preds, int n_tmals, float dt,
-        #                float **mvals, int **tmal_ints, float **tmal_floats)
+        self.kernel.run(j0=j0)
+
+    def _make_chunk_model(self, times, j0):
+        """Make a model that covers ``times`` with the same components,
+        parameter values and input data as this model, where ``times`` start
+        at model time index ``j0`` and may extend past the model stop.
 
-        mvals = convert_type_star_star(self.mvals, ctypes.c_double)
-        tmal_ints = convert_type_star_star(self.tmal_ints, ctypes.c_int)
-        tmal_floats = convert_type_star_star(self.tmal_floats, ctypes.c_double)
+        Parameters
+        ----------
+        times :
+            chunk times (CXC secs)
+        j0 :
+            model time index of the first chunk time
+
+        Returns
+        -------
+        XijaModel
+        """
+        j1 = j0 + len(times)
+        chunk = self.__class__(self.name, start=times[0], stop=times[-1],
+                               dt=self.dt, model_spec=self.model_spec,
+                               evolve_method=self.evolve_method, rk4=self.rk4,
+                               jit=self.jit, mvals_layout=self.mvals_layout,
+                               dtype=self.dtype, backend=self.backend,
+                               provider=self.provider)
+        chunk._set_times(times)
+        chunk.bad_times_indices = chunk._get_times_indices(chunk.bad_times)
+        chunk.mask_times = self.mask_times.copy()
+        chunk.mask_times_indices = chunk._get_times_indices(chunk.mask_times)
+        chunk.mask_time_secs = date2secs(chunk.mask_times)
+
+        if hasattr(self, '_cmd_states') and len(self._cmd_states) >= j1:
+            chunk._cmd_states = self._cmd_states[j0:j1]
+
+        for comp in self.comps:
+            if comp.data is None:
+                continue
+            data = comp.data
+            if isinstance(data, np.ndarray) and comp.data_times is None:
+                # Data values at the model times
+                if len(data) < j1:
+                    raise ValueError('data for {} component do not span the '
+                                     'chunk times'.format(comp))
+                data = data[j0:j1]
+            chunk.comp[comp.name].set_data(data, comp.data_times)
+
+        return chunk
+
+    def iter_calc(self, chunk_days=30.0):
+        """Calculate the model in chunks of ``chunk_days`` and yield the model
+        times and values for each chunk.
+
+        Each chunk is a separate model covering the chunk times, so the input
+        data, ``dvals`` and ``mvals`` are only ever held for one chunk at a
+        time and long runs have bounded memory.  The predicted node values at
+        the end of each chunk are carried over as the initial state for the
+        next one, so the concatenated chunks give the same result as
+        ``calc()`` for the full time range.  This model does not need to be
+        made with ``make()`` first.
+
+        Parameters
+        ----------
+        chunk_days :
+            chunk duration (days, default=30)
+
+        Yields
+        ------
+        tuple
+            (times, mvals) for each chunk, where ``mvals`` is the
+            (n_comps, n_chunk_times) block of model values
+        """
+        # Use an even number of steps per chunk so the evolve_method=1 step
+        # pairs line up with those of the full model
+        n_chunk = int(round(chunk_days * 86400.0 / self.dt / 2)) * 2
+        n_chunk = max(n_chunk, 2)
+
+        state = None
+        j0 = 0
+        while True:
+            # Each chunk extends two times past the start of the next chunk so
+            # that the carried state is fully computed (calc() copies the
+            # second to last column into the last one)
+            last = j0 + n_chunk + 2 >= self.n_times
+            j1 = self.n_times if last else j0 + n_chunk + 2
+            chunk = self._make_chunk_model(self.times[j0:j1], j0)
+            chunk.make()
+            if state is not None:
+                chunk.mvals[:chunk.n_preds, 0] = state
+            chunk.calc()
+
+            if last:
+                yield chunk.times, chunk.mvals
+                break
+
+            state = chunk.mvals[:chunk.n_preds, n_chunk].copy()
+            yield chunk.times[:n_chunk], chunk.mvals[:, :n_chunk]
+            j0 += n_chunk
+
+    def calc_batch(self, parvals):
+        """Calculate the model for an ensemble of parameter vectors.
+
+        Each row of ``parvals`` is a full set of model parameter values (in
+        the order of ``self.parnames``).  The precomputed mvals and TMAL floats
+        for every ensemble member are generated in Python and then all members
+        are integrated in a single call to the C core, which parallelizes over
+        members.  The model parameter values and mvals are restored to their
+        original state afterward.
+
+        Parameters
+        ----------
+        parvals :
+            (n_members, n_pars) array of parameter values
+
+        Returns
+        -------
+        ndarray
+            (n_members, n_preds, n_times) array of predicted node values
+        """
+        parvals = np.atleast_2d(np.asarray(parvals, dtype=np.float64))
+        if parvals.shape[1] != len(self.pars):
+            raise ValueError('Length mismatch setting parvals {} vs {}'.format(
+                    len(self.pars), parvals.shape[1]))
 
+        n_members = len(parvals)
+        orig_parvals = self.parvals
+        self.make_tmal()
+        mvals = np.empty((n_members,) + self.mvals.shape, dtype=self.dtype)
+        tmal_floats = np.empty((n_members,) + self.tmal_floats.shape,
+                               dtype=self.dtype)
+        try:
+            for i, vals in enumerate(parvals):
+                self.parvals = vals
+                self.make_tmal()
+                mvals[i] = self.mvals
+                tmal_floats[i] = self.tmal_floats
+        finally:
+            self.parvals = orig_parvals
+            self.make_tmal()
+
+        tmal_ints = np.ascontiguousarray(self.tmal_ints, dtype=np.int32)
+        n_comps = self.mvals.shape[0]
+        single = self.dtype == np.float32
         if self.evolve_method == 1:
             dt = self.dt_ksec * 2
-            self.core_1.calc_model_1(self.n_times, self.n_preds,
-                                     len(self.tmal_ints), dt, mvals,
-                                     tmal_ints, tmal_floats)
+            calc_model_1_batch = (self.core_1.calc_model_1_batch_f if single
+                                  else self.core_1.calc_model_1_batch)
+            status = calc_model_1_batch(
+                n_members, self.n_times, n_comps, self.n_preds,
+                len(tmal_ints), tmal.N_INTS, tmal.N_FLOATS, dt,
+                mvals, tmal_ints, tmal_floats)
         elif self.evolve_method == 2:
             dt = self.dt_ksec
-            self.core_2.calc_model_2(self.rk4, self.n_times, self.n_preds,
-                                     len(self.tmal_ints), dt, mvals,
-                                     tmal_ints, tmal_floats)
+            calc_model_2_batch = (self.core_2.calc_model_2_batch_f if single
+                                  else self.core_2.calc_model_2_batch)
+            status = calc_model_2_batch(
+                self.rk4, n_members, self.n_times, n_comps, self.n_preds,
+                len(tmal_ints), tmal.N_INTS, tmal.N_FLOATS, dt,
+                mvals, tmal_ints, tmal_floats)
+        else:
+            raise ValueError('calc_batch not supported for evolve_method={}'
+                             .format(self.evolve_method))
+        if status != 0:
+            raise MemoryError('failed to allocate memory in calc_batch')
+
+        # Same hackish fix as calc() to ensure last value is computed
+        mvals[:, :, -1] = mvals[:, :, -2]
 
-        # hackish fix to ensure last value is computed
+        return mvals[:, :self.n_preds, :].copy()
+
+    def calc_sensitivity(self):
+        """Calculate the model together with the sensitivities of the model
+        values to the thawed parameters.
+
+        The tangent-linear equations of the ODE solver are integrated along
+        with the model state, so the result is the derivative of the model
+        values computed by ``calc()``.  Only ``evolve_method`` 1 and 2 are
+        supported.  The model values appear in the self.mvals array as for
+        ``calc()``.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        ndarray
+            (n_thawed_pars, n_comps, n_times) array of d(mvals)/d(par)
+        """
+        if self.evolve_method not in (1, 2):
+            raise ValueError('calc_sensitivity not supported for evolve_method={}'
+                             .format(self.evolve_method))
+        if self.dtype != np.float64:
+            raise ValueError('gradients require dtype=float64')
+
+        pars = [par for par in self.pars if not par.frozen]
+        self.make_tmal()
+        dfloats, dmvals = sensitivity.get_par_derivs(self, pars)
+        if self.evolve_method == 1:
+            sensitivity.calc_sens_1(self.n_times, self.n_preds, self.dt_ksec * 2,
+                                    self.tmal_ints, self.tmal_floats, dfloats,
+                                    self.mvals, dmvals)
+        else:
+            sensitivity.calc_sens_2(self.rk4, self.n_times, self.n_preds,
+                                    self.dt_ksec, self.tmal_ints,
+                                    self.tmal_floats, dfloats, self.mvals,
+                                    dmvals)
+
+        # Same hackish fix as calc() to ensure last value is computed
         self.mvals[:, -1] = self.mvals[:, -2]
+        dmvals[:, :, -1] = dmvals[:, :, -2]
+
+        return dmvals
+
+    @profiled('fit_stat')
+    def calc_stat(self, grad=False, grad_method='adjoint'):
+        """Calculate model fit statistic as the sum of component fit stats
+
+        Parameters
+        ----------
+        grad :
+            also return the gradient of the fit statistic with respect to the
+            thawed parameters (default=False)
+        grad_method :
+            'adjoint' for a backward pass over the model values, whose cost
+            does not depend on the number of thawed parameters, or 'forward'
+            to use ``calc_sensitivity()`` (default='adjoint')
 
-    def calc_stat(self):
-        """Calculate model fit statistic as the sum of component fit stats"""
-        self.calc()            # parvals already set with dummy_calc
-        fit_stat = sum(comp.calc_stat() for comp in self.comps if comp.predict)
-        return fit_stat
+        Returns
+        -------
+        float or tuple
+            fit statistic, or (fit statistic, gradient) if ``grad`` is True
+        """
+        comps = [comp for comp in self.comps if comp.predict]
+        if not grad:
+            self.calc()            # parvals already set with dummy_calc
+            fit_stat = sum(comp.calc_stat() for comp in comps)
+            return fit_stat
+
+        if self.dtype != np.float64:
+            raise ValueError('gradients require dtype=float64')
+        pars = [par for par in self.pars if not par.frozen]
+        if grad_method == 'forward':
+            dmvals = self.calc_sensitivity()
+            fit_stat = sum(comp.calc_stat() for comp in comps)
+            fit_grad = np.zeros(len(pars))
+            for comp in comps:
+                fit_grad += comp.calc_stat_grad(dmvals[:, comp.mvals_i])
+        elif grad_method == 'adjoint':
+            if self.evolve_method not in (1, 2):
+                raise ValueError('adjoint gradient not supported for '
+                                 'evolve_method={}'.format(self.evolve_method))
+            self.calc()
+            fit_stat = sum(comp.calc_stat() for comp in comps)
+            mvals_grad = np.zeros(self.mvals.shape)
+            for comp in comps:
+                mvals_grad[comp.mvals_i] = comp.calc_stat_mvals_grad()
+            fit_grad = adjoint.calc_adjoint_grad(self, pars, mvals_grad)
+        else:
+            raise ValueError("grad_method must be 'adjoint' or 'forward'")
+
+        return fit_stat, fit_grad
 
     def calc_staterror(self, data):
         """Calculate model fit statistic error (dummy array for Sherpa use)
@@ -742,7 +1461,49 @@ class XijaModel(object):
             _core_1.calc_model_1.argtypes = [
                 ctypes.c_int, ctypes.c_int, ctypes.c_int,
                 ctypes.c_double,
-                ctypes.POINTER(ctypes.POINTER(ctypes.c_double)),
+                ctypes.POINTER(ctypes.c_double), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
+                ]
+            _core_1.calc_model_1_f.restype = ctypes.c_int
+            _core_1.calc_model_1_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_double,
+                ctypes.POINTER(ctypes.c_float), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_float))
+                ]
+            _core_1.calc_model_1_batch.restype = ctypes.c_int
+            _core_1.calc_model_1_batch.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_double,
+                np.ctypeslib.ndpointer(np.float64, ndim=3, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.int32, ndim=2, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.float64, ndim=3, flags='C_CONTIGUOUS')
+                ]
+            _core_1.calc_model_1_batch_f.restype = ctypes.c_int
+            _core_1.calc_model_1_batch_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_double,
+                np.ctypeslib.ndpointer(np.float32, ndim=3, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.int32, ndim=2, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.float32, ndim=3, flags='C_CONTIGUOUS')
+                ]
+            _core_1.calc_model_1_soa.restype = ctypes.c_int
+            _core_1.calc_model_1_soa.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_double,
+                ctypes.POINTER(ctypes.c_double), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.c_int),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
+                ]
+            _core_1.calc_model_1_soa_f.restype = ctypes.c_int
+            _core_1.calc_model_1_soa_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_double,
+                ctypes.POINTER(ctypes.c_float), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.c_int),
                 ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
                 ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
                 ]
@@ -769,7 +1530,49 @@ class XijaModel(object):
             _core_2.calc_model_2.argtypes = [
                 ctypes.c_int, ctypes.c_int, ctypes.c_int,
                 ctypes.c_int, ctypes.c_double,
-                ctypes.POINTER(ctypes.POINTER(ctypes.c_double)),
+                ctypes.POINTER(ctypes.c_double), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
+            ]
+            _core_2.calc_model_2_f.restype = ctypes.c_int
+            _core_2.calc_model_2_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, ctypes.c_double,
+                ctypes.POINTER(ctypes.c_float), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_float))
+            ]
+            _core_2.calc_model_2_batch.restype = ctypes.c_int
+            _core_2.calc_model_2_batch.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_double,
+                np.ctypeslib.ndpointer(np.float64, ndim=3, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.int32, ndim=2, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.float64, ndim=3, flags='C_CONTIGUOUS')
+            ]
+            _core_2.calc_model_2_batch_f.restype = ctypes.c_int
+            _core_2.calc_model_2_batch_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_double,
+                np.ctypeslib.ndpointer(np.float32, ndim=3, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.int32, ndim=2, flags='C_CONTIGUOUS'),
+                np.ctypeslib.ndpointer(np.float32, ndim=3, flags='C_CONTIGUOUS')
+            ]
+            _core_2.calc_model_2_soa.restype = ctypes.c_int
+            _core_2.calc_model_2_soa.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_double,
+                ctypes.POINTER(ctypes.c_double), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.c_int),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
+                ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
+            ]
+            _core_2.calc_model_2_soa_f.restype = ctypes.c_int
+            _core_2.calc_model_2_soa_f.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_double,
+                ctypes.POINTER(ctypes.c_float), ctypes.c_long, ctypes.c_long,
+                ctypes.POINTER(ctypes.c_int),
                 ctypes.POINTER(ctypes.POINTER(ctypes.c_int)),
                 ctypes.POINTER(ctypes.POINTER(ctypes.c_double))
             ]
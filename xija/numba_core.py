@@ -0,0 +1,203 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Numba implementation of the TMAL program interpreter and integrators.
+
+``dTdt`` mirrors ``dTdt`` in core_2.c and is used by the integrators that are
+written in Python (e.g. the implicit solver) so that they work directly on the
+same ``mvals``, ``tmal_ints`` and ``tmal_floats`` arrays as the C cores.
+``calc_model_1`` and ``calc_model_2`` reproduce the C cores step for step, so
+``NumbaKernel`` (the ``'numba'`` backend) gives the same results without any
+compiled extension.
+"""
+import numpy as np
+from numba import njit
+
+__all__ = ['dTdt', 'calc_model_1', 'calc_model_2', 'NumbaKernel']
+
+
+@njit(cache=True)
+def dTdt(j, w, write, n_preds, tmal_ints, tmal_floats, mvals, deriv, y):
+    """Compute the derivative ``deriv`` of the predicted node values ``y``.
+
+    Input mvals are linearly interpolated a fraction ``w`` of the way from
+    column ``j`` to column ``j + 1``.  If ``write`` is True then the active
+    heater powers are stored in mvals column ``j`` (as done in the C cores at
+    the start of each step).
+
+    Parameters
+    ----------
+    j :
+        mvals column at the start of the step
+    w :
+        fractional position within the step (0 <= w <= 1)
+    write :
+        store active heater powers in mvals
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    mvals :
+        model mvals array
+    deriv :
+        output derivative array (length n_preds)
+    y :
+        predicted node values (length n_preds)
+
+    Returns
+    -------
+
+    """
+    for i in range(n_preds):
+        deriv[i] = 0.0
+
+    for i in range(tmal_ints.shape[0]):
+        opcode = tmal_ints[i, 0]
+        i1 = tmal_ints[i, 1]
+        i2 = tmal_ints[i, 2]
+
+        if w == 0.0:
+            mvals_i2 = mvals[i2, j]
+        elif w == 0.5:
+            mvals_i2 = 0.5 * (mvals[i2, j] + mvals[i2, j + 1])
+        else:
+            mvals_i2 = (1.0 - w) * mvals[i2, j] + w * mvals[i2, j + 1]
+
+        if opcode == 0:  # Node to node coupling
+            if i1 < n_preds:
+                if i2 < n_preds:
+                    deriv[i1] += (y[i2] - y[i1]) / tmal_floats[i, 0]
+                else:
+                    deriv[i1] += (mvals_i2 - y[i1]) / tmal_floats[i, 0]
+        elif opcode == 1:  # heat sink (coupling to fixed temperature)
+            if i1 < n_preds:
+                deriv[i1] += (tmal_floats[i, 0] - y[i1]) / tmal_floats[i, 1]
+        elif opcode == 2:  # precomputed heat
+            if i1 < n_preds:
+                deriv[i1] += mvals_i2
+        elif opcode == 3 or opcode == 4:  # active heaters
+            dt2 = tmal_floats[i, 0] - (y[i2] if i2 < n_preds else mvals_i2)
+            if dt2 > 0:
+                if opcode == 3:  # proportional
+                    heat = tmal_floats[i, 1] * dt2
+                else:  # thermostatic
+                    heat = tmal_floats[i, 1]
+                if i1 < n_preds:
+                    deriv[i1] += heat
+            else:
+                heat = 0.0
+            if write:
+                mvals[tmal_ints[i, 3], j] = heat
+
+
+@njit(cache=True)
+def calc_model_1(n_times, n_preds, dt, tmal_ints, tmal_floats, mvals):
+    """Integrate the model with the evolve_method=1 scheme of core_1.c.
+    ``dt`` is the two-step time step as used by the C core."""
+    y = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    for j0 in range(0, n_times - 2, 2):
+        for i in range(n_preds):
+            y[i] = mvals[i, j0]
+        dTdt(j0, 0.0, True, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            y[i] = y[i] + dt * deriv[i] / 2.0
+        dTdt(j0 + 1, 0.0, True, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            k2 = dt * deriv[i]
+            mvals[i, j0 + 1] = y[i] + k2 / 2.0
+            mvals[i, j0 + 2] = y[i] + k2
+
+
+@njit(cache=True)
+def calc_model_2(rk4, n_times, n_preds, dt, tmal_ints, tmal_floats, mvals):
+    """Integrate the model with the RK2 / RK4 scheme of core_2.c."""
+    one_sixth = 1.0 / 6.0
+    y = np.zeros(n_preds)
+    yh = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    k1 = np.zeros(n_preds)
+    k2 = np.zeros(n_preds)
+    k3 = np.zeros(n_preds)
+    for j in range(n_times - 1):
+        for i in range(n_preds):
+            y[i] = mvals[i, j]
+        dTdt(j, 0.0, True, n_preds, tmal_ints, tmal_floats, mvals, deriv, y)
+        for i in range(n_preds):
+            k1[i] = dt * deriv[i]
+            yh[i] = y[i] + 0.5 * k1[i]
+        dTdt(j, 0.5, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, yh)
+        for i in range(n_preds):
+            k2[i] = dt * deriv[i]
+        if rk4 == 0:
+            for i in range(n_preds):
+                mvals[i, j + 1] = y[i] + k2[i]
+            continue
+
+        for i in range(n_preds):
+            yh[i] = y[i] + 0.5 * k2[i]
+        dTdt(j, 0.5, False, n_preds, tmal_ints, tmal_floats, mvals, deriv, yh)
+        for i in range(n_preds):
+            k3[i] = dt * deriv[i]
+            yh[i] = y[i] + k3[i]
+        dTdt(j + 1, 0.0, True, n_preds, tmal_ints, tmal_floats, mvals, deriv, yh)
+        for i in range(n_preds):
+            k4 = dt * deriv[i]
+            mvals[i, j + 1] = y[i] + one_sixth * (k1[i] + 2.0 * (k2[i] + k3[i]) + k4)
+
+
+class NumbaKernel(object):
+    """Prepared handle for integrating a model with the numba versions of the
+    C cores (``backend='numba'``).  This supports ``evolve_method`` 1 and 2
+    and needs no compiled extension.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object with ``mvals``, ``tmal_ints`` and ``tmal_floats``
+
+    Returns
+    -------
+
+    """
+    evolve_methods = (1, 2)
+
+    def __init__(self, model):
+        self.model = model
+        self.mvals = model.mvals
+        self.tmal_ints = model.tmal_ints
+        self.tmal_floats = model.tmal_floats
+
+    @property
+    def is_current(self):
+        """True if the kernel buffers are still the ones used by the model"""
+        model = self.model
+        return (self.mvals is model.mvals
+                and self.tmal_ints is model.tmal_ints
+                and self.tmal_floats is model.tmal_floats)
+
+    def run(self, j0=0):
+        """Integrate the model using the current contents of the buffers.  The
+        results appear in the model ``mvals`` array.
+
+        Parameters
+        ----------
+        j0 :
+            mvals column holding the initial state (default=0)
+
+        Returns
+        -------
+
+        """
+        model = self.model
+        mvals = self.mvals[:, j0:] if j0 else self.mvals
+        if model.evolve_method == 1:
+            calc_model_1(model.n_times - j0, model.n_preds, model.dt_ksec * 2,
+                         self.tmal_ints, self.tmal_floats, mvals)
+        else:
+            calc_model_2(model.rk4, model.n_times - j0, model.n_preds,
+                         model.dt_ksec, self.tmal_ints, self.tmal_floats, mvals)
+
+        # hackish fix to ensure last value is computed
+        self.mvals[:, -1] = self.mvals[:, -2]
@@ -0,0 +1,188 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Opt-in profiling of the phases of a model evaluation.
+
+A ``Profiler`` accumulates the wall time and number of calls of each phase
+(``make_mvals``, ``make_tmal``, component ``update``, ``kernel_setup`` for
+building the kernel and its ctypes pointer tables, ``integrate`` for the ODE
+solver, ``calc_stat``, ``prefetch`` and ``fetch``), both overall and per model
+component.  Computing component ``dvals`` is not timed separately but is
+included in the phase that first needs them, e.g. ``make_mvals`` or the
+component ``update``.  Optionally every call is also recorded as a Chrome
+trace event so that a whole fitting session can be inspected in a trace
+viewer such as ``chrome://tracing`` or Perfetto.
+
+Profiling is enabled per model with ``XijaModel.enable_profiling()``.  When
+disabled the model ``profiler`` attribute is None and the instrumented code
+paths only check that attribute.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from astropy.table import Table
+
+__all__ = ['Profiler', 'profiled']
+
+
+class Profiler(object):
+    """Accumulate wall time and call counts of model evaluation phases.
+
+    Times of nested phases are inclusive, e.g. the ``make_tmal`` time includes
+    the ``update`` times of all components.
+
+    Parameters
+    ----------
+    trace :
+        record each call as a Chrome trace event (default=True)
+
+    Returns
+    -------
+
+    """
+    def __init__(self, trace=True):
+        self.trace = trace
+        self.reset()
+
+    def reset(self):
+        """Clear all accumulated statistics and trace events."""
+        self.stats = {}
+        self.events = []
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name, comp=None):
+        """Context manager to time one call of phase ``name``.
+
+        Parameters
+        ----------
+        name :
+            phase name
+        comp :
+            name of the model component (default=None)
+
+        Returns
+        -------
+
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, comp, t0, time.perf_counter())
+
+    def add(self, name, comp, t0, t1):
+        """Record one call of phase ``name`` running from ``t0`` to ``t1``
+        (``time.perf_counter()`` values).
+
+        Parameters
+        ----------
+        name :
+            phase name
+        comp :
+            name of the model component or None
+        t0 :
+            start time (sec)
+        t1 :
+            stop time (sec)
+
+        Returns
+        -------
+
+        """
+        stat = self.stats.setdefault((name, comp), [0, 0.0])
+        stat[0] += 1
+        stat[1] += t1 - t0
+        if self.trace:
+            event = {'name': name if comp is None else '{} {}'.format(name, comp),
+                     'cat': name,
+                     'ph': 'X',
+                     'ts': (t0 - self.t0) * 1e6,
+                     'dur': (t1 - t0) * 1e6,
+                     'pid': os.getpid(),
+                     'tid': threading.get_ident()}
+            if comp is not None:
+                event['args'] = {'comp': comp}
+            self.events.append(event)
+
+    def report(self):
+        """Return a table of the accumulated statistics, sorted by total time.
+
+        Rows with an empty ``comp`` are the totals of each phase over all
+        components.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        Table
+            columns phase, comp, n_calls, total (sec) and mean (sec)
+        """
+        totals = {}
+        for (name, comp), (n_calls, total) in self.stats.items():
+            if comp is not None:
+                phase_total = totals.setdefault((name, None), [0, 0.0])
+                phase_total[0] += n_calls
+                phase_total[1] += total
+        rows = dict(totals)
+        rows.update(self.stats)
+
+        keys = sorted(rows, key=lambda key: (-rows[key][1], key[0], key[1] or ''))
+        n_calls = np.array([rows[key][0] for key in keys], dtype=int)
+        total = np.array([rows[key][1] for key in keys], dtype=float)
+        out = Table([[key[0] for key in keys], [key[1] or '' for key in keys],
+                     n_calls, total, total / np.maximum(n_calls, 1)],
+                    names=['phase', 'comp', 'n_calls', 'total', 'mean'])
+        out['total'].format = '.6f'
+        out['mean'].format = '.3e'
+        return out
+
+    def write_trace(self, filename):
+        """Write the recorded calls in Chrome trace-event JSON format.
+
+        Parameters
+        ----------
+        filename :
+            output file name
+
+        Returns
+        -------
+
+        """
+        if not self.trace:
+            raise ValueError('profiler was created with trace=False')
+        with open(filename, 'w') as fh:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, fh)
+
+
+def profiled(name, comp=False):
+    """Decorator to time a method as phase ``name`` when the ``profiler``
+    attribute of the instance is not None.
+
+    Parameters
+    ----------
+    name :
+        phase name
+    comp :
+        record the time per component using ``str(self)`` (default=False)
+
+    Returns
+    -------
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            profiler = self.profiler
+            if profiler is None:
+                return func(self, *args, **kwargs)
+            with profiler.phase(name, str(self) if comp else None):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,331 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Providers of the telemetry and commanded states inputs of a model.
+
+``XijaModel.fetch()`` and ``XijaModel.cmd_states`` get their inputs from the
+model ``provider``, an object with the methods:
+
+- ``fetch(msid, tstart, tstop, stat)``: return telemetry with a ``times``
+  attribute and the MSID attributes in its ``colnames`` list (``vals``, ...)
+- ``get_cmd_states(tstart, tstop, times)``: return the commanded states as a
+  structured array with one row for each of ``times``
+
+The built-in providers are:
+
+- ``EngArchiveProvider``: Ska engineering archive and kadi commanded states
+- ``CachedProvider``: telemetry of another provider kept in a persistent
+  ``xija.cache.TelemetryCache``
+- ``FileProvider``: columnar files in a local directory, e.g. recorded with
+  ``FileProvider.write_msid()`` for replay without archive access
+
+When no provider is given to the model, ``get_default_provider()`` returns a
+``FileProvider`` for the ``XIJA_DATA_DIR`` environment variable if that is set,
+and otherwise an ``EngArchiveProvider`` which is wrapped in a
+``CachedProvider`` if the telemetry cache is enabled (see ``xija.cache``).
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+from Chandra.Time import DateTime
+
+from . import cache
+from . import clogging
+
+__all__ = ['EngArchiveProvider', 'CachedProvider', 'FileProvider',
+           'get_default_provider']
+
+logger = clogging.config_logger('xija', level=clogging.INFO)
+
+# Root directory of a FileProvider used by default when set
+DATA_DIR = os.environ.get('XIJA_DATA_DIR') or None
+
+
+class EngArchiveProvider(object):
+    """Telemetry from the Ska engineering archive and commanded states from
+    kadi.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+
+    """
+    def fetch(self, msid, tstart, tstop, stat='5min'):
+        """Fetch telemetry for ``msid`` with bad times filtered.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tstart :
+            start time (CXC secs)
+        tstop :
+            stop time (CXC secs)
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+        MSID
+            Ska.engarchive MSID object
+        """
+        datestart = DateTime(tstart).date
+        datestop = DateTime(tstop).date
+        logger.info('Fetching msid: %s over %s to %s' %
+                    (msid, datestart, datestop))
+        try:
+            import Ska.engarchive.fetch_sci as fetch
+            tlm = fetch.MSID(msid, datestart, datestop, stat=stat)
+            tlm.filter_bad_times()
+        except ImportError:
+            raise ValueError('Ska.engarchive.fetch not available')
+        return tlm
+
+    def get_cmd_states(self, tstart, tstop, times):
+        """Get the kadi commanded states at ``times``.
+
+        Parameters
+        ----------
+        tstart :
+            start time (any DateTime format)
+        tstop :
+            stop time (any DateTime format)
+        times :
+            times (CXC secs) at which to interpolate the states
+
+        Returns
+        -------
+        ndarray
+            structured array of states
+        """
+        import kadi.commands.states as kadi_states
+        datestart = DateTime(tstart).date
+        datestop = DateTime(tstop).date
+        logger.info('Getting kadi commanded states over %s to %s' %
+                    (datestart, datestop))
+        states = kadi_states.get_states(datestart, datestop)
+        return kadi_states.interpolate_states(states, times).as_array()
+
+
+class CachedProvider(object):
+    """Provider that keeps the telemetry of ``provider`` in a persistent
+    telemetry cache, so that only the time ranges missing from the cache are
+    fetched from ``provider``.  Commanded states are not cached.
+
+    Parameters
+    ----------
+    provider :
+        provider of the telemetry (default=EngArchiveProvider())
+    tlm_cache :
+        TelemetryCache object or cache directory
+        (default=``xija.cache.get_telemetry_cache()``)
+
+    Returns
+    -------
+
+    """
+    def __init__(self, provider=None, tlm_cache=None):
+        self.provider = EngArchiveProvider() if provider is None else provider
+        if tlm_cache is None:
+            tlm_cache = cache.get_telemetry_cache()
+            if tlm_cache is None:
+                raise ValueError('telemetry cache is not enabled, set '
+                                 'XIJA_CACHE_DIR or provide tlm_cache')
+        elif not isinstance(tlm_cache, cache.TelemetryCache):
+            tlm_cache = cache.TelemetryCache(tlm_cache)
+        self.tlm_cache = tlm_cache
+
+    def fetch(self, msid, tstart, tstop, stat='5min'):
+        """Get telemetry for ``msid`` from the cache, fetching the missing
+        time ranges from the wrapped provider.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tstart :
+            start time (CXC secs)
+        tstop :
+            stop time (CXC secs)
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+        CachedMSID
+        """
+        return self.tlm_cache.fetch(msid, tstart, tstop, self.provider.fetch,
+                                    stat=stat)
+
+    def get_cmd_states(self, tstart, tstop, times):
+        """Get the commanded states at ``times`` from the wrapped provider.
+
+        Parameters
+        ----------
+        tstart :
+            start time (any DateTime format)
+        tstop :
+            stop time (any DateTime format)
+        times :
+            times (CXC secs) at which to interpolate the states
+
+        Returns
+        -------
+        ndarray
+            structured array of states
+        """
+        return self.provider.get_cmd_states(tstart, tstop, times)
+
+
+class FileProvider(object):
+    """Telemetry and commanded states read from columnar files in the
+    directory ``path``, with the layout::
+
+      <path>/<stat>/<msid>.npz        one array per MSID attribute, or
+      <path>/<stat>/<msid>/<attr>.npy one file per MSID attribute
+      <path>/cmd_states.npz           one array per state column, or
+      <path>/cmd_states/<col>.npy     one file per state column
+
+    MSID names are lower case.  Each MSID needs a sorted ``times`` column and
+    the commanded states need ``tstart`` and ``tstop`` columns.  The ``.npy``
+    columns are memory mapped so only the requested time range is read.
+
+    Parameters
+    ----------
+    path :
+        data directory
+
+    Returns
+    -------
+
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _read_columns(self, path):
+        """Read the columns of the ``.npz`` file or the directory of ``.npy``
+        files at ``path`` (without suffix).
+        """
+        if path.is_dir():
+            return {filename.stem: np.load(filename, mmap_mode='r', allow_pickle=False)
+                    for filename in sorted(path.glob('*.npy'))}
+        filename = path.with_suffix('.npz')
+        if not filename.exists():
+            raise ValueError('no data file {} or directory {}'.format(filename, path))
+        with np.load(filename, allow_pickle=False) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+
+    @staticmethod
+    def _write_columns(path, cols):
+        path.mkdir(parents=True, exist_ok=True)
+        for name, vals in cols.items():
+            np.save(path / (name + '.npy'), np.asarray(vals), allow_pickle=False)
+
+    def fetch(self, msid, tstart, tstop, stat='5min'):
+        """Read telemetry for ``msid`` from ``tstart`` to ``tstop``.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tstart :
+            start time (CXC secs)
+        tstop :
+            stop time (CXC secs)
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+        CachedMSID
+        """
+        cols = self._read_columns(self.path / stat / msid.lower())
+        if 'times' not in cols:
+            raise ValueError('no times column for {}'.format(msid))
+        i0, i1 = cache.get_time_slice(cols['times'], tstart, tstop)
+        return cache.CachedMSID(msid, stat, {name: np.asarray(vals[i0:i1])
+                                             for name, vals in cols.items()})
+
+    def get_cmd_states(self, tstart, tstop, times):
+        """Get the commanded states at ``times``.
+
+        Parameters
+        ----------
+        tstart :
+            start time (any DateTime format)
+        tstop :
+            stop time (any DateTime format)
+        times :
+            times (CXC secs) at which to interpolate the states
+
+        Returns
+        -------
+        ndarray
+            structured array of states
+        """
+        cols = self._read_columns(self.path / 'cmd_states')
+        if cols['tstart'][0] > times[0] or cols['tstop'][-1] < times[-1]:
+            raise ValueError('cmd_states in {} do not span {} to {}'
+                             .format(self.path, DateTime(tstart).date,
+                                     DateTime(tstop).date))
+        idxs = np.searchsorted(cols['tstop'], times)
+        idxs = np.clip(idxs, 0, len(cols['tstop']) - 1)
+        states = np.empty(len(times), dtype=[(name, vals.dtype)
+                                             for name, vals in cols.items()])
+        for name, vals in cols.items():
+            states[name] = vals[idxs]
+        return states
+
+    def write_msid(self, msid, tlm, stat='5min'):
+        """Write the telemetry ``tlm`` (e.g. fetched by another provider) as
+        one ``.npy`` file per MSID attribute.
+
+        Parameters
+        ----------
+        msid :
+            MSID name
+        tlm :
+            object with ``times`` and the attributes in ``colnames``
+        stat :
+            archive statistic (default='5min')
+
+        Returns
+        -------
+
+        """
+        self._write_columns(self.path / stat / msid.lower(),
+                            cache.get_columns(tlm))
+
+    def write_cmd_states(self, states):
+        """Write the commanded states ``states`` as one ``.npy`` file per column.
+
+        Parameters
+        ----------
+        states :
+            structured array of states with ``tstart`` and ``tstop`` columns
+
+        Returns
+        -------
+
+        """
+        self._write_columns(self.path / 'cmd_states',
+                            {name: states[name] for name in states.dtype.names})
+
+
+def get_default_provider():
+    """Return the provider used by models for which none is given.
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    provider
+    """
+    if DATA_DIR is not None:
+        return FileProvider(DATA_DIR)
+    if cache.get_telemetry_cache() is not None:
+        return CachedProvider()
+    return EngArchiveProvider()
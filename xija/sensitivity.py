@@ -0,0 +1,311 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Forward (tangent-linear) sensitivity integration for analytic gradients.
+
+Parameters enter the model ODE through the TMAL floats (time constants, heat
+sink temperatures, heater set points and gains) and the precomputed input
+rows of mvals (e.g. solar heating powers).  The derivatives of those with
+respect to each parameter are taken from the component ``update()`` methods
+by central differences, which is exact for the common case where they are
+linear in the parameter.  The tangent-linear equations of the explicit
+evolve_method 1 and 2 schemes are then integrated alongside the model state,
+so the sensitivities ``d(mvals)/d(par)`` are the exact derivatives of the
+discrete model values that ``calc()`` computes.
+"""
+import numpy as np
+from numba import njit
+
+__all__ = ['iter_par_derivs', 'get_par_derivs', 'calc_sens_1', 'calc_sens_2',
+           'dTdt_tl']
+
+
+def iter_par_derivs(model, pars, rel_step=1e-6):
+    """Iterate over the derivatives of the TMAL floats and the input
+    (non-predicted) mvals rows with respect to each of ``pars``.
+
+    Each parameter is perturbed by ``+/- rel_step * max(1, abs(val))`` and the
+    model ``make_tmal()`` is called to update the TMAL floats and the mvals
+    rows computed by the components.  The model is restored afterward.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object which has been made with ``make()``
+    pars :
+        list of Param objects
+    rel_step :
+        relative step size for central differences (default=1e-6)
+
+    Yields
+    ------
+    tuple
+        (dfloats, dmvals) with shapes (n_tmals, N_FLOATS) and
+        (n_comps - n_preds, n_times)
+    """
+    n_preds = model.n_preds
+    try:
+        for par in pars:
+            val = par.val
+            step = rel_step * max(1.0, abs(val))
+            try:
+                par.val = val + step
+                model.make_tmal()
+                floats_hi = model.tmal_floats.copy()
+                mvals_hi = model.mvals[n_preds:].copy()
+
+                par.val = val - step
+                model.make_tmal()
+                dfloats = (floats_hi - model.tmal_floats) / (2 * step)
+                dmvals = (mvals_hi - model.mvals[n_preds:]) / (2 * step)
+            finally:
+                par.val = val
+            yield dfloats, dmvals
+    finally:
+        model.make_tmal()
+
+
+def get_par_derivs(model, pars, rel_step=1e-6):
+    """Derivatives of the TMAL floats and mvals with respect to each of
+    ``pars``.  See ``iter_par_derivs()``.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object which has been made with ``make()``
+    pars :
+        list of Param objects
+    rel_step :
+        relative step size for central differences (default=1e-6)
+
+    Returns
+    -------
+    tuple
+        (dfloats, dmvals) with shapes (n_pars, n_tmals, N_FLOATS) and
+        (n_pars, n_comps, n_times).  The predicted rows of ``dmvals`` are zero.
+    """
+    n_preds = model.n_preds
+    dfloats = np.zeros((len(pars),) + model.tmal_floats.shape)
+    dmvals = np.zeros((len(pars),) + model.mvals.shape)
+    for i, derivs in enumerate(iter_par_derivs(model, pars, rel_step)):
+        dfloats[i], dmvals[i, n_preds:] = derivs
+
+    return dfloats, dmvals
+
+
+@njit(cache=True)
+def _at(row, j, w):
+    if w == 0.0:
+        return row[j]
+    if w == 0.5:
+        return 0.5 * (row[j] + row[j + 1])
+    return (1.0 - w) * row[j] + w * row[j + 1]
+
+
+@njit(cache=True)
+def dTdt_tl(j, w, write, n_preds, tmal_ints, tmal_floats, dfloats, mvals,
+            dmvals, y, dy, deriv, dderiv):
+    """Tangent-linear version of ``xija.numba_core.dTdt``.
+
+    Computes the derivative ``deriv`` of the predicted node values ``y`` and
+    its sensitivities ``dderiv`` given the sensitivities ``dy`` of ``y``.
+    The active heater on/off switching is not differentiated (the heater
+    power derivative is taken on the current side of the set point).
+
+    Parameters
+    ----------
+    j :
+        mvals column at the start of the step
+    w :
+        fractional position within the step (0 <= w <= 1)
+    write :
+        store active heater powers and their sensitivities
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    tmal_floats :
+        (n_tmals, N_FLOATS) array of TMAL float values
+    dfloats :
+        (n_pars, n_tmals, N_FLOATS) derivatives of ``tmal_floats``
+    mvals :
+        model mvals array
+    dmvals :
+        (n_pars, n_comps, n_times) sensitivities of ``mvals``
+    y :
+        predicted node values (length n_preds)
+    dy :
+        (n_pars, n_preds) sensitivities of ``y``
+    deriv :
+        output derivative array (length n_preds)
+    dderiv :
+        output (n_pars, n_preds) sensitivities of ``deriv``
+
+    Returns
+    -------
+
+    """
+    n_pars = dy.shape[0]
+    for i in range(n_preds):
+        deriv[i] = 0.0
+        for p in range(n_pars):
+            dderiv[p, i] = 0.0
+
+    for i in range(tmal_ints.shape[0]):
+        opcode = tmal_ints[i, 0]
+        i1 = tmal_ints[i, 1]
+        i2 = tmal_ints[i, 2]
+        f0 = tmal_floats[i, 0]
+        f1 = tmal_floats[i, 1]
+
+        if opcode == 0:  # Node to node coupling
+            if i1 < n_preds:
+                x2 = y[i2] if i2 < n_preds else _at(mvals[i2], j, w)
+                deriv[i1] += (x2 - y[i1]) / f0
+                for p in range(n_pars):
+                    dx2 = dy[p, i2] if i2 < n_preds else _at(dmvals[p, i2], j, w)
+                    dderiv[p, i1] += ((dx2 - dy[p, i1])
+                                      - (x2 - y[i1]) * dfloats[p, i, 0] / f0) / f0
+        elif opcode == 1:  # heat sink (coupling to fixed temperature)
+            if i1 < n_preds:
+                deriv[i1] += (f0 - y[i1]) / f1
+                for p in range(n_pars):
+                    dderiv[p, i1] += ((dfloats[p, i, 0] - dy[p, i1])
+                                      - (f0 - y[i1]) * dfloats[p, i, 1] / f1) / f1
+        elif opcode == 2:  # precomputed heat
+            if i1 < n_preds:
+                deriv[i1] += _at(mvals[i2], j, w)
+                for p in range(n_pars):
+                    dderiv[p, i1] += _at(dmvals[p, i2], j, w)
+        elif opcode == 3 or opcode == 4:  # active heaters
+            i3 = tmal_ints[i, 3]
+            dt2 = f0 - (y[i2] if i2 < n_preds else _at(mvals[i2], j, w))
+            heat = 0.0
+            if dt2 > 0:
+                heat = f1 * dt2 if opcode == 3 else f1
+                if i1 < n_preds:
+                    deriv[i1] += heat
+            if write:
+                mvals[i3, j] = heat
+            for p in range(n_pars):
+                dheat = 0.0
+                if dt2 > 0:
+                    if opcode == 3:
+                        dctrl = (dy[p, i2] if i2 < n_preds
+                                 else _at(dmvals[p, i2], j, w))
+                        dheat = dfloats[p, i, 1] * dt2 + f1 * (dfloats[p, i, 0] - dctrl)
+                    else:
+                        dheat = dfloats[p, i, 1]
+                    if i1 < n_preds:
+                        dderiv[p, i1] += dheat
+                if write:
+                    dmvals[p, i3, j] = dheat
+
+
+@njit(cache=True)
+def calc_sens_1(n_times, n_preds, dt, tmal_ints, tmal_floats, dfloats, mvals,
+                dmvals):
+    """Integrate the model and its sensitivities with the evolve_method=1
+    scheme of core_1.c.  ``dt`` is the two-step time step as used by the C
+    core.  Results are written to ``mvals`` and ``dmvals``.
+    """
+    n_pars = dfloats.shape[0]
+    y = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    dy = np.zeros((n_pars, n_preds))
+    dderiv = np.zeros((n_pars, n_preds))
+
+    for j0 in range(0, n_times - 2, 2):
+        for i in range(n_preds):
+            y[i] = mvals[i, j0]
+            for p in range(n_pars):
+                dy[p, i] = dmvals[p, i, j0]
+        dTdt_tl(j0, 0.0, True, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, y, dy, deriv, dderiv)
+        for i in range(n_preds):
+            y[i] = y[i] + dt * deriv[i] / 2.0
+            for p in range(n_pars):
+                dy[p, i] = dy[p, i] + dt * dderiv[p, i] / 2.0
+        dTdt_tl(j0 + 1, 0.0, True, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, y, dy, deriv, dderiv)
+        for i in range(n_preds):
+            k2 = dt * deriv[i]
+            mvals[i, j0 + 1] = y[i] + k2 / 2.0
+            mvals[i, j0 + 2] = y[i] + k2
+            for p in range(n_pars):
+                dk2 = dt * dderiv[p, i]
+                dmvals[p, i, j0 + 1] = dy[p, i] + dk2 / 2.0
+                dmvals[p, i, j0 + 2] = dy[p, i] + dk2
+
+
+@njit(cache=True)
+def calc_sens_2(rk4, n_times, n_preds, dt, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals):
+    """Integrate the model and its sensitivities with the RK2 / RK4 scheme of
+    core_2.c.  Results are written to ``mvals`` and ``dmvals``.
+    """
+    n_pars = dfloats.shape[0]
+    one_sixth = 1.0 / 6.0
+    y = np.zeros(n_preds)
+    yh = np.zeros(n_preds)
+    deriv = np.zeros(n_preds)
+    k1 = np.zeros(n_preds)
+    k2 = np.zeros(n_preds)
+    k3 = np.zeros(n_preds)
+    dy = np.zeros((n_pars, n_preds))
+    dyh = np.zeros((n_pars, n_preds))
+    dderiv = np.zeros((n_pars, n_preds))
+    dk1 = np.zeros((n_pars, n_preds))
+    dk2 = np.zeros((n_pars, n_preds))
+    dk3 = np.zeros((n_pars, n_preds))
+
+    for j in range(n_times - 1):
+        for i in range(n_preds):
+            y[i] = mvals[i, j]
+            for p in range(n_pars):
+                dy[p, i] = dmvals[p, i, j]
+
+        dTdt_tl(j, 0.0, True, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, y, dy, deriv, dderiv)
+        for i in range(n_preds):
+            k1[i] = dt * deriv[i]
+            yh[i] = y[i] + 0.5 * k1[i]
+            for p in range(n_pars):
+                dk1[p, i] = dt * dderiv[p, i]
+                dyh[p, i] = dy[p, i] + 0.5 * dk1[p, i]
+
+        dTdt_tl(j, 0.5, False, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, yh, dyh, deriv, dderiv)
+        for i in range(n_preds):
+            k2[i] = dt * deriv[i]
+            for p in range(n_pars):
+                dk2[p, i] = dt * dderiv[p, i]
+
+        if rk4 == 0:
+            for i in range(n_preds):
+                mvals[i, j + 1] = y[i] + k2[i]
+                for p in range(n_pars):
+                    dmvals[p, i, j + 1] = dy[p, i] + dk2[p, i]
+            continue
+
+        for i in range(n_preds):
+            yh[i] = y[i] + 0.5 * k2[i]
+            for p in range(n_pars):
+                dyh[p, i] = dy[p, i] + 0.5 * dk2[p, i]
+        dTdt_tl(j, 0.5, False, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, yh, dyh, deriv, dderiv)
+        for i in range(n_preds):
+            k3[i] = dt * deriv[i]
+            yh[i] = y[i] + k3[i]
+            for p in range(n_pars):
+                dk3[p, i] = dt * dderiv[p, i]
+                dyh[p, i] = dy[p, i] + dk3[p, i]
+
+        dTdt_tl(j + 1, 0.0, True, n_preds, tmal_ints, tmal_floats, dfloats,
+                mvals, dmvals, yh, dyh, deriv, dderiv)
+        for i in range(n_preds):
+            k4 = dt * deriv[i]
+            mvals[i, j + 1] = y[i] + one_sixth * (k1[i] + 2.0 * (k2[i] + k3[i]) + k4)
+            for p in range(n_pars):
+                dk4 = dt * dderiv[p, i]
+                dmvals[p, i, j + 1] = dy[p, i] + one_sixth * (
+                    dk1[p, i] + 2.0 * (dk2[p, i] + dk3[p, i]) + dk4)
@@ -0,0 +1,270 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Superposition response engine for fast what-if predictions.
+
+Without active heaters the predicted node values are linear in the initial
+state and in the input mvals rows (fixed node temperatures and precomputed
+heat powers).  The explicit ODE solvers are also invariant under a shift in
+time, by one time step for ``evolve_method=2`` and by two time steps for
+``evolve_method=1`` (which advances two steps per iteration).  So once the
+unit-impulse response of every predicted node to every input row has been
+integrated, the prediction for any input history is the free response (from
+the initial state and heat sinks with zero inputs) plus the sum of the
+convolutions of the inputs with those responses.
+
+The convolutions are done with FFTs, so a prediction for a long input history,
+e.g. an alternative pitch profile, costs O(n log n) per input instead of a new
+integration.  The responses are cached and only recomputed when the network
+(the coupling and heat sink parameters) changes.
+"""
+import numpy as np
+import scipy.fft
+
+from . import tmal
+from .linear import EXPLICIT_METHODS, LinearSystem, has_active_heaters
+
+__all__ = ['SuperpositionEngine']
+
+
+class SuperpositionEngine(object):
+    """Predict the model node values for new input histories by convolution
+    with cached unit-impulse responses.
+
+    The impulse responses are truncated once the slowest mode of the discrete
+    scheme has decayed by a factor ``tol``.  Only ``evolve_method`` 1 and 2
+    are supported, and the model must not include active heaters.
+
+    Example::
+
+      engine = SuperpositionEngine(model)
+      inputs = model.mvals[engine.input_rows].copy()
+      inputs[0] *= 1.1  # Alternative history for the first input
+      mvals = engine.predict(inputs)
+
+    Parameters
+    ----------
+    model :
+        XijaModel object which has been made with ``make()``
+    tol :
+        relative amplitude at which the impulse responses are truncated
+        (default=1e-12)
+
+    Returns
+    -------
+
+    """
+    def __init__(self, model, tol=1e-12):
+        if model.evolve_method not in (1, 2):
+            raise ValueError('SuperpositionEngine not supported for '
+                             'evolve_method={}'.format(model.evolve_method))
+        self.model = model
+        self.tol = tol
+        self._key = None
+        self._free_key = None
+        self._fft_resps = {}
+        self.update()
+
+    @property
+    def period(self):
+        """Number of time steps over which the ODE solver is shift invariant"""
+        return 2 if self.model.evolve_method == 1 else 1
+
+    def _get_program(self):
+        """Return the TMAL statements for the predicted nodes, with the input
+        mvals rows renumbered to follow the predicted rows, and the
+        LinearSystem of the network.
+        """
+        model = self.model
+        model.make_tmal()
+        if has_active_heaters(model.tmal_ints):
+            raise ValueError('model with active heaters is not linear')
+        n_preds = model.n_preds
+        keep = model.tmal_ints[:, 1] < n_preds
+        tmal_ints = np.array(model.tmal_ints[keep], dtype=np.int32)
+        tmal_floats = np.array(model.tmal_floats[keep], dtype=np.float64)
+        system = LinearSystem(tmal_ints, tmal_floats, n_preds)
+
+        opcodes, i2s = tmal_ints[:, 0], tmal_ints[:, 2]
+        inputs = np.isin(opcodes, (tmal.OPCODES['coupling'],
+                                   tmal.OPCODES['precomputed_heat'])) & (i2s >= n_preds)
+        tmal_ints[inputs, 2] = n_preds + np.searchsorted(system.input_rows, i2s[inputs])
+        return tmal_ints, tmal_floats, system
+
+    def _get_key(self, tmal_ints, tmal_floats):
+        model = self.model
+        return (tmal_ints.tobytes(), tmal_floats.tobytes(), model.evolve_method,
+                model.rk4, model.dt_ksec, model.n_times, self.tol)
+
+    @property
+    def is_current(self):
+        """True if the cached responses match the current model parameters"""
+        tmal_ints, tmal_floats, _ = self._get_program()
+        return self._key == self._get_key(tmal_ints, tmal_floats)
+
+    def _integrate(self, tmal_ints, tmal_floats, mvals):
+        """Integrate each member of ``mvals`` (n_members, n_rows, n_times) in
+        place with the C batch core.
+        """
+        model = self.model
+        n_members, n_rows, n_times = mvals.shape
+        tmal_floats = np.ascontiguousarray(
+            np.broadcast_to(tmal_floats, (n_members,) + tmal_floats.shape))
+        if model.evolve_method == 1:
+            status = model.core_1.calc_model_1_batch(
+                n_members, n_times, n_rows, model.n_preds, len(tmal_ints),
+                tmal.N_INTS, tmal.N_FLOATS, model.dt_ksec * 2, mvals,
+                tmal_ints, tmal_floats)
+        else:
+            status = model.core_2.calc_model_2_batch(
+                model.rk4, n_members, n_times, n_rows, model.n_preds,
+                len(tmal_ints), tmal.N_INTS, tmal.N_FLOATS, model.dt_ksec,
+                mvals, tmal_ints, tmal_floats)
+        if status != 0:
+            raise MemoryError('failed to allocate memory for the responses')
+
+    def get_response_length(self, system):
+        """Number of time steps after which the impulse responses of
+        ``system`` have decayed by ``tol``.
+
+        Parameters
+        ----------
+        system :
+            LinearSystem of the model network
+
+        Returns
+        -------
+        int
+        """
+        model = self.model
+        for evolve_method, rk4, stab_func in EXPLICIT_METHODS.values():
+            if (evolve_method, rk4) == (model.evolve_method, model.rk4):
+                break
+        step = model.dt_ksec * self.period
+        decay = np.max(np.abs(stab_func(np.linalg.eigvals(system.A) * step)))
+        if decay >= 1.0:
+            return model.n_times
+        n_steps = np.log(self.tol) / np.log(decay) * self.period
+        return int(min(np.ceil(n_steps) + self.period, model.n_times))
+
+    def update(self):
+        """Recompute the impulse responses if the network changed.
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+
+        """
+        tmal_ints, tmal_floats, system = self._get_program()
+        key = self._get_key(tmal_ints, tmal_floats)
+        if key == self._key:
+            return
+
+        n_preds = self.model.n_preds
+        n_inputs = len(system.input_rows)
+        period = self.period
+        n_resp = self.get_response_length(system)
+
+        # Member p * n_inputs + k has a unit impulse in input k at column
+        # period + p, with zero initial state and zero heat sink temperatures.
+        # The impulse is not at column 0 since the input at column j also
+        # enters the step from j - 1 to j.
+        mvals = np.zeros((period * n_inputs, n_preds + n_inputs, n_resp + 2 * period + 2))
+        for p in range(period):
+            for k in range(n_inputs):
+                mvals[p * n_inputs + k, n_preds + k, period + p] = 1.0
+        floats = tmal_floats.copy()
+        floats[tmal_ints[:, 0] == tmal.OPCODES['heatsink'], 0] = 0.0
+        self._integrate(tmal_ints, floats, mvals)
+
+        self.resps = np.array([mvals[p * n_inputs:(p + 1) * n_inputs, :n_preds,
+                                     period + p:period + p + n_resp]
+                               for p in range(period)])
+        self.input_rows = system.input_rows
+        self._program = (tmal_ints, tmal_floats)
+        self._fft_resps = {}
+        self._free_key = None
+        self._key = key
+
+    def get_free_response(self, init):
+        """Predicted node values for initial state ``init`` with all inputs
+        zero, which is cached for the last initial state.
+
+        Parameters
+        ----------
+        init :
+            initial values of the predicted nodes
+
+        Returns
+        -------
+        ndarray
+            (n_preds, n_times) array
+        """
+        init = np.asarray(init, dtype=np.float64)
+        if init.tobytes() != self._free_key:
+            model = self.model
+            tmal_ints, tmal_floats = self._program
+            mvals = np.zeros((1, model.n_preds + len(self.input_rows), model.n_times))
+            mvals[0, :model.n_preds, 0] = init
+            self._integrate(tmal_ints, tmal_floats, mvals)
+            self._free = mvals[0, :model.n_preds]
+            self._free_key = init.tobytes()
+        return self._free
+
+    def _get_fft_resps(self, n_fft):
+        if n_fft not in self._fft_resps:
+            self._fft_resps[n_fft] = scipy.fft.rfft(self.resps, n_fft)
+        return self._fft_resps[n_fft]
+
+    def predict(self, inputs=None, init=None):
+        """Predicted node values for the input history ``inputs``.
+
+        Several input histories can be given at once by stacking them along
+        leading axes of ``inputs``, which does all the FFTs in one call.
+
+        Parameters
+        ----------
+        inputs :
+            (..., n_inputs, n) array of values of the input mvals rows
+            ``self.input_rows`` at the first n <= n_times model times
+            (default=current model mvals)
+        init :
+            initial values of the predicted nodes (default=current model
+            mvals at the first time)
+
+        Returns
+        -------
+        ndarray
+            (..., n_preds, n) array of predicted node values
+        """
+        self.update()
+        model = self.model
+        if inputs is None:
+            inputs = model.mvals[self.input_rows]
+        inputs = np.asarray(inputs, dtype=np.float64)
+        n_times = inputs.shape[-1]
+        if (inputs.ndim < 2 or inputs.shape[-2] != len(self.input_rows)
+                or n_times > model.n_times):
+            raise ValueError('inputs must have shape (..., {}, n) with n <= {}'
+                             .format(len(self.input_rows), model.n_times))
+        if init is None:
+            init = model.mvals[:model.n_preds, 0]
+
+        n_fft = scipy.fft.next_fast_len(n_times + self.resps.shape[-1] - 1, real=True)
+        fft_resps = self._get_fft_resps(n_fft)
+        period = self.period
+        fft_out = 0.0
+        for p in range(period):
+            vals = inputs
+            if period > 1:
+                vals = np.zeros_like(inputs)
+                vals[..., p::period] = inputs[..., p::period]
+            fft_vals = scipy.fft.rfft(vals, n_fft)
+            fft_out = fft_out + np.einsum('...kf,kif->...if', fft_vals, fft_resps[p])
+        out = scipy.fft.irfft(fft_out, n_fft)[..., :n_times]
+        out += self.get_free_response(init)[:, :n_times]
+
+        # Same hackish fix as calc() to ensure last value is computed
+        out[..., -1] = out[..., -2]
+        return out
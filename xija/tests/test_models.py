@@ -2,12 +2,27 @@
 from __future__ import print_function
 
 import os
+import copy
+import json
+import pickle
 import tempfile
+import threading
 import numpy as np
 import pytest
 from pathlib import Path
 
-from xija import ThermalModel, Node, HeatSink, SolarHeat, Pitch, Eclipse, __version__
+from Chandra.Time import DateTime
+
+from xija import (ThermalModel, Node, HeatSink, HeatSinkRef, SolarHeat, StepFunctionPower,
+                  Pitch, Eclipse, Coupling, EarthHeat, TelemData, __version__)
+from xija import cache, providers, varpro, XijaModel
+import xija.model
+from xija.superposition import SuperpositionEngine
+from xija.backends import BACKENDS, register_backend
+from xija.kernel import CoreKernel, SoaKernel
+from xija.numba_core import NumbaKernel
+from xija.tmal import SOA_GROUPS, group_by_opcode
+from xija.component.heat import interpolation_weights
 from numpy import sin, cos, abs
 
 try:
@@ -139,6 +154,48 @@ def get_dpa_model():
     return mdl
 
 
+def ramp_pitch(mdl):
+    return np.linspace(60, 170, mdl.n_times)
+
+
+def wave_pitch(mdl):
+    times = (mdl.times - mdl.times[0]) / 10000.0
+    return 45.1 + 55 * (1 + sin(times / 2))
+
+
+def wave_eclipse(mdl):
+    times = (mdl.times - mdl.times[0]) / 10000.0
+    return cos(times) > 0.95
+
+
+def wave_T(mdl):
+    return 20.0 + 5 * np.sin(np.arange(mdl.n_times) / 50.0)
+
+
+def get_pftank2t_model(start='2012:001:12:00:00', stop='2012:006:12:00:00', T=10.0,
+                       pitch=ramp_pitch, eclipse=False, make=True, calc=True, **kwargs):
+    """pftank2t model with the node data ``T``, ``pitch`` and ``eclipse`` each
+    given as a value, a ``(data, times)`` tuple, a function of the model that
+    returns one of those, or None to fetch the telemetry.  ``kwargs`` are
+    passed to ThermalModel."""
+    mdl = ThermalModel('pftank2t', start=start, stop=stop,
+                       model_spec=abs_path('pftank2t.json'), **kwargs)
+    for names, data in ((('pftank2t', 'pf0tank2t'), T),
+                        (('pitch',), pitch),
+                        (('eclipse',), eclipse)):
+        if callable(data):
+            data = data(mdl)
+        if data is None:
+            continue
+        for name in names:
+            mdl.comp[name].set_data(*(data if isinstance(data, tuple) else (data,)))
+    if make:
+        mdl.make()
+        if calc:
+            mdl.calc()
+    return mdl
+
+
 def test_dpa():
     mdl = get_dpa_model()
     dpa = mdl.comp['1dpamzt']
@@ -296,3 +353,915 @@ def test_multi_solar_heat_values():
     assert mvals2[0] == 30.0
     assert abs(mvals2[500] - 15.8338) < 0.001
     assert abs(mvals2[1049] - 11.4947) < 0.001
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_calc_batch(evolve_method, rk4):
+    mdl = get_pftank2t_model(stop='2012:004:12:00:00', pitch=wave_pitch,
+                             eclipse=wave_eclipse, calc=False,
+                             evolve_method=evolve_method, rk4=rk4)
+
+    parvals0 = np.array(mdl.parvals)
+    parvals = np.array([parvals0, parvals0, parvals0])
+    i_P_60 = mdl.parnames.index('solarheat__pf0tank2t__P_60')
+    parvals[1, i_P_60] = 5.0
+    parvals[2, i_P_60] = -1.0
+
+    preds = mdl.calc_batch(parvals)
+    assert preds.shape == (3, mdl.n_preds, mdl.n_times)
+    assert np.all(np.array(mdl.parvals) == parvals0)
+
+    for vals, pred in zip(parvals, preds):
+        mdl.parvals = vals
+        mdl.calc()
+        assert np.allclose(mdl.mvals[:mdl.n_preds], pred, rtol=0, atol=1e-10)
+
+
+def test_kernel_reuse():
+    mdl = get_dpa_model()
+    kernel = mdl.kernel
+    mvals = mdl.comp['1dpamzt'].mvals.copy()
+
+    # Repeated calc() calls reuse the same prepared kernel and give the same answer
+    mdl.calc()
+    assert mdl.kernel is kernel
+    assert np.all(mdl.comp['1dpamzt'].mvals == mvals)
+
+    # Rebuilding the model layout gives a new kernel
+    mdl.make_mvals()
+    mdl.calc()
+    assert mdl.kernel is not kernel
+    assert np.allclose(mdl.comp['1dpamzt'].mvals, mvals)
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_jit_kernel(evolve_method, rk4, tmpdir, monkeypatch):
+    monkeypatch.setenv('XIJA_JIT_CACHE_DIR', str(tmpdir))
+    mvals = {}
+    for jit in (False, True):
+        mdl = get_pftank2t_model(stop='2012:004:12:00:00', pitch=wave_pitch,
+                                 eclipse=wave_eclipse, evolve_method=evolve_method,
+                                 rk4=rk4, jit=jit)
+        mvals[jit] = mdl.mvals.copy()
+
+    assert np.allclose(mvals[True], mvals[False], rtol=0, atol=1e-8)
+
+
+def test_evolve_method_3():
+    """Exponential integrator is exact for constant inputs and falls back to RK
+    for models with active heaters.
+    """
+    mvals = {}
+    for evolve_method, rk4 in ((2, 1), (3, 0)):
+        mdl = ThermalModel('minusz', start='2012:001:12:00:00', stop='2012:010:12:00:00',
+                           model_spec=abs_path('minusz.json'),
+                           evolve_method=evolve_method, rk4=rk4)
+        for msid in ('tephin', 'tcylaft6', 'tcylfmzm', 'tmzp_my', 'tfssbkt1'):
+            mdl.comp[msid].set_data(10.0)
+        mdl.comp['pitch'].set_data(120.0)
+        mdl.comp['eclipse'].set_data(False)
+        mdl.make()
+        mdl.calc()
+        mvals[evolve_method] = mdl.mvals[:mdl.n_preds].copy()
+
+    assert np.allclose(mvals[3], mvals[2], rtol=0, atol=1e-3)
+
+    mvals = {}
+    for evolve_method in (2, 3):
+        mdl = get_pftank2t_model(stop='2012:004:12:00:00', pitch=120.0,
+                                 evolve_method=evolve_method)
+        mvals[evolve_method] = mdl.mvals.copy()
+
+    assert np.all(mvals[3] == mvals[2])
+
+
+@pytest.mark.parametrize('j_step', [100, 101, 400])
+def test_evolve_method_3_step_input(j_step):
+    """Exponential integrator matches the analytic solution across a step
+    change in the input, which is linear between the model times"""
+    mdl = XijaModel('step', start='2012:001:12:00:00', stop='2012:004:12:00:00',
+                    evolve_method=3)
+    node = mdl.add(Node, 'node')
+    ext = mdl.add(Node, 'ext', predict=False)
+    mdl.add(Coupling, node, ext, tau=20.0)
+    mdl.add(HeatSink, node, T=-10.0, tau=50.0)
+    node.set_data(0.0)
+    ext.set_data(np.where(np.arange(mdl.n_times) < j_step, 10.0, 30.0))
+    mdl.make()
+    mdl.calc()
+
+    # dy/dt = (v - y) / tau with v the weighted mean of the input and the
+    # heat sink temperature, which ramps from v0 to v1 over one time step
+    tau = 1 / (1 / 20.0 + 1 / 50.0)
+    v0, v1 = [tau * (u / 20.0 - 10.0 / 50.0) for u in (10.0, 30.0)]
+    t = mdl.ksecs
+    t0 = t[j_step - 1]
+    dt = t[j_step] - t0
+    y0 = v0 * (1 - np.exp(-t0 / tau))
+    slope = (v1 - v0) / dt
+    y1 = v1 - slope * tau + (y0 - v0 + slope * tau) * np.exp(-dt / tau)
+    y = np.where(t <= t0, v0 * (1 - np.exp(-t / tau)),
+                 v1 + (y1 - v1) * np.exp(-(t - t0 - dt) / tau))
+    assert np.allclose(mdl.comp['node'].mvals, y, rtol=0, atol=1e-10)
+
+
+def test_evolve_method_4():
+    """Implicit TR-BDF2 solver matches RK4 for a non-stiff model and stays
+    stable for a stiff one where the explicit methods blow up.
+    """
+    def make_minusz(evolve_method, rk4=0, dt=None, tau=None):
+        mdl = ThermalModel('minusz', start='2012:001:12:00:00', stop='2012:010:12:00:00',
+                           model_spec=abs_path('minusz.json'),
+                           evolve_method=evolve_method, rk4=rk4, dt=dt)
+        for msid in ('tephin', 'tcylaft6', 'tcylfmzm', 'tmzp_my', 'tfssbkt1'):
+            mdl.comp[msid].set_data(10.0)
+        mdl.comp['pitch'].set_data(120.0)
+        mdl.comp['eclipse'].set_data(False)
+        if tau is not None:
+            for comp in mdl.comps:
+                if isinstance(comp, Coupling):
+                    comp.pars[0].val = tau
+        mdl.make()
+        mdl.calc()
+        return mdl
+
+    mdl2 = make_minusz(2, rk4=1)
+    mdl4 = make_minusz(4)
+    assert mdl2.check_stability() == []
+    assert np.allclose(mdl4.mvals[:mdl4.n_preds], mdl2.mvals[:mdl2.n_preds],
+                       rtol=0, atol=1e-2)
+
+    mdl4 = make_minusz(4, tau=0.2)
+    assert 'evolve_method=2 (RK4)' in mdl4.check_stability()
+    mdl2 = make_minusz(2, rk4=1, dt=32.8, tau=0.2)
+    assert mdl2.check_stability() == []
+    preds4 = mdl4.mvals[:mdl4.n_preds]
+    preds2 = mdl2.mvals[:mdl2.n_preds, ::10]
+    n = min(preds4.shape[1], preds2.shape[1]) - 1
+    assert np.all(np.isfinite(preds4))
+    # Allow for the start-up transient which is shorter than a 328 sec step
+    assert np.allclose(preds4[:, 10:n], preds2[:, 10:n], rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('name', ['minusz', 'pftank2t'])
+def test_solve_initial_state(name):
+    """Model started from the steady state stays there for constant inputs"""
+    mdl = ThermalModel(name, start='2012:001:12:00:00', stop='2012:005:12:00:00',
+                       model_spec=abs_path(name + '.json'))
+    for comp in mdl.comps:
+        if isinstance(comp, Node):
+            comp.set_data(10.0)
+    mdl.comp['pitch'].set_data(120.0)
+    mdl.comp['eclipse'].set_data(False)
+    mdl.make()
+    y = mdl.solve_initial_state()
+    mdl.calc()
+    preds = mdl.mvals[:mdl.n_preds]
+    assert np.allclose(preds[:, 0], y)
+    # Inputs vary slowly (e.g. solar distance) so only check the first hours
+    assert np.allclose(preds[:, :30], y[:, np.newaxis], rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('evolve_method,backend',
+                         [(1, None), (2, None), (3, None), (4, None), (1, 'soa'), (2, 'soa')])
+def test_extend(evolve_method, backend):
+    """Extending a model gives the same result as a full calculation"""
+    # Pitch change after the stop of the model that gets extended
+    pitch = (np.array([120.0, 150.0]),
+             DateTime(['2012:001:00:00:00', '2012:006:00:00:00']).secs)
+
+    full, mdl = (get_pftank2t_model(stop=stop, pitch=pitch, evolve_method=evolve_method,
+                                    backend=backend)
+                 for stop in ('2012:008:12:00:00', '2012:004:12:00:00'))
+    mdl.extend('2012:008:12:00:00', new_inputs={'pitch': pitch})
+
+    assert np.all(mdl.times == full.times)
+    assert np.all(mdl.comp['pitch'].dvals == full.comp['pitch'].dvals)
+    assert np.allclose(mdl.mvals, full.mvals, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('mvals_layout', ['comp', 'time'])
+def test_extend_new_times(mvals_layout):
+    """Extending a model only fetches and computes inputs for the new times"""
+    class PitchMSID(FakeMSID):
+        def __init__(self, msid, tstart, tstop):
+            super(PitchMSID, self).__init__(msid, tstart, tstop)
+            self.vals = 100.0 + 50 * self.vals
+
+    class Provider(object):
+        def __init__(self):
+            self.fetches = []
+
+        def fetch(self, msid, tstart, tstop, stat='5min'):
+            self.fetches.append((msid, tstart, tstop))
+            return (PitchMSID if msid == 'pitch' else FakeMSID)(msid, tstart, tstop)
+
+    full, mdl = (get_pftank2t_model(stop=stop, T=None, pitch=None,
+                                    mvals_layout=mvals_layout, provider=Provider())
+                 for stop in ('2012:008:12:00:00', '2012:004:12:00:00'))
+    n_fetches = len(mdl.provider.fetches)
+    tstop = mdl.tstop
+    mdl.enable_profiling(trace=False)
+    mdl.extend('2012:008:12:00:00')
+    mdl.disable_profiling()
+
+    fetches = mdl.provider.fetches[n_fetches:]
+    assert sorted(fetch[0] for fetch in fetches) == ['pf0tank2t', 'pftank2t', 'pitch']
+    assert all(tstop - fetch[1] < 3600 for fetch in fetches)
+    # Solar heat of the old times is kept, not updated over the full range
+    n_calls = {(row['phase'], row['comp']): row['n_calls']
+               for row in mdl.profile_report()}
+    assert ('update', 'solarheat__pf0tank2t') not in n_calls
+    assert np.all(mdl.times == full.times)
+    assert np.allclose(mdl.comp['solarheat__pf0tank2t'].dvals,
+                       full.comp['solarheat__pf0tank2t'].dvals, rtol=0, atol=1e-12)
+    assert np.allclose(mdl.mvals, full.mvals, rtol=0, atol=1e-10)
+
+    # Component updated over the extended times after a parameter change
+    for model in (full, mdl):
+        model.comp['solarheat__pf0tank2t'].pars_dict['P_90'].val += 0.1
+        model.calc()
+    assert np.allclose(mdl.mvals, full.mvals, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('evolve_method', [1, 2])
+def test_iter_calc(evolve_method):
+    """Chunked calculation gives the same result as a full calculation"""
+    mdl = get_pftank2t_model(stop='2012:010:12:00:00', make=False,
+                             evolve_method=evolve_method)
+
+    chunks = list(mdl.iter_calc(chunk_days=2.0))
+    assert len(chunks) == 5
+    times = np.concatenate([chunk[0] for chunk in chunks])
+    mvals = np.concatenate([chunk[1] for chunk in chunks], axis=1)
+
+    mdl.make()
+    mdl.calc()
+    assert np.all(times == mdl.times)
+    assert np.allclose(mvals, mdl.mvals, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_calc_stat_grad(evolve_method, rk4):
+    """Sensitivity gradient of the fit statistic matches finite differences"""
+    mdl = get_pftank2t_model(T=wave_T, calc=False, evolve_method=evolve_method, rk4=rk4)
+
+    pars = [par for par in mdl.pars if not par.frozen]
+    stat, grad = mdl.calc_stat(grad=True, grad_method='forward')
+    assert len(grad) == len(pars)
+    assert np.isclose(stat, mdl.calc_stat())
+
+    # Adjoint gradient, including bad times which are excluded from the stat
+    stat_adj, grad_adj = mdl.calc_stat(grad=True)
+    assert stat_adj == stat
+    assert np.allclose(grad_adj, grad, rtol=1e-8, atol=1e-10 * abs(stat))
+    mdl.append_mask_times(['2012:003:00:00:00', '2012:004:00:00:00'])
+    mdl.make()
+    stat_bad, grad_bad = mdl.calc_stat(grad=True, grad_method='forward')
+    assert stat_bad < stat
+    assert np.allclose(mdl.calc_stat(grad=True)[1], grad_bad, rtol=1e-8,
+                       atol=1e-10 * abs(stat))
+    mdl.reset_mask_times()
+
+    for i, par in enumerate(pars):
+        val = par.val
+        step = 1e-4 * max(1.0, abs(val))
+        par.val = val + step
+        stat_hi = mdl.calc_stat()
+        par.val = val - step
+        stat_lo = mdl.calc_stat()
+        par.val = val
+        grad_fd = (stat_hi - stat_lo) / (2 * step)
+        assert np.isclose(grad[i], grad_fd, rtol=1e-4, atol=1e-6 * abs(stat))
+
+
+def test_calc_stat_grad_cost():
+    """Adjoint gradient needs one model evaluation regardless of the number of
+    parameters that have per-component gradients"""
+    mdl = get_pftank2t_model(stop='2012:061:12:00:00', T=wave_T, calc=False)
+    mdl.calc_stat(grad=True)
+    solarheat_tau = mdl.comp['solarheat__pf0tank2t'].pars_dict['tau']
+
+    def count_grad_calls(thawed):
+        for par in mdl.pars:
+            par.frozen = par not in thawed
+        mdl.enable_profiling(trace=False)
+        for _ in range(5):
+            mdl.calc_stat(grad=True)
+        mdl.disable_profiling()
+        return {(row['phase'], row['comp']): row['n_calls']
+                for row in mdl.profile_report()}
+
+    n_calls_1 = count_grad_calls(mdl.pars[:1])
+    n_calls_all = count_grad_calls([par for par in mdl.pars if par is not solarheat_tau])
+    # One model evaluation per gradient regardless of the thawed parameters
+    assert n_calls_1['make_tmal', ''] == n_calls_all['make_tmal', ''] == 5
+    assert n_calls_all['integrate', ''] == 5
+
+    # Parameters without a per-component gradient use finite differences
+    n_calls_fd = count_grad_calls([solarheat_tau])
+    assert n_calls_fd['update', 'solarheat__pf0tank2t'] > 5
+
+    for par in mdl.pars:
+        par.frozen = False
+
+
+def test_profiling(tmpdir):
+    """Profiling records per phase and per component times and a trace"""
+    mdl = get_pftank2t_model(T=20.0, calc=False)
+    with pytest.raises(ValueError):
+        mdl.profile_report()
+
+    mdl.enable_profiling()
+    solarheat = mdl.comp['solarheat__pf0tank2t']
+    for _ in range(3):
+        # Change a solar heat parameter so the component is updated each time
+        solarheat.pars[0].val += 0.01
+        mdl.calc_stat()
+    mdl.disable_profiling()
+    mdl.calc_stat()
+    assert mdl.profiler is None
+
+    report = mdl.profile_report()
+    n_calls = {(row['phase'], row['comp']): row['n_calls'] for row in report}
+    assert n_calls['fit_stat', ''] == 3
+    assert n_calls['integrate', ''] == 3
+    assert n_calls['update', 'solarheat__pf0tank2t'] == 3
+    assert n_calls['calc_stat', 'pftank2t'] == 3
+    assert n_calls['calc_stat', ''] == 6
+    # Component dvals are timed as part of the phase that needs them
+    assert not any(phase == 'dvals' for phase, _ in n_calls)
+    assert np.all(report['total'][:-1] >= report['total'][1:])
+
+    filename = str(tmpdir.join('trace.json'))
+    mdl.write_profile_trace(filename)
+    with open(filename) as fh:
+        events = json.load(fh)['traceEvents']
+    assert len([event for event in events if event['name'] == 'integrate']) == 3
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_mvals_layout(evolve_method, rk4):
+    """Time-major mvals layout gives the same result as the default layout"""
+    mdls = []
+    for mvals_layout in ('comp', 'time'):
+        mdls.append(get_pftank2t_model(evolve_method=evolve_method, rk4=rk4,
+                                       mvals_layout=mvals_layout))
+
+    mdl_comp, mdl_time = mdls
+    assert mdl_time.mvals.T.flags.c_contiguous
+    assert np.all(mdl_time.mvals == mdl_comp.mvals)
+    node = mdl_time.comp['pftank2t']
+    assert np.shares_memory(node.mvals, mdl_time.mvals)
+    assert np.all(node.mvals == mdl_comp.comp['pftank2t'].mvals)
+
+    # Continuing from a checkpoint column uses the same buffer
+    mdl_time.kernel.run(j0=100)
+    assert np.all(mdl_time.mvals == mdl_comp.mvals)
+
+    with pytest.raises(ValueError):
+        ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'),
+                     mvals_layout='row')
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+@pytest.mark.parametrize('mvals_layout', ['comp', 'time'])
+def test_float32(evolve_method, rk4, mvals_layout):
+    """Single precision model values agree with float64 to well below 0.01 degC"""
+    mdls = []
+    for dtype in (np.float64, np.float32):
+        mdls.append(get_pftank2t_model(evolve_method=evolve_method, rk4=rk4,
+                                       mvals_layout=mvals_layout, dtype=dtype))
+
+    mdl64, mdl32 = mdls
+    assert mdl32.mvals.dtype == np.float32
+    assert mdl32.tmal_floats.dtype == np.float32
+    assert np.allclose(mdl32.mvals, mdl64.mvals, rtol=0, atol=1e-3)
+
+    parvals = np.array([mdl64.parvals] * 2)
+    batch32 = mdl32.calc_batch(parvals)
+    assert batch32.dtype == np.float32
+    assert np.allclose(batch32, mdl64.calc_batch(parvals), rtol=0, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        mdl32.calc_stat(grad=True)
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_many_nodes(evolve_method, rk4):
+    """C core handles more than 100 predicted nodes in both precisions"""
+    mdls = []
+    for backend, dtype in (('c', np.float64), ('c', np.float32),
+                           ('soa', np.float64), ('soa', np.float32)):
+        mdl = XijaModel('chain', start='2012:001:12:00:00', stop='2012:003:12:00:00',
+                        evolve_method=evolve_method, rk4=rk4, backend=backend,
+                        dtype=dtype)
+        nodes = [mdl.add(Node, 'node{}'.format(i)) for i in range(120)]
+        for node1, node2 in zip(nodes[:-1], nodes[1:]):
+            mdl.add(Coupling, node1, node2, tau=1.0)
+        mdl.add(HeatSink, nodes[-1], T=-10.0, tau=10.0)
+        for node in nodes:
+            node.set_data(20.0)
+        mdl.make()
+        mdl.calc()
+        mdls.append(mdl)
+
+    mdl_c, mdl_c32, mdl_soa, mdl_soa32 = mdls
+    assert mdl_c.n_preds == 120
+    assert mdl_c.mvals[-1, -1] < 0
+    assert np.allclose(mdl_soa.mvals, mdl_c.mvals, rtol=0, atol=1e-10)
+    assert np.allclose(mdl_c32.mvals, mdl_c.mvals, rtol=0, atol=1e-3)
+    assert mdl_soa32.mvals.dtype == np.float32
+    assert np.allclose(mdl_soa32.mvals, mdl_c32.mvals, rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize('backend', ['c', 'soa'])
+@pytest.mark.parametrize('evolve_method', [1, 2])
+def test_core_alloc_failure(monkeypatch, evolve_method, backend):
+    """Allocation failure in the C core raises instead of leaving mvals
+    partially computed"""
+    mdl = XijaModel('chain', start='2012:001:12:00:00', stop='2012:003:12:00:00',
+                    evolve_method=evolve_method, backend=backend)
+    node1 = mdl.add(Node, 'node1')
+    node2 = mdl.add(Node, 'node2')
+    mdl.add(Coupling, node1, node2, tau=1.0)
+    mdl.add(HeatSink, node2, T=-10.0, tau=10.0)
+    for node in (node1, node2):
+        node.set_data(20.0)
+    mdl.make()
+
+    class FailingCore(object):
+        @staticmethod
+        def calc_model_1(*args):
+            return -1
+
+        @staticmethod
+        def calc_model_2(*args):
+            return -1
+
+        calc_model_1_soa = calc_model_1
+        calc_model_2_soa = calc_model_2
+
+    monkeypatch.setattr(XijaModel, 'core_1', FailingCore)
+    monkeypatch.setattr(XijaModel, 'core_2', FailingCore)
+    with pytest.raises(MemoryError, match='calc_model_{}'.format(evolve_method)):
+        mdl.calc()
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_backends(evolve_method, rk4):
+    """Numba and struct-of-arrays backends give the same result as the C core"""
+    mdls = []
+    for backend, mvals_layout in (('c', 'comp'), ('numba', 'comp'), ('soa', 'comp'),
+                                  ('soa', 'time')):
+        mdls.append(get_pftank2t_model(evolve_method=evolve_method, rk4=rk4,
+                                       backend=backend, mvals_layout=mvals_layout))
+
+    mdl_c, mdl_numba, mdl_soa, mdl_soa_time = mdls
+    assert isinstance(mdl_c.kernel, CoreKernel)
+    assert isinstance(mdl_numba.kernel, NumbaKernel)
+    assert isinstance(mdl_soa.kernel, SoaKernel)
+    assert np.allclose(mdl_numba.mvals, mdl_c.mvals, rtol=0, atol=1e-10)
+    assert np.allclose(mdl_soa.mvals, mdl_c.mvals, rtol=0, atol=1e-10)
+    assert mdl_soa_time.mvals.flags.f_contiguous
+    assert np.allclose(mdl_soa_time.mvals, mdl_c.mvals, rtol=0, atol=1e-10)
+
+    groups = group_by_opcode(mdl_soa.tmal_ints, mdl_soa.n_preds)
+    assert sorted(np.concatenate(list(groups.values()))) == list(range(len(mdl_soa.tmal_ints)))
+    assert [len(groups[name]) for name in SOA_GROUPS] == list(mdl_soa.kernel.n_ops)
+
+
+def test_backend_registry():
+    class DummyKernel(object):
+        evolve_methods = (5,)
+
+    register_backend('dummy', DummyKernel)
+    try:
+        mdl = ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'),
+                           backend='dummy')
+        assert mdl.evolve_method == 5
+        assert mdl._get_kernel_class() is DummyKernel
+    finally:
+        BACKENDS.pop('dummy')
+
+    with pytest.raises(ValueError):
+        ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'),
+                     backend='fortran')
+
+    mdl = ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'),
+                       evolve_method=4, backend='numba')
+    with pytest.raises(ValueError):
+        mdl._get_kernel_class()
+
+    with pytest.raises(ValueError):
+        register_backend('dummy', object)
+
+
+def test_update_tracking():
+    """Components are only updated when their parameters or data change"""
+    mdl = get_pftank2t_model()
+    solarheat = mdl.comp['solarheat__pf0tank2t']
+    coupling = [comp for comp in mdl.comps if comp.name.startswith('coupling')][0]
+    n_updates = []
+    orig_update = solarheat.update
+
+    def update():
+        n_updates.append(1)
+        orig_update()
+
+    solarheat.update = update
+    par = solarheat.pars[0]
+    version = par.version
+    coupling.tau = coupling.tau * 1.1
+    mdl.calc()
+    assert len(n_updates) == 0
+
+    # Same result as a model where every component is updated
+    mdl2 = get_pftank2t_model(calc=False)
+    mdl2.parvals = mdl.parvals
+    mdl2.calc()
+    assert np.all(mdl.mvals == mdl2.mvals)
+
+    # Setting the same value does not count as a change
+    par.val = par.val
+    mdl.calc()
+    assert len(n_updates) == 0
+    assert par.version == version
+
+    mdl.parvals = [val + 0.01 if name == par.full_name else val
+                   for name, val in zip(mdl.parnames, mdl.parvals)]
+    mdl.calc()
+    assert len(n_updates) == 1
+    assert par.version == version + 1
+    assert 'version' not in dict(par)
+
+    # make() rebuilds mvals so every component is updated again
+    mdl.make()
+    mdl.calc()
+    assert len(n_updates) == 2
+
+    # Direct writes into the input rows persist until invalidate() or
+    # set_data() forces the updates
+    mvals = mdl.mvals.copy()
+    mdl.mvals[solarheat.mvals_i] = 0.0
+    mdl.calc()
+    assert len(n_updates) == 2
+    assert np.all(solarheat.mvals == 0.0)
+    mdl.invalidate()
+    mdl.calc()
+    assert len(n_updates) == 3
+    assert np.all(mdl.mvals == mvals)
+
+    mdl.mvals[solarheat.mvals_i] = 0.0
+    mdl.comp['eclipse'].set_data(False)
+    mdl.calc()
+    assert len(n_updates) == 4
+    assert np.all(mdl.mvals == mvals)
+
+
+def test_param_store():
+    """Parameter values are views of one model parameter array"""
+    mdl = ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'))
+    par = mdl.pars[1]
+    assert par._vals is mdl._parvals
+    assert mdl.parvals == tuple(p.val for p in mdl.pars)
+    assert dict(par)['val'] == par.val == par['val']
+
+    vals = np.array(mdl.parvals)
+    vals[1] += 1.0
+    versions = [p.version for p in mdl.pars]
+    mdl.parvals = vals
+    assert par.val == vals[1]
+    assert [p.version - version for p, version in zip(mdl.pars, versions)] == \
+        [1 if i == 1 else 0 for i in range(len(vals))]
+
+    par.val = 2.5
+    assert mdl._parvals[1] == 2.5
+    comp = mdl.comp[par.comp_name]
+    assert np.all(comp.parvals == [p.val for p in comp.pars])
+    assert getattr(comp, par.name) == 2.5
+
+    with pytest.raises(ValueError):
+        mdl.parvals = vals[1:]
+
+
+def test_param_copy_pickle():
+    """Copied and pickled parameters keep their value"""
+    mdl = ThermalModel('pftank2t', model_spec=abs_path('pftank2t.json'))
+    par = mdl.pars[1]
+    par_copy = copy.copy(par)
+    assert dict(par_copy) == dict(par)
+    par_copy.val += 1.0
+    assert par_copy.val == par.val + 1.0
+
+    pars = pickle.loads(pickle.dumps(mdl.pars))
+    assert [dict(p) for p in pars] == [dict(p) for p in mdl.pars]
+    # Unpickled parameters still share one value array
+    assert pars[0]._vals is pars[1]._vals
+    pars[1].val = 3.0
+    assert pars[0]._vals[1] == 3.0 and par.val != 3.0
+
+    with pytest.raises(ValueError, match='not None'):
+        mdl.comp[par.comp_name].add_par('new_par')
+    assert not hasattr(par, 'no_such_attr')
+
+
+def test_solarheat_weights():
+    """SolarHeat powers from the precomputed sparse interpolation weights"""
+    xp = np.array([45.0, 65.0, 90.0, 130.0, 180.0])
+    fp = np.array([1.0, 0.5, -0.2, 0.3, 0.8])
+    x = np.concatenate([xp, np.linspace(45, 180, 101)])
+    weights = interpolation_weights(xp, x)
+    assert weights.nnz == 2 * len(x)
+    assert np.allclose(weights.dot(fp), np.interp(x, xp, fp), rtol=0, atol=1e-14)
+
+    mdl = ThermalModel('pftank2t', start='2012:001:12:00:00', stop='2012:006:12:00:00',
+                       model_spec=abs_path('pftank2t.json'))
+    mdl.comp['pitch'].set_data(np.linspace(40, 175, mdl.n_times))
+    mdl.comp['eclipse'].set_data(np.arange(mdl.n_times) % 10 == 0)
+    comp = mdl.comp['solarheat__pf0tank2t']
+    for _ in range(2):
+        comp.pars[0].val += 0.1
+        dvals = comp.dvals
+        pitches = np.clip(mdl.comp['pitch'].dvals, comp.P_pitches[0], comp.P_pitches[-1])
+        P_vals = np.interp(pitches, comp.P_pitches, comp.parvals[:comp.n_pitches] + comp.bias)
+        dP_vals = np.interp(pitches, comp.P_pitches,
+                            comp.parvals[comp.n_pitches:2 * comp.n_pitches])
+        expected = (P_vals + dP_vals * comp.var_func(comp.t_days, comp.tau)
+                    + comp.ampl * np.cos(comp.t_phase))
+        expected[mdl.comp['eclipse'].dvals] = 0.0
+        assert np.allclose(dvals, expected, rtol=0, atol=1e-12)
+
+
+def test_varpro():
+    """Variable projection recovers the model from its own predictions"""
+    def make_chain(data=None):
+        mdl = ThermalModel('chain', start='2012:001:12:00:00', stop='2012:006:12:00:00')
+        pitch = mdl.add(Pitch)
+        eclipse = mdl.add(Eclipse)
+        nodes = []
+        for i in range(3):
+            node = mdl.add(Node, 'node{}'.format(i))
+            mdl.add(SolarHeat, node, pitch, eclipse, [45, 90, 130, 180],
+                    Ps=[0.2 * (i + 1), 0.5, 0.8, 0.3])
+            if nodes:
+                mdl.add(Coupling, node, nodes[-1], tau=20.0 + 5 * i)
+            nodes.append(node)
+        mdl.add(HeatSinkRef, nodes[0], T=-10.0, tau=30.0)
+        mdl.add(StepFunctionPower, nodes[2], '2012:004:00:00:00', P=0.3)
+        pitch.set_data(110 + 60 * np.sin(np.arange(mdl.n_times) / 50.0))
+        eclipse.set_data(False)
+        for i, node in enumerate(nodes):
+            node.set_data(10.0 if data is None else data[i])
+        for par in mdl.pars:
+            par.frozen = not (par.name.startswith('P')
+                              or par.name == 'tau' and par.comp_name.startswith('coupling'))
+        mdl.make()
+        return mdl
+
+    mdl = make_chain()
+    mdl.calc()
+    mdl = make_chain(mdl.mvals[:3].copy())
+    pars = varpro.get_linear_pars(mdl)
+    assert len(pars) == 14
+    assert [par.name for par in mdl.pars
+            if not par.frozen and not varpro.is_linear_par(mdl, par)] == ['tau', 'tau']
+    assert mdl.calc_stat() < 1e-20
+
+    for par in pars:
+        par.val = par.val + 0.1
+    assert mdl.calc_stat() > 1e3
+    assert varpro.solve_linear_pars(mdl) < 1e-12
+
+    mdl.comp['coupling__node1__node0'].tau *= 1.2
+    assert varpro.solve_linear_pars(mdl) > 1.0
+    result = varpro.fit(mdl)
+    assert result.fun < 1e-4
+    assert np.isclose(mdl.comp['coupling__node1__node0'].tau, 25.0, rtol=1e-3)
+
+
+@pytest.mark.parametrize('evolve_method,rk4', [(1, 0), (2, 0), (2, 1)])
+def test_superposition(evolve_method, rk4):
+    """Convolution with the impulse responses matches the integrated model"""
+    mdl = ThermalModel('minusz', start='2012:001:12:00:00', stop='2012:004:12:00:00',
+                       model_spec=abs_path('minusz.json'),
+                       evolve_method=evolve_method, rk4=rk4)
+    times = (mdl.times - mdl.times[0]) / 10000.0
+    for msid in ('tephin', 'tcylaft6', 'tcylfmzm', 'tmzp_my', 'tfssbkt1'):
+        mdl.comp[msid].set_data(10.0)
+    mdl.comp['pitch'].set_data(45.1 + 55 * (1 + sin(times / 2)))
+    mdl.comp['eclipse'].set_data(cos(times) > 0.95)
+    mdl.make()
+    mdl.calc()
+
+    engine = SuperpositionEngine(mdl)
+    n_preds = mdl.n_preds
+    assert np.allclose(engine.predict(), mdl.mvals[:n_preds], rtol=0, atol=1e-10)
+
+    # New input histories, also several at once
+    inputs = mdl.mvals[engine.input_rows] * (1 + 0.3 * sin(times / 3))
+    preds = engine.predict(np.stack([inputs, 0.5 * inputs]))
+    assert preds.shape == (2, n_preds, mdl.n_times)
+    mdl.mvals[engine.input_rows] = inputs
+    mdl.kernel.run()
+    assert np.allclose(preds[0], mdl.mvals[:n_preds], rtol=0, atol=1e-10)
+
+    # Heat powers only change the inputs but time constants change the network
+    mdl.comp['solarheat__tephin'].pars[0].val += 0.1
+    assert engine.is_current
+    mdl.comp['coupling__tephin__tcylaft6'].tau *= 1.5
+    assert not engine.is_current
+    mdl.calc()
+    assert np.allclose(engine.predict(), mdl.mvals[:n_preds], rtol=0, atol=1e-10)
+    assert engine.is_current
+
+
+def test_prefetch(monkeypatch):
+    """make() reads each needed MSID once, concurrently"""
+    mdl = ThermalModel('pftank2t', start='2012:001:12:00:00', stop='2012:004:12:00:00',
+                       model_spec=abs_path('pftank2t.json'))
+    msids = ['pftank2t', 'pf0tank2t', 'pitch', 'aoeclips']
+    # Each read only returns once all of them are in progress
+    barrier = threading.Barrier(len(msids), timeout=10)
+    fetched = []
+
+    class FakeMSID(object):
+        def __init__(self, msid):
+            self.times = np.arange(mdl.tstart - 2000, mdl.tstop + 2000, 328.0)
+            self.vals = np.full(len(self.times), 'DAY ' if msid == 'aoeclips'
+                                else 90.0 if msid == 'pitch' else 20.0)
+
+    def fake_fetch_tlm(self, msid):
+        barrier.wait()
+        fetched.append(msid)
+        return FakeMSID(msid)
+
+    monkeypatch.setattr(XijaModel, '_fetch_tlm', fake_fetch_tlm)
+    assert sorted(sum([list(comp.get_fetch_msids()) for comp in mdl.comps], [])) == sorted(msids)
+    mdl.make()
+    assert sorted(fetched) == sorted(msids)
+    assert np.all(mdl.comp['pftank2t'].dvals == 20.0)
+    assert np.all(mdl.comp['pitch'].dvals == 90.0)
+    assert not np.any(mdl.comp['eclipse'].dvals)
+
+    # Cached telemetry is reused
+    assert np.all(mdl.fetch('pitch') == 90.0)
+    assert len(fetched) == len(msids)
+
+
+class FakeMSID(object):
+    """Telemetry at 5-min samples aligned with the model times"""
+    colnames = ['vals', 'maxes']
+
+    def __init__(self, msid, tstart, tstop):
+        i0 = np.ceil((tstart - xija.model.TIME0) / 328.0)
+        i1 = np.floor((tstop - xija.model.TIME0) / 328.0)
+        self.times = xija.model.TIME0 + np.arange(i0, i1 + 1) * 328.0
+        self.vals = np.sin(self.times / 1e5)
+        self.maxes = self.vals + 1.0
+
+
+def test_telemetry_cache(monkeypatch, tmp_path):
+    """Only telemetry missing from the disk cache is read from the archive"""
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    reads = []
+
+    def fake_fetch(self, msid, tstart, tstop, stat='5min'):
+        reads.append((tstart, tstop))
+        return FakeMSID(msid, tstart, tstop)
+
+    monkeypatch.setattr(providers.EngArchiveProvider, 'fetch', fake_fetch)
+
+    def fetch(start, stop, attr='vals'):
+        mdl = XijaModel('test', start=start, stop=stop)
+        return mdl, mdl.fetch('pitch', attr)
+
+    mdl, vals = fetch('2012:001:12:00:00', '2012:004:12:00:00')
+    assert len(reads) == 1
+    assert np.allclose(vals, np.sin(mdl.times / 1e5))
+
+    # Fully cached, including another attribute
+    mdl, vals = fetch('2012:002:00:00:00', '2012:003:00:00:00', attr='maxes')
+    assert len(reads) == 1
+    assert np.allclose(vals, np.sin(mdl.times / 1e5) + 1.0)
+
+    # Extending the time range reads only the new part, and the two segments
+    # are merged into one
+    mdl, vals = fetch('2012:001:12:00:00', '2012:006:00:00:00')
+    assert len(reads) == 2
+    assert reads[1][0] >= DateTime('2012:004:12:00:00').secs
+    assert np.allclose(vals, np.sin(mdl.times / 1e5))
+    tlm_cache = cache.get_telemetry_cache()
+    assert len(tlm_cache.cache.entries('pitch/5min/')) == 1
+    assert tlm_cache.get_gaps('pitch', mdl.tstart, mdl.tstop) == []
+
+    # Least recently used entries are evicted beyond the size limit
+    disk_cache = cache.DiskCache(tmp_path / 'lru', max_bytes=2000)
+    for key in ('a', 'b', 'c'):
+        disk_cache.put(key, {'vals': np.zeros(100)})
+        disk_cache.get('a')
+    assert sorted(disk_cache.entries()) == ['a', 'c']
+    assert disk_cache.size <= 2000
+    assert np.all(disk_cache.get('c')['vals'] == 0.0)
+
+    # Reads do not rewrite the index until the access times are flushed
+    index = (tmp_path / 'lru' / 'index.json').read_text()
+    disk_cache.get('a')
+    assert (tmp_path / 'lru' / 'index.json').read_text() == index
+    disk_cache.flush()
+    assert (tmp_path / 'lru' / 'index.json').read_text() != index
+
+    # A segment evicted before it is read is fetched again
+    tlm_cache = cache.TelemetryCache(tmp_path / 'evict')
+    archive_fetch = providers.EngArchiveProvider().fetch
+    tstart = mdl.tstart
+    tlm_cache.fetch('pitch', tstart, tstart + 1e5, archive_fetch)
+    n_reads = len(reads)
+    monkeypatch.setattr(tlm_cache.cache, 'get', lambda key: None)
+    tlm = tlm_cache.fetch('pitch', tstart, tstart + 2e5, archive_fetch)
+    assert reads[n_reads:] == [(tstart, tstart + 2e5)]
+    assert np.all(np.diff(tlm.times) == 328.0)
+    assert tlm.times[0] - tstart < 328.0 and tstart + 2e5 - tlm.times[-1] < 328.0
+
+
+def test_file_provider(tmp_path):
+    """Model inputs read from local files recorded from another provider"""
+    start, stop = '2012:001:12:00:00', '2012:004:12:00:00'
+    provider = providers.FileProvider(tmp_path)
+    tstart = DateTime(start).secs - 5000
+    tstop = DateTime(stop).secs + 5000
+    provider.write_msid('PITCH', FakeMSID('pitch', tstart, tstop))
+    tlm = FakeMSID('1dpamzt', tstart, tstop)
+    np.savez(tmp_path / '5min' / '1dpamzt.npz', times=tlm.times, vals=tlm.vals)
+    tstarts = np.arange(tstart, tstop, 20000.0)
+    provider.write_cmd_states(np.rec.fromarrays(
+        [tstarts, tstarts + 20000.0, np.arange(len(tstarts)) % 7],
+        names=['tstart', 'tstop', 'ccd_count']))
+
+    mdl = XijaModel('test', start=start, stop=stop, provider=provider)
+    assert np.allclose(mdl.fetch('pitch'), np.sin(mdl.times / 1e5))
+    assert np.allclose(mdl.fetch('pitch', 'maxes'), np.sin(mdl.times / 1e5) + 1.0)
+    assert np.allclose(mdl.fetch('1dpamzt'), np.sin(mdl.times / 1e5))
+    idxs = np.searchsorted(tstarts + 20000.0, mdl.times)
+    assert np.all(mdl.cmd_states['ccd_count'] == idxs % 7)
+
+    with pytest.raises(ValueError, match='no data file'):
+        mdl.fetch('aoeclips')
+    mdl = XijaModel('test', start=start, stop='2012:010:00:00:00', provider=provider)
+    with pytest.raises(ValueError, match='does not span'):
+        mdl.fetch('pitch')
+
+
+def test_earth_heat_cache(monkeypatch, tmp_path):
+    """EarthHeat illumination is reused for identical ephemeris and attitude"""
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path))
+    calls = []
+
+    def fake_calc(self, ephems, q_atts):
+        calls.append(len(ephems))
+        self._dvals[:] = ephems[:, 0] * 1e-9 + q_atts[:, 3]
+
+    monkeypatch.setattr(EarthHeat, 'calc_earth_vis_from_grid', fake_calc)
+
+    def get_earth_heat(q4=1.0):
+        mdl = XijaModel('test', start='2012:001:12:00:00', stop='2012:004:12:00:00')
+        node = mdl.add(Node, 'node')
+        days = (mdl.times - mdl.tstart) / 86400.0
+        names = []
+        for axis, vals in zip('xyz', (np.cos(days), np.sin(days), days)):
+            names.append('orbitephem0_' + axis)
+            mdl.add(TelemData, names[-1]).set_data(vals * 1e8)
+        for i, vals in enumerate((0.0, 0.0, np.sqrt(1 - q4 ** 2), q4)):
+            names.append('aoattqt{}'.format(i + 1))
+            mdl.add(TelemData, names[-1]).set_data(vals)
+        return mdl.add(EarthHeat, node, *names)
+
+    dvals = get_earth_heat().dvals.copy()
+    assert len(calls) == 1
+    assert len(cache.get_disk_cache('earth_vis').entries('grid/')) == 1
+
+    earth_heat = get_earth_heat()
+    assert np.all(earth_heat.dvals == dvals)
+    assert not earth_heat.dvals.flags.writeable
+    assert len(calls) == 1
+
+    # Different attitude inputs are not served from the cache
+    assert np.allclose(get_earth_heat(q4=0.8).dvals, dvals - 0.2)
+    assert len(calls) == 2
+
+    # Nor are values from another xija version or grid file
+    monkeypatch.setattr(xija, '__version__', xija.__version__ + '.test')
+    assert np.all(get_earth_heat().dvals == dvals)
+    assert len(calls) == 3
+
+    grid_path = tmp_path / 'earth_vis_grid.fits.gz'
+    grid_path.write_bytes(b'grid')
+    monkeypatch.setattr(EarthHeat, 'earth_vis_grid_path', grid_path)
+    get_earth_heat().dvals
+    assert len(calls) == 4
+    grid_path.write_bytes(b'new grid')
+    get_earth_heat().dvals
+    assert len(calls) == 5
+    get_earth_heat().dvals
+    assert len(calls) == 5
@@ -1,4 +1,6 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
+import numpy as np
+
 OPCODES = {'coupling': 0,
            'heatsink': 1,
            'precomputed_heat': 2,
@@ -7,3 +9,42 @@ OPCODES = {'coupling': 0,
 N_INTS = 8
 N_FLOATS = 8
 
+# Groups of the struct-of-arrays form of a TMAL program, in the order used by
+# the ``calc_model_1_soa`` and ``calc_model_2_soa`` C routines.  'coupling' is
+# a coupling between two predicted nodes and 'coupling_ext' a coupling to a
+# node that is not predicted.
+SOA_GROUPS = ('coupling', 'coupling_ext', 'heatsink', 'precomputed_heat',
+              'heater')
+
+
+def group_by_opcode(tmal_ints, n_preds):
+    """Split the statements of a TMAL program into the ``SOA_GROUPS``.
+
+    Statements that only act on a node that is not predicted (other than
+    heaters, which also set their own model values) have no effect on the
+    model and are dropped.
+
+    Parameters
+    ----------
+    tmal_ints :
+        (n_tmals, N_INTS) array of TMAL integer codes
+    n_preds :
+        number of predicted nodes (leading rows of mvals)
+
+    Returns
+    -------
+    dict
+        index array of the ``tmal_ints`` rows in each group
+    """
+    tmal_ints = np.asarray(tmal_ints)
+    opcodes = tmal_ints[:, 0]
+    pred1 = tmal_ints[:, 1] < n_preds
+    pred2 = tmal_ints[:, 2] < n_preds
+    coupling = (opcodes == OPCODES['coupling']) & pred1
+    masks = {'coupling': coupling & pred2,
+             'coupling_ext': coupling & ~pred2,
+             'heatsink': (opcodes == OPCODES['heatsink']) & pred1,
+             'precomputed_heat': (opcodes == OPCODES['precomputed_heat']) & pred1,
+             'heater': np.isin(opcodes, (OPCODES['proportional_heater'],
+                                         OPCODES['thermostat_heater']))}
+    return {name: np.flatnonzero(masks[name]) for name in SOA_GROUPS}
@@ -0,0 +1,188 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Variable projection fitting of the parameters that enter the model linearly.
+
+The predicted node values are an affine function of every parameter that only
+scales a precomputed heat input, e.g. the SolarHeat ``P_*`` powers or the
+AcisDpaStatePower ``pow_*`` state powers, because the model ODE is linear in
+those inputs and the ODE solvers are linear maps.  Components list these
+parameters (as ``fnmatch`` patterns) in their ``linear_pars`` class attribute.
+
+For fixed values of all other parameters, the model is integrated once with
+the thawed linear parameters set to zero and once for each of them set to one,
+all in a single ``calc_batch()`` call.  The differences are the unit responses
+of the predicted nodes, so the linear parameters that minimize the fit
+statistic are the solution of a bounded weighted linear least squares problem.
+``fit()`` then only needs to search the remaining (nonlinear) thawed
+parameters such as the coupling time constants.
+"""
+import fnmatch
+
+import numpy as np
+import scipy.optimize
+
+from .linear import has_active_heaters
+
+__all__ = ['is_linear_par', 'get_linear_pars', 'solve_linear_pars', 'fit']
+
+
+def is_linear_par(model, par):
+    """True if the predicted node values depend linearly on ``par``.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+    par :
+        Param object
+
+    Returns
+    -------
+    bool
+    """
+    comp = model.comp[par.comp_name]
+    return any(fnmatch.fnmatchcase(par.name, pattern)
+               for pattern in comp.linear_pars)
+
+
+def get_linear_pars(model):
+    """Return the thawed parameters of ``model`` that enter linearly.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+
+    Returns
+    -------
+    list
+        Param objects
+    """
+    return [par for par in model.pars
+            if not par.frozen and is_linear_par(model, par)]
+
+
+def _get_fit_nodes(model):
+    """Return (mvals row, fit time indices, 1 / sigma) for each predicted node
+    that contributes to the fit statistic.  The times are those used by the
+    node ``calc_stat()``, i.e. excluding the model ``mask_times`` and any
+    times masked by the node ``mask`` component.
+    """
+    fit_nodes = []
+    for comp in model.comps:
+        if not comp.predict or comp.sigma == 0:
+            continue
+        ok = np.ones(model.n_times, dtype=bool)
+        for i0, i1 in model.mask_times_indices:
+            ok[i0:i1] = False
+        if comp.mask is not None:
+            ok &= comp.mask.mask
+        fit_nodes.append((comp, np.flatnonzero(ok), 1.0 / comp.sigma))
+    return fit_nodes
+
+
+def solve_linear_pars(model, pars=None):
+    """Set the linear parameters ``pars`` to the values within their bounds
+    which minimize the fit statistic for the current values of all other
+    parameters, then calculate the model.
+
+    The unit responses are computed with ``calc_batch()``, which holds the
+    model values for ``len(pars) + 1`` ensemble members in memory.  The model
+    must not include heaters (whose power depends on the node temperature) and
+    must have been made with ``make()``.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object
+    pars :
+        list of linear Param objects (default=thawed linear parameters)
+
+    Returns
+    -------
+    float
+        fit statistic
+    """
+    if pars is None:
+        pars = get_linear_pars(model)
+    if not pars:
+        return model.calc_stat()
+
+    model.make_tmal()
+    if has_active_heaters(model.tmal_ints):
+        raise ValueError('model with heaters is not linear in the heat powers')
+
+    par_idxs = {id(par): i for i, par in enumerate(model.pars)}
+    idxs = [par_idxs[id(par)] for par in pars]
+
+    # Member 0 has all linear parameters at zero and member k has only
+    # parameter k - 1 set to one.
+    n_pars = len(pars)
+    parvals = np.tile(model.parvals, (n_pars + 1, 1))
+    parvals[:, idxs] = 0.0
+    parvals[np.arange(1, n_pars + 1), idxs] = 1.0
+    mvals = model.calc_batch(parvals)
+    base = mvals[0]
+    resps = mvals[1:] - base
+
+    A = []
+    b = []
+    for comp, ok, inv_sigma in _get_fit_nodes(model):
+        i = comp.mvals_i
+        A.append(resps[:, i, ok].T * inv_sigma)
+        b.append((comp.dvals[ok] - base[i, ok]) * inv_sigma)
+    if not A:
+        raise ValueError('no predicted nodes contribute to the fit statistic')
+
+    bounds = ([par.min for par in pars], [par.max for par in pars])
+    result = scipy.optimize.lsq_linear(np.concatenate(A), np.concatenate(b),
+                                       bounds=bounds)
+    for par, val in zip(pars, result.x):
+        par.val = val
+
+    return model.calc_stat()
+
+
+def fit(model, method='Nelder-Mead', options=None):
+    """Fit the thawed model parameters by variable projection.
+
+    The optimizer searches only the thawed parameters that are not linear.
+    For each trial value the linear parameters are solved exactly with
+    ``solve_linear_pars()``.  On return the model parameters are set to the
+    best fit and the model is calculated.
+
+    Parameters
+    ----------
+    model :
+        XijaModel object which has been made with ``make()``
+    method :
+        ``scipy.optimize.minimize`` method (default='Nelder-Mead')
+    options :
+        dict of ``scipy.optimize.minimize`` options (default=None)
+
+    Returns
+    -------
+    OptimizeResult
+        result of ``scipy.optimize.minimize`` for the nonlinear parameters,
+        with ``fun`` the fit statistic at the best fit
+    """
+    linear_pars = get_linear_pars(model)
+    linear_ids = set(id(par) for par in linear_pars)
+    pars = [par for par in model.pars
+            if not par.frozen and id(par) not in linear_ids]
+
+    def calc_stat(vals):
+        for par, val in zip(pars, vals):
+            par.val = val
+        return solve_linear_pars(model, linear_pars)
+
+    if not pars:
+        stat = calc_stat([])
+        return scipy.optimize.OptimizeResult(x=np.array([]), fun=stat,
+                                             success=True, nfev=1)
+
+    result = scipy.optimize.minimize(
+        calc_stat, [par.val for par in pars], method=method,
+        bounds=[(par.min, par.max) for par in pars], options=options)
+    result.fun = calc_stat(result.x)
+    return result